@@ -0,0 +1,101 @@
+# %%
+# Microbenchmark of the per-chunk serialization cost in the streaming dispatchers.
+# Compares the former path (model_dump up to three times, json.dumps and an f-string)
+# with the dump-once pipeline feeding the bytes stringifiers.
+import argparse
+import asyncio
+import json
+import sys
+from pathlib import Path
+from time import perf_counter
+sys.path.append(str(Path(__file__).resolve().absolute().parent.parent))
+from cohere import (
+    ChatContentDeltaEventDelta,
+    ChatContentDeltaEventDeltaMessage,
+    ChatContentDeltaEventDeltaMessageContent,
+    ContentDeltaV2ChatStreamResponse,
+)
+from server.cohere_service import StreamingResponseHTTPExceptionDispatcherForCohere
+from server.json_utils import orjson
+
+
+def make_pieces(count: int) -> list[ContentDeltaV2ChatStreamResponse]:
+    return [
+        ContentDeltaV2ChatStreamResponse(
+            type='content-delta',
+            index=0,
+            delta=ChatContentDeltaEventDelta(
+                message=ChatContentDeltaEventDeltaMessage(
+                    content=ChatContentDeltaEventDeltaMessageContent(text=f'tok{i} ')
+                )
+            ),
+        )
+        for i in range(count)
+    ]
+
+
+class FormerDispatcherForCohereV2(StreamingResponseHTTPExceptionDispatcherForCohere):
+    """The dispatcher pipeline as it was before the dump-once change."""
+
+    async def _feed_response(self):
+        added = False
+        async for piece in self.response:
+            if not added:
+                piece_dict = piece.model_dump(exclude_unset=True, exclude_none=True)
+                if self._detect_finishing(piece_dict):
+                    for text in self.additional_string:
+                        yield self._create_intermediate_response(text)
+                    added = True
+            yield piece
+
+    async def _yield_items(self):
+        async for piece in self._feed_response():
+            self._set_generation_id(piece.model_dump(exclude_unset=True, exclude_none=True))
+            a_dict = piece.model_dump(exclude_unset=True, exclude_none=True)
+            yield f'event: {a_dict.get("type")}\ndata: {json.dumps(a_dict)}\n\n'
+
+
+def run_dispatcher(dispatcher_class, pieces) -> int:
+    async def feed():
+        for piece in pieces:
+            yield piece
+
+    async def consume():
+        dispatcher = dispatcher_class(response=feed(), api_version="v2")
+        size = 0
+        async for chunk in dispatcher._yield_items():
+            size += len(chunk)
+        return size
+
+    return asyncio.run(consume())
+
+
+def former_path(pieces) -> int:
+    return run_dispatcher(FormerDispatcherForCohereV2, pieces)
+
+
+def dump_once_path(pieces) -> int:
+    return run_dispatcher(StreamingResponseHTTPExceptionDispatcherForCohere, pieces)
+
+
+def measure(func, pieces, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = perf_counter()
+        func(pieces)
+        best = min(best, perf_counter() - started)
+    return best / len(pieces)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per-chunk serialization of streamed responses")
+    parser.add_argument("--chunks", "-n", type=int, default=20000, help="Number of content-delta chunks per run")
+    parser.add_argument("--repeat", "-r", type=int, default=5, help="Number of runs; the best one is reported")
+    args = parser.parse_args()
+    pieces = make_pieces(args.chunks)
+    former = measure(former_path, pieces, args.repeat)
+    dump_once = measure(dump_once_path, pieces, args.repeat)
+    print(f'JSON backend: {"orjson" if orjson is not None else "json (stdlib)"}')
+    print(f'former path:    {former * 1e6:8.2f} us/chunk')
+    print(f'dump-once path: {dump_once * 1e6:8.2f} us/chunk')
+    print(f'speedup:        {former / dump_once:8.2f}x')
@@ -15,6 +15,46 @@ class Environment:
     def __init__(self):
         self.cohere_url = self._ensure_trailing_slash(os.environ.get("COHERE_URL") or None)
         self.openai_url = self._ensure_trailing_slash(os.environ.get("OPENAI_URL") or None)
+        self.anthropic_url = self._ensure_trailing_slash(os.environ.get("ANTHROPIC_URL") or None)
+        self.cohere_urls: list[str] = [url.strip() for url in (os.environ.get("COHERE_URLS") or "").split(",") if url.strip()]
+        self.openai_urls: list[str] = [url.strip() for url in (os.environ.get("OPENAI_URLS") or "").split(",") if url.strip()]
+        self.anthropic_urls: list[str] = [url.strip() for url in (os.environ.get("ANTHROPIC_URLS") or "").split(",") if url.strip()]
+        self.lb_ewma_alpha: float = float(os.environ.get("LB_EWMA_ALPHA") or "0.3")
+        self.circuit_breaker: bool = (os.environ.get("CIRCUIT_BREAKER") or "no").lower() in ['yes', 'true']
+        self.circuit_breaker_window_seconds: float = float(os.environ.get("CIRCUIT_BREAKER_WINDOW_SECONDS") or "30")
+        self.circuit_breaker_min_calls: int = int(os.environ.get("CIRCUIT_BREAKER_MIN_CALLS") or "10")
+        self.circuit_breaker_failure_rate: float = float(os.environ.get("CIRCUIT_BREAKER_FAILURE_RATE") or "0.5")
+        self.circuit_breaker_slow_call_seconds: float = float(os.environ.get("CIRCUIT_BREAKER_SLOW_CALL_SECONDS") or "10")
+        self.circuit_breaker_slow_call_rate: float = float(os.environ.get("CIRCUIT_BREAKER_SLOW_CALL_RATE") or "0.8")
+        self.circuit_breaker_open_seconds: float = float(os.environ.get("CIRCUIT_BREAKER_OPEN_SECONDS") or "30")
+        self.circuit_breaker_half_open_probes: int = int(os.environ.get("CIRCUIT_BREAKER_HALF_OPEN_PROBES") or "2")
+        self.hedging: bool = (os.environ.get("HEDGING") or "no").lower() in ['yes', 'true']
+        self.hedge_delay_seconds: float = float(os.environ.get("HEDGE_DELAY_SECONDS") or "0")
+        self.hedge_delay_percentile: float = float(os.environ.get("HEDGE_DELAY_PERCENTILE") or "95")
+        self.hedge_budget_percent: float = float(os.environ.get("HEDGE_BUDGET_PERCENT") or "5")
+        self.rate_limit: bool = (os.environ.get("RATE_LIMIT") or "no").lower() in ['yes', 'true']
+        self.rate_limit_requests_per_second: float = float(os.environ.get("RATE_LIMIT_REQUESTS_PER_SECOND") or "10")
+        self.rate_limit_burst: float = float(os.environ.get("RATE_LIMIT_BURST") or "20")
+        self.rate_limit_tokens_per_minute: float = float(os.environ.get("RATE_LIMIT_TOKENS_PER_MINUTE") or "0")
+        self.rate_limit_queue_size: int = int(os.environ.get("RATE_LIMIT_QUEUE_SIZE") or "64")
+        self.rate_limit_max_wait_seconds: float = float(os.environ.get("RATE_LIMIT_MAX_WAIT_SECONDS") or "10")
+        self.rate_limit_max_keys: int = int(os.environ.get("RATE_LIMIT_MAX_KEYS") or "10000")
+        self.fair_scheduler: bool = (os.environ.get("FAIR_SCHEDULER") or "no").lower() in ['yes', 'true']
+        self.fair_scheduler_max_concurrency: int = int(os.environ.get("FAIR_SCHEDULER_MAX_CONCURRENCY") or "64")
+        self.fair_scheduler_quantum_tokens: float = float(os.environ.get("FAIR_SCHEDULER_QUANTUM_TOKENS") or "1000")
+        self.fair_scheduler_weights: list[str] = [entry.strip() for entry in (os.environ.get("FAIR_SCHEDULER_WEIGHTS") or "").split(",") if entry.strip()]
+        self.adaptive_concurrency: bool = (os.environ.get("ADAPTIVE_CONCURRENCY") or "no").lower() in ['yes', 'true']
+        self.adaptive_concurrency_initial_limit: int = int(os.environ.get("ADAPTIVE_CONCURRENCY_INITIAL_LIMIT") or "20")
+        self.adaptive_concurrency_min_limit: int = int(os.environ.get("ADAPTIVE_CONCURRENCY_MIN_LIMIT") or "1")
+        self.adaptive_concurrency_max_limit: int = int(os.environ.get("ADAPTIVE_CONCURRENCY_MAX_LIMIT") or "500")
+        self.adaptive_concurrency_backoff: float = float(os.environ.get("ADAPTIVE_CONCURRENCY_BACKOFF") or "0.9")
+        self.adaptive_concurrency_latency_tolerance: float = float(os.environ.get("ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE") or "2.0")
+        self.adaptive_concurrency_latency_window: int = int(os.environ.get("ADAPTIVE_CONCURRENCY_LATENCY_WINDOW") or "200")
+        self.adaptive_concurrency_max_queue: int = int(os.environ.get("ADAPTIVE_CONCURRENCY_MAX_QUEUE") or "1000")
+        self.stream_buffer: bool = (os.environ.get("STREAM_BUFFER") or "no").lower() in ['yes', 'true']
+        self.stream_buffer_max_bytes: int = int(os.environ.get("STREAM_BUFFER_MAX_BYTES") or "262144")
+        self.stream_buffer_global_max_bytes: int = int(os.environ.get("STREAM_BUFFER_GLOBAL_MAX_BYTES") or "67108864")
+        self.stream_buffer_policies: list[str] = [entry.strip() for entry in (os.environ.get("STREAM_BUFFER_POLICIES") or "").split(",") if entry.strip()]
         self.raise_4xx_when_blocked: bool = (os.environ.get("RAISE_4XX_WHEN_BLOCKED") or "yes").lower() in ['yes', 'true']
         self.precheck_api_key: bool = (os.environ.get("PRECHECK_API_KEY") or "no").lower() in ['yes', 'true']
         self.dev_record_time: bool = (os.environ.get("DEV_RECORD_TIME") or "no").lower() in ['yes', 'true']
@@ -29,6 +69,56 @@ class Environment:
         self.dev_show_incoming_message: bool = (os.environ.get("DEV_SHOW_INCOMING_MESSAGE") or "no").lower() in ['yes', 'true']
         self.debug_trace_response: bool = (os.environ.get("DEBUG_TRACE_RESPONSE") or "no").lower() in ['yes', 'true']
         self.debug_append_test_info: bool = (os.environ.get("DEBUG_APPEND_TEST_INFO") or "yes").lower() in ['yes', 'true']
+        self.client_pool_max_clients: int = int(os.environ.get("CLIENT_POOL_MAX_CLIENTS") or "64")
+        self.client_pool_idle_ttl_seconds: float = float(os.environ.get("CLIENT_POOL_IDLE_TTL_SECONDS") or "600")
+        self.upstream_max_connections: int = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS") or "200")
+        self.upstream_max_keepalive_connections: int = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS") or "50")
+        self.upstream_keepalive_expiry_seconds: float = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY_SECONDS") or "60")
+        self.upstream_timeout_seconds: float = float(os.environ.get("UPSTREAM_TIMEOUT_SECONDS") or "300")
+        self.passthrough_same_protocol: bool = (os.environ.get("PASSTHROUGH_SAME_PROTOCOL") or "no").lower() in ['yes', 'true']
+        self.compatibility_via_v2: bool = (os.environ.get("COMPATIBILITY_VIA_V2") or "no").lower() in ['yes', 'true']
+        self.cohere_v1_via_v2: bool = (os.environ.get("COHERE_V1_VIA_V2") or "no").lower() in ['yes', 'true']
+        self.first_chunk_timeout_seconds: float | None = float(os.environ.get("FIRST_CHUNK_TIMEOUT_SECONDS") or "0") or None
+        self.cancel_on_disconnect: bool = (os.environ.get("CANCEL_ON_DISCONNECT") or "yes").lower() in ['yes', 'true']
+        self.delta_coalescing: bool = (os.environ.get("DELTA_COALESCING") or "no").lower() in ['yes', 'true']
+        self.delta_coalescing_max_bytes: int = int(os.environ.get("DELTA_COALESCING_MAX_BYTES") or "512")
+        self.delta_coalescing_max_delay_seconds: float = float(os.environ.get("DELTA_COALESCING_MAX_DELAY_SECONDS") or "0.02")
+        self.compression: bool = (os.environ.get("COMPRESSION") or "no").lower() in ['yes', 'true']
+        self.compression_gzip_level: int = int(os.environ.get("COMPRESSION_GZIP_LEVEL") or "6")
+        self.compression_zstd_level: int = int(os.environ.get("COMPRESSION_ZSTD_LEVEL") or "3")
+        self.compression_min_bytes: int = int(os.environ.get("COMPRESSION_MIN_BYTES") or "1024")
+        self.response_cache: bool = (os.environ.get("RESPONSE_CACHE") or "no").lower() in ['yes', 'true']
+        self.response_cache_max_entries: int = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES") or "1024")
+        self.response_cache_ttl_seconds: float = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS") or "300")
+        self.stream_cache: bool = (os.environ.get("STREAM_CACHE") or "no").lower() in ['yes', 'true']
+        self.stream_cache_max_entries: int = int(os.environ.get("STREAM_CACHE_MAX_ENTRIES") or "256")
+        self.stream_cache_max_bytes: int = int(os.environ.get("STREAM_CACHE_MAX_BYTES") or str(64 * 1024 * 1024))
+        self.stream_cache_ttl_seconds: float = float(os.environ.get("STREAM_CACHE_TTL_SECONDS") or "300")
+        self.stream_cache_replay_timing: str = (os.environ.get("STREAM_CACHE_REPLAY_TIMING") or "instant").lower()
+        self.single_flight: bool = (os.environ.get("SINGLE_FLIGHT") or "no").lower() in ['yes', 'true']
+        self.single_flight_queue_chunks: int = int(os.environ.get("SINGLE_FLIGHT_QUEUE_CHUNKS") or "256")
+        self.single_flight_max_history_bytes: int = int(os.environ.get("SINGLE_FLIGHT_MAX_HISTORY_BYTES") or str(1024 * 1024))
+        self.semantic_cache: bool = (os.environ.get("SEMANTIC_CACHE") or "no").lower() in ['yes', 'true']
+        self.semantic_cache_model: str = os.environ.get("SEMANTIC_CACHE_MODEL") or "sentence-transformers/all-MiniLM-L6-v2"
+        self.semantic_cache_threshold: float = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD") or "0.95")
+        self.semantic_cache_capacity: int = int(os.environ.get("SEMANTIC_CACHE_CAPACITY") or "10000")
+        self.semantic_cache_dtype: str = (os.environ.get("SEMANTIC_CACHE_DTYPE") or "float16").lower()
+        self.semantic_cache_path: Path | None = Path(os.environ["SEMANTIC_CACHE_PATH"]) if os.environ.get("SEMANTIC_CACHE_PATH") else None
+        self.semantic_cache_snapshot_every: int = int(os.environ.get("SEMANTIC_CACHE_SNAPSHOT_EVERY") or "64")
+        self.disk_cache: bool = (os.environ.get("DISK_CACHE") or "no").lower() in ['yes', 'true']
+        self.disk_cache_path: Path | None = Path(os.environ.get("DISK_CACHE_PATH") or "/var/cache/llm_proxy/responses")
+        self.disk_cache_max_bytes: int = int(os.environ.get("DISK_CACHE_MAX_BYTES") or str(1024 * 1024 * 1024))
+        self.disk_cache_ttl_seconds: float = float(os.environ.get("DISK_CACHE_TTL_SECONDS") or "86400")
+        self.disk_cache_index_slots: int = int(os.environ.get("DISK_CACHE_INDEX_SLOTS") or "65536")
+        self.embedding_batching: bool = (os.environ.get("EMBEDDING_BATCHING") or "no").lower() in ['yes', 'true']
+        self.embedding_batch_window_seconds: float = float(os.environ.get("EMBEDDING_BATCH_WINDOW_SECONDS") or "0.005")
+        self.embedding_cache: bool = (os.environ.get("EMBEDDING_CACHE") or "no").lower() in ['yes', 'true']
+        self.embedding_cache_max_entries: int = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES") or "100000")
+        self.embedding_cache_max_bytes: int = int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES") or str(256 * 1024 * 1024))
+        self.embedding_cache_ttl_seconds: float = float(os.environ.get("EMBEDDING_CACHE_TTL_SECONDS") or "86400")
+        self.rerank_cache: bool = (os.environ.get("RERANK_CACHE") or "no").lower() in ['yes', 'true']
+        self.rerank_cache_max_entries: int = int(os.environ.get("RERANK_CACHE_MAX_ENTRIES") or "100000")
+        self.rerank_cache_ttl_seconds: float = float(os.environ.get("RERANK_CACHE_TTL_SECONDS") or "86400")
 
     _instance: Environment | None = None
 
@@ -44,6 +134,46 @@ class Environment:
             for key, value in dict(
                 cohere_url=self.cohere_url,
                 openai_url=self.openai_url,
+                anthropic_url=self.anthropic_url,
+                cohere_urls=self.cohere_urls,
+                openai_urls=self.openai_urls,
+                anthropic_urls=self.anthropic_urls,
+                lb_ewma_alpha=self.lb_ewma_alpha,
+                circuit_breaker=self.circuit_breaker,
+                circuit_breaker_window_seconds=self.circuit_breaker_window_seconds,
+                circuit_breaker_min_calls=self.circuit_breaker_min_calls,
+                circuit_breaker_failure_rate=self.circuit_breaker_failure_rate,
+                circuit_breaker_slow_call_seconds=self.circuit_breaker_slow_call_seconds,
+                circuit_breaker_slow_call_rate=self.circuit_breaker_slow_call_rate,
+                circuit_breaker_open_seconds=self.circuit_breaker_open_seconds,
+                circuit_breaker_half_open_probes=self.circuit_breaker_half_open_probes,
+                hedging=self.hedging,
+                hedge_delay_seconds=self.hedge_delay_seconds,
+                hedge_delay_percentile=self.hedge_delay_percentile,
+                hedge_budget_percent=self.hedge_budget_percent,
+                rate_limit=self.rate_limit,
+                rate_limit_requests_per_second=self.rate_limit_requests_per_second,
+                rate_limit_burst=self.rate_limit_burst,
+                rate_limit_tokens_per_minute=self.rate_limit_tokens_per_minute,
+                rate_limit_queue_size=self.rate_limit_queue_size,
+                rate_limit_max_wait_seconds=self.rate_limit_max_wait_seconds,
+                rate_limit_max_keys=self.rate_limit_max_keys,
+                fair_scheduler=self.fair_scheduler,
+                fair_scheduler_max_concurrency=self.fair_scheduler_max_concurrency,
+                fair_scheduler_quantum_tokens=self.fair_scheduler_quantum_tokens,
+                fair_scheduler_weights=self.fair_scheduler_weights,
+                adaptive_concurrency=self.adaptive_concurrency,
+                adaptive_concurrency_initial_limit=self.adaptive_concurrency_initial_limit,
+                adaptive_concurrency_min_limit=self.adaptive_concurrency_min_limit,
+                adaptive_concurrency_max_limit=self.adaptive_concurrency_max_limit,
+                adaptive_concurrency_backoff=self.adaptive_concurrency_backoff,
+                adaptive_concurrency_latency_tolerance=self.adaptive_concurrency_latency_tolerance,
+                adaptive_concurrency_latency_window=self.adaptive_concurrency_latency_window,
+                adaptive_concurrency_max_queue=self.adaptive_concurrency_max_queue,
+                stream_buffer=self.stream_buffer,
+                stream_buffer_max_bytes=self.stream_buffer_max_bytes,
+                stream_buffer_global_max_bytes=self.stream_buffer_global_max_bytes,
+                stream_buffer_policies=self.stream_buffer_policies,
                 precheck_api_key=self.precheck_api_key,
                 raise_4xx_when_blocked=self.raise_4xx_when_blocked,
                 dev_record_time=self.dev_record_time,
@@ -58,6 +188,56 @@ class Environment:
                 dev_show_incoming_message=self.dev_show_incoming_message,
                 debug_trace_response=self.debug_trace_response,
                 debug_append_test_info=self.debug_append_test_info,
+                client_pool_max_clients=self.client_pool_max_clients,
+                client_pool_idle_ttl_seconds=self.client_pool_idle_ttl_seconds,
+                upstream_max_connections=self.upstream_max_connections,
+                upstream_max_keepalive_connections=self.upstream_max_keepalive_connections,
+                upstream_keepalive_expiry_seconds=self.upstream_keepalive_expiry_seconds,
+                upstream_timeout_seconds=self.upstream_timeout_seconds,
+                first_chunk_timeout_seconds=self.first_chunk_timeout_seconds,
+                cancel_on_disconnect=self.cancel_on_disconnect,
+                delta_coalescing=self.delta_coalescing,
+                delta_coalescing_max_bytes=self.delta_coalescing_max_bytes,
+                delta_coalescing_max_delay_seconds=self.delta_coalescing_max_delay_seconds,
+                compression=self.compression,
+                compression_gzip_level=self.compression_gzip_level,
+                compression_zstd_level=self.compression_zstd_level,
+                compression_min_bytes=self.compression_min_bytes,
+                passthrough_same_protocol=self.passthrough_same_protocol,
+                compatibility_via_v2=self.compatibility_via_v2,
+                cohere_v1_via_v2=self.cohere_v1_via_v2,
+                response_cache=self.response_cache,
+                response_cache_max_entries=self.response_cache_max_entries,
+                response_cache_ttl_seconds=self.response_cache_ttl_seconds,
+                stream_cache=self.stream_cache,
+                stream_cache_max_entries=self.stream_cache_max_entries,
+                stream_cache_max_bytes=self.stream_cache_max_bytes,
+                stream_cache_ttl_seconds=self.stream_cache_ttl_seconds,
+                stream_cache_replay_timing=self.stream_cache_replay_timing,
+                single_flight=self.single_flight,
+                single_flight_queue_chunks=self.single_flight_queue_chunks,
+                single_flight_max_history_bytes=self.single_flight_max_history_bytes,
+                semantic_cache=self.semantic_cache,
+                semantic_cache_model=self.semantic_cache_model,
+                semantic_cache_threshold=self.semantic_cache_threshold,
+                semantic_cache_capacity=self.semantic_cache_capacity,
+                semantic_cache_dtype=self.semantic_cache_dtype,
+                semantic_cache_path=self.semantic_cache_path,
+                semantic_cache_snapshot_every=self.semantic_cache_snapshot_every,
+                disk_cache=self.disk_cache,
+                disk_cache_path=self.disk_cache_path,
+                disk_cache_max_bytes=self.disk_cache_max_bytes,
+                disk_cache_ttl_seconds=self.disk_cache_ttl_seconds,
+                disk_cache_index_slots=self.disk_cache_index_slots,
+                embedding_batching=self.embedding_batching,
+                embedding_batch_window_seconds=self.embedding_batch_window_seconds,
+                embedding_cache=self.embedding_cache,
+                embedding_cache_max_entries=self.embedding_cache_max_entries,
+                embedding_cache_max_bytes=self.embedding_cache_max_bytes,
+                embedding_cache_ttl_seconds=self.embedding_cache_ttl_seconds,
+                rerank_cache=self.rerank_cache,
+                rerank_cache_max_entries=self.rerank_cache_max_entries,
+                rerank_cache_ttl_seconds=self.rerank_cache_ttl_seconds,
             ).items()
             if value is not None and value != ""
         }
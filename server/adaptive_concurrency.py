@@ -0,0 +1,239 @@
+"""
+Adaptive (AIMD) concurrency limit of the calls to each upstream provider.
+
+Every call takes a slot; when all `limit` slots are taken, calls wait. After
+each call the limit is adjusted:
+
+- it is cut to `limit * ADAPTIVE_CONCURRENCY_BACKOFF` when the upstream answered
+  429/503/504/529 or timed out, or when the time to the first chunk of a stream
+  exceeded `ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE` times the minimum recently
+  observed (once per episode: calls started before the last cut do not cut
+  again). The duration of a non-stream call grows with the length of its
+  output, not only with the load of the upstream, so only overload errors cut
+  the limit for those;
+- otherwise it grows by one, as long as at least half of the slots were in use
+  (an idle limit says nothing about the capacity of the upstream).
+
+Calls waiting for a slot are bounded by `ADAPTIVE_CONCURRENCY_MAX_QUEUE`; beyond
+that they fail at once with `UpstreamUnavailableError`.
+"""
+
+from __future__ import annotations
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Literal, TypeVar
+import asyncio
+import time
+
+from resources.environment import Environment
+from server.common_service import close_iterator_quietly
+from server.errors import UpstreamUnavailableError
+from server.metrics import ProxyMetrics
+
+
+T = TypeVar('T')
+
+CallKind = Literal["stream", "non_stream"]
+
+_OVERLOAD_STATUS_CODES = (429, 503, 504, 529)
+
+
+def is_overload(exc: BaseException) -> bool:
+    """Whether an exception says the upstream is overloaded (rather than that the request is wrong)."""
+    if isinstance(exc, asyncio.TimeoutError) or 'timeout' in exc.__class__.__name__.lower():
+        return True
+    return getattr(exc, 'status_code', None) in _OVERLOAD_STATUS_CODES
+
+
+class Slot:
+    def __init__(self, limiter: AdaptiveConcurrencyLimiter, kind: CallKind):
+        self.limiter = limiter
+        self.kind = kind
+        self.started = time.monotonic()
+        self.latency: float | None = None
+        self.released = False
+
+    def first_item(self) -> None:
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started
+
+    def release(self, exc: BaseException | None = None) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.limiter._on_release(self, exc)
+
+
+class _LimitedIterator:
+    """Async iterator that takes a slot at its first item (unless given one) and gives it back at the end."""
+
+    def __init__(self, limiter: AdaptiveConcurrencyLimiter, iterator: AsyncIterator[T], slot: Slot | None):
+        self.limiter = limiter
+        self.iterator = iterator
+        self.slot = slot
+
+    def __aiter__(self) -> _LimitedIterator:
+        return self
+
+    async def __anext__(self) -> T:
+        if self.slot is None:
+            self.slot = await self.limiter.acquire("stream")
+        try:
+            item = await anext(self.iterator)
+        except StopAsyncIteration:
+            self.slot.release()
+            raise
+        except BaseException as exp:
+            self.slot.release(exp)
+            raise
+        self.slot.first_item()
+        return item
+
+    async def aclose(self) -> None:
+        if self.slot is not None:
+            self.slot.release()
+        await close_iterator_quietly(self.iterator)
+
+
+class AdaptiveConcurrencyLimiter:
+    instances: dict[str, AdaptiveConcurrencyLimiter] = {}
+
+    def __init__(
+        self,
+        name: str,
+        enabled: bool,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        backoff: float,
+        latency_tolerance: float,
+        latency_window: int,
+        max_queue: int,
+    ):
+        self.name = name
+        self.enabled = enabled
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        # Times to the first chunk of recent streams.
+        self.recent_latencies: deque[float] = deque(maxlen=latency_window)
+        self.last_decrease = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self.rejections = 0
+
+    @classmethod
+    def get_instance(cls, name: str) -> AdaptiveConcurrencyLimiter:
+        instance = cls.instances.get(name)
+        if instance is None:
+            env = Environment.get_instance()
+            instance = cls.instances[name] = cls(
+                name=name,
+                enabled=env.adaptive_concurrency,
+                initial_limit=env.adaptive_concurrency_initial_limit,
+                min_limit=env.adaptive_concurrency_min_limit,
+                max_limit=env.adaptive_concurrency_max_limit,
+                backoff=env.adaptive_concurrency_backoff,
+                latency_tolerance=env.adaptive_concurrency_latency_tolerance,
+                latency_window=env.adaptive_concurrency_latency_window,
+                max_queue=env.adaptive_concurrency_max_queue,
+            )
+            ProxyMetrics.get_instance().register_source(f'adaptive_concurrency_{name}', instance.stats)
+            instance._publish()
+        return instance
+
+    def _publish(self) -> None:
+        ProxyMetrics.get_instance().set_gauge('adaptive_concurrency_limit', int(self.limit), upstream=self.name)
+
+    def _wake(self) -> None:
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self, kind: CallKind) -> Slot:
+        if not self.enabled:
+            return Slot(self, kind)
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            return Slot(self, kind)
+        if len(self.waiters) >= self.max_queue:
+            self.rejections += 1
+            raise UpstreamUnavailableError(
+                f"Too many calls are waiting for {self.name}; the upstream is saturated.",
+                extra=dict(upstream=self.name, limit=int(self.limit)),
+                headers={"Retry-After": "1"},
+            )
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as the caller went away.
+                self.in_flight -= 1
+                self._wake()
+            else:
+                self.waiters.remove(waiter)
+            raise
+        return Slot(self, kind)
+
+    def _on_release(self, slot: Slot, exc: BaseException | None) -> None:
+        if not self.enabled:
+            return
+        utilization = self.in_flight / self.limit
+        self.in_flight -= 1
+        overloaded = exc is not None and is_overload(exc)
+        latencies = self.recent_latencies
+        slow = False
+        if slot.latency is not None:
+            slow = bool(latencies) and slot.latency > min(latencies) * self.latency_tolerance
+            latencies.append(slot.latency)
+        if overloaded or slow:
+            # Calls started before the last cut were sent under the old limit; one cut per episode.
+            if slot.started >= self.last_decrease:
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                self.last_decrease = time.monotonic()
+                self.decreases += 1
+                self._publish()
+        elif exc is None and utilization >= 0.5 and self.limit < self.max_limit:
+            self.limit = min(float(self.max_limit), self.limit + 1)
+            self.increases += 1
+            self._publish()
+        self._wake()
+
+    async def call(self, call: Callable[[], Awaitable[T]]) -> T:
+        slot = await self.acquire("non_stream")
+        try:
+            result = await call()
+        except BaseException as exp:
+            slot.release(exp)
+            raise
+        # No latency sample: a non-stream call lasts as long as its output does.
+        slot.release()
+        return result
+
+    def stream(self, iterator: AsyncIterator[T], slot: Slot | None = None) -> AsyncIterator[T]:
+        """Hold a slot while `iterator` is consumed; it is taken at the first item unless `slot` is given."""
+        if not self.enabled:
+            return iterator
+        return _LimitedIterator(self, iterator, slot)
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            enabled=self.enabled,
+            limit=int(self.limit),
+            in_flight=self.in_flight,
+            waiting=len(self.waiters),
+            min_stream_latency_ms=(
+                round(min(self.recent_latencies) * 1000, 1) if self.recent_latencies else None
+            ),
+            increases=self.increases,
+            decreases=self.decreases,
+            rejections=self.rejections,
+        )
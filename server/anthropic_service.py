@@ -0,0 +1,171 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, AsyncIterator, TypeVar
+from pydantic import BaseModel
+import anthropic
+from anthropic import AsyncAnthropic, APIStatusError
+from anthropic.types import Message, RawMessageStreamEvent
+from fastapi import HTTPException
+from server.func_utils import show_result
+from server.payloads_anthropic import (
+    AnthropicMessagesNonStreamingRequest,
+    AnthropicMessagesStreamingRequest,
+)
+from server.common_service import StreamingResponseHTTPExceptionDispatcher
+from server.delta_coalescing import TextDelta
+from server.json_utils import dumps_bytes
+from server.client_pool import UpstreamClientRegistry
+from server.adaptive_concurrency import AdaptiveConcurrencyLimiter
+from resources.environment import Environment
+from server.debug_utils import get_test_info_for_debug
+
+if TYPE_CHECKING:
+    from server.stream_cache import StreamRecorder
+
+
+E = TypeVar('E', bound=Exception)
+
+
+def to_http_exception(exc: APIStatusError) -> HTTPException:
+    """Map an Anthropic error to the status and message the upstream gave, before it reaches the client."""
+    error = exc.body.get('error') if isinstance(exc.body, dict) else None
+    message = error.get('message') if isinstance(error, dict) else None
+    return HTTPException(status_code=exc.status_code, detail=message or exc.message or 'An error occurred.')
+
+
+class StreamingResponseHTTPExceptionDispatcherForAnthropic(StreamingResponseHTTPExceptionDispatcher):
+    def __init__(
+        self,
+        response: AsyncIterator[BaseModel | dict[str, ...]],
+        exception_type_to_catch: type[E] = APIStatusError,
+        additional_strings: list[str] | None = None,
+        log_to_info: bool = False,
+        first_chunk_timeout: float | None = None,
+        recorder: StreamRecorder | None = None,
+    ):
+        super().__init__(
+            response=response,
+            exception_type_to_catch=exception_type_to_catch,
+            log_to_info=log_to_info,
+            additional_strings=additional_strings,
+            first_chunk_timeout=first_chunk_timeout,
+            recorder=recorder,
+        )
+        # Index the additional text block takes: after every block of the message.
+        self.next_block_index = 0
+
+    def _set_generation_id(self, piece: dict[str, ...]):
+        if piece.get('type') == 'message_start':
+            self.generation_id_in_stream_start = (piece.get('message') or {}).get('id') or ""
+
+    @staticmethod
+    def _stringify(a_dict: dict[str, ...]) -> bytes:
+        return b"event: " + str(a_dict.get("type")).encode() + b"\ndata: " + dumps_bytes(a_dict) + b"\n\n"
+
+    def _detect_finishing(self, piece: dict[str, ...]) -> bool:
+        piece_type = piece.get('type')
+        if piece_type == 'content_block_start':
+            self.next_block_index = max(self.next_block_index, piece.get('index', 0) + 1)
+        return piece_type in ('message_delta', 'message_stop')
+
+    def _create_intermediate_responses(self, texts: list[str]) -> list:
+        # Every content block is closed by now: the texts go into a text block of their own.
+        index = self.next_block_index
+        return [
+            dict(type='content_block_start', index=index, content_block=dict(type='text', text='')),
+            *(self._create_intermediate_response(text) for text in texts),
+            dict(type='content_block_stop', index=index),
+        ]
+
+    def _create_intermediate_response(self, text: str):
+        return dict(
+            type='content_block_delta',
+            index=self.next_block_index,
+            delta=dict(type='text_delta', text=text),
+        )
+
+    def _create_http_exception(self, e: APIStatusError) -> HTTPException:
+        return to_http_exception(e)
+
+    @staticmethod
+    def _text_delta(a_dict: dict[str, ...]) -> TextDelta | None:
+        if a_dict.get('type') != 'content_block_delta':
+            return None
+        delta = a_dict.get('delta') or {}
+        if delta.get('type') != 'text_delta' or not isinstance(delta.get('text'), str) or delta.keys() - {'type', 'text'}:
+            return None
+        return ('content_block_delta', a_dict.get('index')), delta, 'text'
+
+
+def _options(request: BaseModel) -> dict[str, Any]:
+    return request.model_dump(exclude_defaults=True, exclude_none=True, exclude_unset=True)
+
+
+async def anthropic_messages_stream(
+    request: AnthropicMessagesStreamingRequest,
+    api_key: str | None = None,
+    x_client_name: str | None = None,
+    accepts: str = "text/event-stream",
+    base_url: str | None = None,
+) -> tuple[AsyncIterator[RawMessageStreamEvent], dict | None]:
+
+    client: AsyncAnthropic = UpstreamClientRegistry.get_instance().get_client(
+        "anthropic", api_key=api_key, base_url=base_url,
+    )
+
+    opts = _options(request)
+    # The SDK sends the request here, so the slot is taken before and handed over to the stream.
+    limiter = AdaptiveConcurrencyLimiter.get_instance("anthropic")
+    slot = await limiter.acquire("stream")
+    try:
+        response_iterator = await client.messages.create(**opts)
+    except APIStatusError as exp:
+        slot.release(exp)
+        raise to_http_exception(exp) from exp
+    except BaseException as exp:
+        slot.release(exp)
+        raise
+    response_iterator = limiter.stream(response_iterator, slot=slot)
+
+    additional_info = (
+        get_test_info_for_debug()
+        if Environment.get_instance().debug_append_test_info else
+        None
+    )
+    return response_iterator, additional_info
+
+
+@show_result
+async def anthropic_messages_non_stream(
+    request: AnthropicMessagesNonStreamingRequest,
+    api_key: str | None = None,
+    x_client_name: str | None = None,
+    accepts: str = "application/json",
+    base_url: str | None = None,
+) -> tuple[Message, dict | None]:
+
+    client: AsyncAnthropic = UpstreamClientRegistry.get_instance().get_client(
+        "anthropic", api_key=api_key, base_url=base_url,
+    )
+
+    opts = _options(request)
+    try:
+        response = await AdaptiveConcurrencyLimiter.get_instance("anthropic").call(
+            lambda: client.messages.create(**opts)
+        )
+    except APIStatusError as exp:
+        raise to_http_exception(exp) from exp
+    additional_info = (
+        get_test_info_for_debug()
+        if Environment.get_instance().debug_append_test_info else
+        None
+    )
+    return response, additional_info
+
+
+def append_text(response: Message, text: str) -> None:
+    """Append `text` to the last text block of a message, or as a new text block when it has none."""
+    for block in reversed(response.content):
+        if block.type == 'text':
+            block.text += text
+            return
+    response.content.append(anthropic.types.TextBlock(type='text', text=text))
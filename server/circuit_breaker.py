@@ -0,0 +1,194 @@
+"""
+Circuit breaker of one upstream endpoint.
+
+The outcomes of the recent calls (within `CIRCUIT_BREAKER_WINDOW_SECONDS`) are
+kept in a sliding window. Once it holds enough calls and too many of them
+failed or were slow, the circuit opens: the load balancer stops sending
+requests to the endpoint, and when no endpoint of a provider is left the
+request fails at once with `UpstreamUnavailableError` instead of waiting for
+the SDK's timeouts and retries. After `CIRCUIT_BREAKER_OPEN_SECONDS` the
+circuit is half-open and lets a limited number of probe requests through;
+it closes when they all succeed and opens again on the first failure.
+"""
+
+from __future__ import annotations
+from collections import deque
+from typing import Any, Literal
+import asyncio
+import logging
+import sys
+import time
+
+from resources.environment import Environment
+from server.metrics import ProxyMetrics
+
+
+CircuitState = Literal["closed", "open", "half_open"]
+
+_STATE_GAUGE_VALUES: dict[CircuitState, int] = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class CircuitBreakerLogger(logging.Logger):
+    instance: CircuitBreakerLogger | None = None
+
+    def __init__(self):
+        super().__init__(__name__, level=logging.INFO)
+        logging.basicConfig(
+            stream=sys.stdout,
+            level=logging.INFO,
+        )
+
+    @classmethod
+    def get_instance(cls) -> CircuitBreakerLogger:
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    """Whether an exception says something about the health of the upstream.
+
+    Rejections of the request itself (4xx other than 408 and 429) and
+    cancellations by the client do not count against the endpoint.
+    """
+    if isinstance(exc, (asyncio.CancelledError, GeneratorExit)) or not isinstance(exc, Exception):
+        return False
+    status_code = getattr(exc, 'status_code', None)
+    if isinstance(status_code, int) and 400 <= status_code < 500 and status_code not in (408, 429):
+        return False
+    return True
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        upstream: str,
+        endpoint: str,
+        enabled: bool,
+        window_seconds: float,
+        min_calls: int,
+        failure_rate: float,
+        slow_call_seconds: float,
+        slow_call_rate: float,
+        open_seconds: float,
+        half_open_probes: int,
+    ):
+        self.upstream = upstream
+        self.endpoint = endpoint
+        self.enabled = enabled
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state: CircuitState = "closed"
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.probes_succeeded = 0
+        # (finished at, failed, slow)
+        self.window: deque[tuple[float, bool, bool]] = deque()
+        self.failures = 0
+        self.slow_calls = 0
+
+    @classmethod
+    def from_environment(cls, upstream: str, endpoint: str) -> CircuitBreaker:
+        env = Environment.get_instance()
+        return cls(
+            upstream=upstream,
+            endpoint=endpoint,
+            enabled=env.circuit_breaker,
+            window_seconds=env.circuit_breaker_window_seconds,
+            min_calls=env.circuit_breaker_min_calls,
+            failure_rate=env.circuit_breaker_failure_rate,
+            slow_call_seconds=env.circuit_breaker_slow_call_seconds,
+            slow_call_rate=env.circuit_breaker_slow_call_rate,
+            open_seconds=env.circuit_breaker_open_seconds,
+            half_open_probes=env.circuit_breaker_half_open_probes,
+        )
+
+    def _transition(self, state: CircuitState, reason: str) -> None:
+        previous, self.state = self.state, state
+        if state == "open":
+            self.opened_at = time.monotonic()
+        if state != "closed":
+            self.probes_in_flight = 0
+            self.probes_succeeded = 0
+        self.window.clear()
+        self.failures = self.slow_calls = 0
+        CircuitBreakerLogger.get_instance().warning(
+            f"Circuit of {self.upstream} endpoint {self.endpoint}: {previous} -> {state} ({reason})"
+        )
+        metrics = ProxyMetrics.get_instance()
+        metrics.increment('circuit_breaker_transitions', upstream=self.upstream, endpoint=self.endpoint, state=state)
+        metrics.set_gauge(
+            'circuit_breaker_state', _STATE_GAUGE_VALUES[state], upstream=self.upstream, endpoint=self.endpoint,
+        )
+
+    def _current_state(self) -> CircuitState:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.open_seconds:
+            self._transition("half_open", f"{self.open_seconds:g}s elapsed")
+        return self.state
+
+    def is_available(self) -> bool:
+        """Whether a call may go to the endpoint now; does not claim anything."""
+        if not self.enabled:
+            return True
+        state = self._current_state()
+        if state == "half_open":
+            return self.probes_in_flight + self.probes_succeeded < self.half_open_probes
+        return state == "closed"
+
+    def on_start(self) -> bool:
+        """Register a call picked for the endpoint; returns whether it is a half-open probe."""
+        if self.enabled and self._current_state() == "half_open":
+            self.probes_in_flight += 1
+            return True
+        return False
+
+    def on_finish(self, probe: bool, failed: bool, latency: float | None) -> None:
+        if not self.enabled:
+            return
+        slow = latency is not None and latency >= self.slow_call_seconds
+        if probe:
+            if self.state != "half_open":
+                return
+            self.probes_in_flight -= 1
+            if failed or slow:
+                self._transition("open", "half-open probe " + ("failed" if failed else f"took {latency:.1f}s"))
+                return
+            self.probes_succeeded += 1
+            if self.probes_succeeded >= self.half_open_probes:
+                self._transition("closed", f"{self.probes_succeeded} probe(s) succeeded")
+            return
+        if self.state != "closed":
+            return
+        now = time.monotonic()
+        self.window.append((now, failed, slow))
+        self.failures += failed
+        self.slow_calls += slow
+        while self.window and now - self.window[0][0] > self.window_seconds:
+            _, old_failed, old_slow = self.window.popleft()
+            self.failures -= old_failed
+            self.slow_calls -= old_slow
+        calls = len(self.window)
+        if calls < self.min_calls:
+            return
+        if self.failures / calls >= self.failure_rate:
+            self._transition("open", f"{self.failures}/{calls} calls failed")
+        elif self.slow_calls / calls >= self.slow_call_rate:
+            self._transition("open", f"{self.slow_calls}/{calls} calls slower than {self.slow_call_seconds:g}s")
+
+    def retry_after(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - self.opened_at))
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            state=self._current_state() if self.enabled else "disabled",
+            window_calls=len(self.window),
+            window_failures=self.failures,
+            window_slow_calls=self.slow_calls,
+        )
@@ -0,0 +1,197 @@
+"""
+Process-wide registry of upstream SDK clients sharing keep-alive connection pools.
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Literal, TypeAlias
+import time
+
+import anthropic
+import cohere
+import httpx
+from openai import AsyncOpenAI
+
+from resources.environment import Environment
+from server.generic_service import fingerprint_api_key
+from server.metrics import ProxyMetrics
+
+
+Provider: TypeAlias = Literal["cohere_v1", "cohere_v2", "openai", "anthropic"]
+
+DEFAULT_BASE_URL: dict[str, str] = {
+    "cohere_v1": "https://api.cohere.com/",
+    "cohere_v2": "https://api.cohere.com/",
+    "openai": "https://api.openai.com/v1/",
+    "anthropic": "https://api.anthropic.com/",
+}
+
+ClientKey: TypeAlias = tuple[str, str, str, str | None, str | None]
+
+
+@dataclass
+class PooledClient:
+    client: Any
+    origin: str
+    last_used: float = field(default_factory=time.monotonic)
+
+
+def _origin_of(base_url: str) -> str:
+    url = httpx.URL(base_url)
+    return f'{url.scheme}://{url.netloc.decode("ascii")}'
+
+
+class UpstreamClientRegistry:
+    """LRU/idle-TTL cache of SDK clients keyed by provider, base URL, API-key fingerprint,
+    organization and project.
+
+    SDK clients are cheap wrappers; the expensive part is the httpx connection pool,
+    which is shared by every client talking to the same origin and kept alive for
+    the lifetime of the process.
+    """
+    instance: UpstreamClientRegistry | None = None
+
+    def __init__(
+        self,
+        max_clients: int,
+        idle_ttl_seconds: float,
+        limits: httpx.Limits,
+        timeout: httpx.Timeout,
+    ):
+        self.max_clients = max_clients
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.limits = limits
+        self.timeout = timeout
+        self._clients: OrderedDict[ClientKey, PooledClient] = OrderedDict()
+        self._http_clients: dict[str, httpx.AsyncClient] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._factories: dict[str, Callable[..., Any]] = {
+            "cohere_v1": self._create_cohere_v1_client,
+            "cohere_v2": self._create_cohere_v2_client,
+            "openai": self._create_openai_client,
+            "anthropic": self._create_anthropic_client,
+        }
+
+    @classmethod
+    def get_instance(cls) -> UpstreamClientRegistry:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                max_clients=env.client_pool_max_clients,
+                idle_ttl_seconds=env.client_pool_idle_ttl_seconds,
+                limits=httpx.Limits(
+                    max_connections=env.upstream_max_connections,
+                    max_keepalive_connections=env.upstream_max_keepalive_connections,
+                    keepalive_expiry=env.upstream_keepalive_expiry_seconds,
+                ),
+                timeout=httpx.Timeout(env.upstream_timeout_seconds, connect=10.0),
+            )
+            ProxyMetrics.get_instance().register_source('upstream_clients', cls.instance.stats)
+        return cls.instance
+
+    def get_client(
+        self,
+        provider: Provider,
+        api_key: str | None,
+        base_url: str | None = None,
+        organization: str | None = None,
+        project: str | None = None,
+    ) -> Any:
+        resolved_base_url = base_url or DEFAULT_BASE_URL[provider]
+        key: ClientKey = (provider, resolved_base_url, fingerprint_api_key(api_key), organization, project)
+        now = time.monotonic()
+        self._evict_idle(now)
+        pooled = self._clients.get(key)
+        if pooled is not None:
+            self.hits += 1
+            pooled.last_used = now
+            self._clients.move_to_end(key)
+            return pooled.client
+
+        self.misses += 1
+        origin = _origin_of(resolved_base_url)
+        client = self._factories[provider](
+            api_key=api_key,
+            base_url=base_url,
+            organization=organization,
+            project=project,
+            http_client=self.get_http_client(origin),
+        )
+        self._clients[key] = PooledClient(client=client, origin=origin, last_used=now)
+        while len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)
+            self.evictions += 1
+        return client
+
+    def get_http_client(self, origin: str) -> httpx.AsyncClient:
+        http_client = self._http_clients.get(origin)
+        if http_client is None:
+            http_client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=self.timeout,
+                follow_redirects=True,
+            )
+            self._http_clients[origin] = http_client
+        return http_client
+
+    def get_http_client_for_url(self, url: str) -> httpx.AsyncClient:
+        """Return the shared httpx client for the origin of `url`, for callers bypassing the SDKs."""
+        return self.get_http_client(_origin_of(url))
+
+    def _evict_idle(self, now: float) -> None:
+        while self._clients:
+            key, pooled = next(iter(self._clients.items()))
+            if now - pooled.last_used < self.idle_ttl_seconds:
+                break
+            del self._clients[key]
+            self.evictions += 1
+
+    async def aclose(self) -> None:
+        self._clients.clear()
+        http_clients = list(self._http_clients.values())
+        self._http_clients.clear()
+        for http_client in http_clients:
+            await http_client.aclose()
+
+    def stats(self) -> dict[str, Any]:
+        connections: dict[str, dict[str, int]] = {}
+        for origin, http_client in self._http_clients.items():
+            pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+            opened = list(getattr(pool, 'connections', []) or [])
+            connections[origin] = dict(
+                open=len(opened),
+                idle=sum(1 for connection in opened if connection.is_idle()),
+            )
+        return dict(
+            pooled_clients=len(self._clients),
+            max_clients=self.max_clients,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            connections=connections,
+        )
+
+    @staticmethod
+    def _create_cohere_v1_client(api_key, base_url, organization, project, http_client):
+        return cohere.AsyncClient(api_key=api_key, base_url=base_url, httpx_client=http_client)
+
+    @staticmethod
+    def _create_cohere_v2_client(api_key, base_url, organization, project, http_client):
+        return cohere.AsyncClientV2(api_key=api_key, base_url=base_url, httpx_client=http_client)
+
+    @staticmethod
+    def _create_openai_client(api_key, base_url, organization, project, http_client):
+        return AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            organization=organization,
+            project=project,
+            http_client=http_client,
+        )
+
+    @staticmethod
+    def _create_anthropic_client(api_key, base_url, organization, project, http_client):
+        return anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url, http_client=http_client)
@@ -1,7 +1,7 @@
 from __future__ import annotations
-from typing import Iterator, Literal, Iterable, Callable, TypeVar, Collection
+from typing import TYPE_CHECKING, AsyncIterator, Iterator, Literal, Iterable, Callable, TypeVar, Collection
 from fastapi import HTTPException
-from server.payloads_cohere import CohereChatV1StreamRequest, CohereChatV1NonStreamRequest, CohereChatV2Request
+from server.payloads_cohere import CohereChatV1StreamRequest, CohereChatV1NonStreamRequest, CohereChatV2Request, CohereChatV2NonStreamRequest, CohereEmbedV2Request, CohereRerankV2Request
 from pydantic import BaseModel
 
 import cohere
@@ -28,10 +28,17 @@ from logging import Logger
 from server.payloads_openai import openai_spec
 from server.generic_service import create_generation_id
 from server.common_service import StreamingResponseHTTPExceptionDispatcher
+from server.delta_coalescing import TextDelta
+from server.json_utils import dumps_bytes
+from server.client_pool import UpstreamClientRegistry
+from server.adaptive_concurrency import AdaptiveConcurrencyLimiter
 from server.openai_service import StreamingResponseHTTPExceptionDispatcherForOpenAI
 from resources.environment import Environment
 from server.debug_utils import get_test_info_for_debug
 
+if TYPE_CHECKING:
+    from server.stream_cache import StreamRecorder
+
 
 T = TypeVar('T')
 E = TypeVar('E', bound=Exception)
@@ -40,17 +47,21 @@ E = TypeVar('E', bound=Exception)
 class StreamingResponseHTTPExceptionDispatcherForCohere(StreamingResponseHTTPExceptionDispatcher):
     def __init__(
         self,
-        response: Iterator[BaseModel | dict[str, ...]],
+        response: AsyncIterator[BaseModel | dict[str, ...]],
         api_version: Literal["v1", "v2", "openai"],
         exception_type_to_catch: type[E] = ApiError,
         additional_strings: list[str] | None = None,
         log_to_info: bool = False,
+        first_chunk_timeout: float | None = None,
+        recorder: StreamRecorder | None = None,
     ):
         super().__init__(
             response=response,
             exception_type_to_catch=exception_type_to_catch,
             log_to_info=log_to_info,
             additional_strings=additional_strings,
+            first_chunk_timeout=first_chunk_timeout,
+            recorder=recorder,
         )
         api_versions = ("v1", "v2", "openai")
         if api_version not in api_versions:
@@ -81,15 +92,20 @@ class StreamingResponseHTTPExceptionDispatcherForCohere(StreamingResponseHTTPExc
             self._create_intermediate_response_v1 if api_version == "v1" else
             self._create_intermediate_response_v2 if api_version == "v2" else
             lambda text: StreamingResponseHTTPExceptionDispatcherForOpenAI._create_intermediate_response(
-                text=text
+                self=self, text=text
             )
         )
+        self._text_delta_proper = (
+            self._text_delta_v1 if api_version == "v1" else
+            self._text_delta_v2 if api_version == "v2" else
+            StreamingResponseHTTPExceptionDispatcherForOpenAI._text_delta
+        )
 
-    def _stringify(self, a_dict: dict[str, ...]) -> str:
+    def _stringify(self, a_dict: dict[str, ...]) -> bytes:
         return self._stringify_proper(a_dict)
 
-    def _set_generation_id(self, piece: ...):
-        if self.generation_id_in_stream_start is None:
+    def _set_generation_id(self, piece: dict[str, ...]):
+        if self.generation_id_in_stream_start is not None:
             return
         return self._set_generation_id_proper(piece)
 
@@ -99,21 +115,24 @@ class StreamingResponseHTTPExceptionDispatcherForCohere(StreamingResponseHTTPExc
     def _create_intermediate_response(self, piece: str):
         return self._create_intermediate_response_proper(piece)
 
-    def _set_generation_id_for_v1(self, piece: StreamedChatResponse):
-        if piece.event_type == 'stream-start':
-            self.generation_id_in_stream_start = piece.generation_id or ""
+    def _text_delta(self, piece: dict[str, ...]) -> TextDelta | None:
+        return self._text_delta_proper(piece)
 
-    def _set_generation_id_for_v2(self, piece: StreamedChatResponseV2):
-        if piece.type == 'message-start':
-            self.generation_id_in_stream_start = piece.id or ""
+    def _set_generation_id_for_v1(self, piece: dict[str, ...]):
+        if piece.get('event_type') == 'stream-start':
+            self.generation_id_in_stream_start = piece.get('generation_id') or ""
+
+    def _set_generation_id_for_v2(self, piece: dict[str, ...]):
+        if piece.get('type') == 'message-start':
+            self.generation_id_in_stream_start = piece.get('id') or ""
 
     @staticmethod
-    def _stringify_v1(a_dict: dict[str, ...]) -> str:
-        return f"{json.dumps(a_dict)}\n"
+    def _stringify_v1(a_dict: dict[str, ...]) -> bytes:
+        return dumps_bytes(a_dict) + b"\n"
 
     @staticmethod
-    def _stringify_v2(a_dict: dict[str, ...]) -> str:
-        return f'event: {a_dict.get("type")}\ndata: {json.dumps(a_dict)}\n\n'
+    def _stringify_v2(a_dict: dict[str, ...]) -> bytes:
+        return b"event: " + str(a_dict.get("type")).encode() + b"\ndata: " + dumps_bytes(a_dict) + b"\n\n"
 
     @staticmethod
     def _detect_finishing_v1(a_dict: dict[str, ...]) -> bool:
@@ -127,6 +146,24 @@ class StreamingResponseHTTPExceptionDispatcherForCohere(StreamingResponseHTTPExc
             return True
         return False
 
+    @staticmethod
+    def _text_delta_v1(a_dict: dict[str, ...]) -> TextDelta | None:
+        if a_dict.get('event_type') != 'text-generation' or not isinstance(a_dict.get('text'), str):
+            return None
+        if a_dict.keys() - {'event_type', 'text'}:
+            return None
+        return 'text-generation', a_dict, 'text'
+
+    @staticmethod
+    def _text_delta_v2(a_dict: dict[str, ...]) -> TextDelta | None:
+        if a_dict.get('type') != 'content-delta' or a_dict.get('logprobs') is not None:
+            return None
+        message = (a_dict.get('delta') or {}).get('message') or {}
+        content = message.get('content') or {}
+        if message.keys() - {'content'} or not isinstance(content.get('text'), str):
+            return None
+        return ('content-delta', a_dict.get('index')), content, 'text'
+
     @staticmethod
     def _create_intermediate_response_v1(text: str) :
         return TextGenerationStreamedChatResponse(
@@ -388,21 +425,24 @@ def omit_none_values(param: BaseModel, keys_to_exclude: Collection[str] | None =
 
 # Cohere V1 Chat API Spec
 # https://docs.cohere.com/v1/reference/chat
-def cohere_chat_v1_stream(
+async def cohere_chat_v1_stream(
     request: CohereChatV1StreamRequest,
     api_key: str | None = None,
     x_client_name: str | None = None,
     accepts: str = "text/event-stream",
-) -> tuple[Iterator[StreamedChatResponse], dict | None]:
+    base_url: str | None = None,
+) -> tuple[AsyncIterator[StreamedChatResponse], dict | None]:
 
-    client = cohere.Client(api_key=api_key, base_url=Environment.get_instance().cohere_url)
+    client: cohere.AsyncClient = UpstreamClientRegistry.get_instance().get_client(
+        "cohere_v1", api_key=api_key, base_url=base_url or Environment.get_instance().cohere_url,
+    )
 
     additional_args = {}
     if 'response_format' in request.model_dump(exclude_unset=True):
         additional_args['response_format'] = request.response_format
 
     # StreamedChatResponseのイテレータを生成
-    response_iterator: Iterator[StreamedChatResponse] = client.chat_stream(
+    response_iterator: AsyncIterator[StreamedChatResponse] = client.chat_stream(
         model=request.model or "command-a-plus",
         message=request.message,
         chat_history=request.chat_history or OMIT,
@@ -430,6 +470,7 @@ def cohere_chat_v1_stream(
         **additional_args,
         safety_mode=request.safety_mode or OMIT, 
     )
+    response_iterator = AdaptiveConcurrencyLimiter.get_instance("cohere").stream(response_iterator)
     
     additional_info = (
         get_test_info_for_debug()
@@ -439,13 +480,16 @@ def cohere_chat_v1_stream(
     return response_iterator, additional_info
     
 
-def cohere_chat_v1_non_stream(
+async def cohere_chat_v1_non_stream(
     request: CohereChatV1NonStreamRequest,
     api_key: str | None = None,
     x_client_name: str | None = None,
     accepts: str = "application/json",
+    base_url: str | None = None,
 ) -> tuple[cohere.NonStreamedChatResponse, dict | None]:
-    client = cohere.Client(api_key=api_key, base_url=Environment.get_instance().cohere_url)
+    client: cohere.AsyncClient = UpstreamClientRegistry.get_instance().get_client(
+        "cohere_v1", api_key=api_key, base_url=base_url or Environment.get_instance().cohere_url,
+    )
     if isinstance(request, CohereChatV1StreamRequest):
         request = CohereChatV1NonStreamRequest.model_validate(
             request.model_dump(exclude_unset=True, exclude_defaults=True),
@@ -458,35 +502,37 @@ def cohere_chat_v1_non_stream(
         additional_args['response_format'] = request.response_format
 
     try:
-        response: cohere.NonStreamedChatResponse = client.chat(
-            message=request.message,
-            accepts=accepts or request.accepts or None,
-            model=request.model or OMIT,
-            preamble=request.preamble or OMIT,
-            chat_history=request.chat_history or OMIT,
-            conversation_id=request.conversation_id or OMIT,
-            prompt_truncation=request.prompt_truncation or OMIT,
-            connectors=request.connectors or OMIT,
-            search_queries_only=request.search_queries_only or OMIT,
-            documents=request.documents or OMIT,
-            citation_quality=request.citation_quality or OMIT,
-            temperature=request.temperature or OMIT,
-            max_tokens=request.max_tokens or OMIT,
-            max_input_tokens=request.max_input_tokens or OMIT,
-            k=request.k or OMIT,
-            p=request.p or OMIT,
-            seed=request.seed or OMIT,
-            stop_sequences=request.stop_sequences or OMIT,
-            frequency_penalty=request.frequency_penalty or OMIT,
-            presence_penalty=request.presence_penalty or OMIT,
-            raw_prompting=request.raw_prompting or OMIT,
-            tools=request.tools or OMIT,
-            tool_results=request.tool_results or OMIT,
-            force_single_step=request.force_single_step or OMIT,
-            # response_format=request.response_format or OMIT,
-            **additional_args,
-            safety_mode=request.safety_mode or OMIT,
-            request_options=request.request_options or None,
+        response: cohere.NonStreamedChatResponse = await AdaptiveConcurrencyLimiter.get_instance("cohere").call(
+            lambda: client.chat(
+                message=request.message,
+                accepts=accepts or request.accepts or None,
+                model=request.model or OMIT,
+                preamble=request.preamble or OMIT,
+                chat_history=request.chat_history or OMIT,
+                conversation_id=request.conversation_id or OMIT,
+                prompt_truncation=request.prompt_truncation or OMIT,
+                connectors=request.connectors or OMIT,
+                search_queries_only=request.search_queries_only or OMIT,
+                documents=request.documents or OMIT,
+                citation_quality=request.citation_quality or OMIT,
+                temperature=request.temperature or OMIT,
+                max_tokens=request.max_tokens or OMIT,
+                max_input_tokens=request.max_input_tokens or OMIT,
+                k=request.k or OMIT,
+                p=request.p or OMIT,
+                seed=request.seed or OMIT,
+                stop_sequences=request.stop_sequences or OMIT,
+                frequency_penalty=request.frequency_penalty or OMIT,
+                presence_penalty=request.presence_penalty or OMIT,
+                raw_prompting=request.raw_prompting or OMIT,
+                tools=request.tools or OMIT,
+                tool_results=request.tool_results or OMIT,
+                force_single_step=request.force_single_step or OMIT,
+                # response_format=request.response_format or OMIT,
+                **additional_args,
+                safety_mode=request.safety_mode or OMIT,
+                request_options=request.request_options or None,
+            )
         )
     except Exception as exp:
         print(str(exp))
@@ -500,12 +546,13 @@ def cohere_chat_v1_non_stream(
     return response, additional_info
 
 
-def cohere_chat_v2_stream(
-    request: CohereChatV2Request,
+async def cohere_chat_v2_stream(
+    request: CohereChatV2Request | CohereChatV2NonStreamRequest,
     api_key: str | None = None,
     x_client_name: str | None = None,
     accepts: str = "text/event-stream",
-) -> tuple[Iterator[V2ChatStreamResponse], dict | None]:
+    base_url: str | None = None,
+) -> tuple[AsyncIterator[V2ChatStreamResponse], dict | None]:
 
     message: str | None = None
     if len(request.messages) > 0 and isinstance(request.messages[-1], dict):
@@ -518,10 +565,14 @@ def cohere_chat_v2_stream(
                 if hasattr(item, 'text') and hasattr(item, 'type') and item.type == 'text'
             )
 
-    client = cohere.ClientV2(api_key=api_key, base_url=Environment.get_instance().cohere_url)
+    client: cohere.AsyncClientV2 = UpstreamClientRegistry.get_instance().get_client(
+        "cohere_v2", api_key=api_key, base_url=base_url or Environment.get_instance().cohere_url,
+    )
 
-    response_iterator: Iterator[StreamedChatResponse] = client.chat_stream(
-        **omit_none_values(request, keys_to_exclude=('stream',))
+    response_iterator: AsyncIterator[V2ChatStreamResponse] = AdaptiveConcurrencyLimiter.get_instance("cohere").stream(
+        client.chat_stream(
+            **omit_none_values(request, keys_to_exclude=('stream',))
+        )
     )
     additional_info = (
         get_test_info_for_debug()
@@ -531,17 +582,22 @@ def cohere_chat_v2_stream(
     return response_iterator, additional_info
 
 
-def cohere_chat_v2_non_stream(
-    request: CohereChatV2Request,
+async def cohere_chat_v2_non_stream(
+    request: CohereChatV2Request | CohereChatV2NonStreamRequest,
     api_key: str | None = None,
     x_client_name: str | None = None,
     accepts: str = "application/json",
+    base_url: str | None = None,
 ) -> tuple[cohere.V2ChatResponse, dict | None]:
 
-    client = cohere.ClientV2(api_key=api_key, base_url=Environment.get_instance().cohere_url)
+    client: cohere.AsyncClientV2 = UpstreamClientRegistry.get_instance().get_client(
+        "cohere_v2", api_key=api_key, base_url=base_url or Environment.get_instance().cohere_url,
+    )
 
-    response: cohere.V2ChatResponse = client.chat(
-        **omit_none_values(request, keys_to_exclude=('stream',))
+    response: cohere.V2ChatResponse = await AdaptiveConcurrencyLimiter.get_instance("cohere").call(
+        lambda: client.chat(
+            **omit_none_values(request, keys_to_exclude=('stream',))
+        )
     )
     additional_info = (
         get_test_info_for_debug()
@@ -549,3 +605,37 @@ def cohere_chat_v2_non_stream(
         None
     )
     return response, additional_info
+
+
+# Cohere V2 Embed API Spec
+# https://docs.cohere.com/v2/reference/embed
+async def cohere_embed_v2(
+    request: CohereEmbedV2Request,
+    api_key: str | None = None,
+    base_url: str | None = None,
+) -> cohere.EmbedByTypeResponse:
+
+    client: cohere.AsyncClientV2 = UpstreamClientRegistry.get_instance().get_client(
+        "cohere_v2", api_key=api_key, base_url=base_url or Environment.get_instance().cohere_url,
+    )
+
+    return await AdaptiveConcurrencyLimiter.get_instance("cohere").call(
+        lambda: client.embed(**omit_none_values(request))
+    )
+
+
+# Cohere V2 Rerank API Spec
+# https://docs.cohere.com/v2/reference/rerank
+async def cohere_rerank_v2(
+    request: CohereRerankV2Request,
+    api_key: str | None = None,
+    base_url: str | None = None,
+) -> cohere.V2RerankResponse:
+
+    client: cohere.AsyncClientV2 = UpstreamClientRegistry.get_instance().get_client(
+        "cohere_v2", api_key=api_key, base_url=base_url or Environment.get_instance().cohere_url,
+    )
+
+    return await AdaptiveConcurrencyLimiter.get_instance("cohere").call(
+        lambda: client.rerank(**omit_none_values(request))
+    )
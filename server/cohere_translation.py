@@ -0,0 +1,573 @@
+"""
+Translation of OpenAI and Cohere v1 chat requests into native Cohere v2 chat calls.
+
+`/compatibility/v1/chat/completions` normally forwards OpenAI-format requests
+to Cohere's own compatibility endpoint. With `COMPATIBILITY_VIA_V2`, the proxy
+translates them itself: the request becomes a v2 `chat`/`chat_stream` call on
+the pooled v2 clients, and every v2 stream event is turned into its
+`chat.completion.chunk` as soon as it arrives (`content-delta` into content,
+`tool-call-start`/`tool-call-delta` into tool call deltas, `message-end` into
+the finish reason and, when asked for, the usage).
+
+With `COHERE_V1_VIA_V2`, `/v1/chat` requests (`message`, `chat_history`,
+`preamble`, ...) are rewritten the same way, and the v2 stream is re-emitted as
+v1 NDJSON events (`stream-start`, `text-generation`, ..., `stream-end`).
+Requests using what v2 has no equivalent for (connectors, search queries only,
+conversation ids, raw prompting, prompt truncation) or no model keep going to
+the v1 API.
+"""
+
+from __future__ import annotations
+from typing import Any, AsyncIterator
+import hashlib
+import json
+import time
+
+import cohere
+from openai.types.chat import ChatCompletion
+from pydantic import BaseModel
+
+from server.cohere_service import cohere_chat_v2_stream, cohere_chat_v2_non_stream
+from server.common_service import close_iterator_quietly
+from server.errors import BadRequestError
+from server.json_utils import to_dict
+from server.payloads_cohere import CohereChatV1NonStreamRequest, CohereChatV1StreamRequest, CohereChatV2NonStreamRequest
+from server.payloads_openai import OpenAIChatNonStreamingRequest, OpenAIChatStreamingRequest
+
+
+_FINISH_REASONS = {
+    "COMPLETE": "stop",
+    "STOP_SEQUENCE": "stop",
+    "MAX_TOKENS": "length",
+    "TOOL_CALL": "tool_calls",
+}
+
+_TOOL_CHOICES = {
+    "none": "NONE",
+    "required": "REQUIRED",
+}
+
+
+def _finish_reason(finish_reason: str | None) -> str:
+    return _FINISH_REASONS.get(finish_reason or "COMPLETE", "stop")
+
+
+def _content(content: Any) -> str | list[dict[str, Any]]:
+    if content is None or isinstance(content, str):
+        return content or ""
+    parts: list[dict[str, Any]] = []
+    for part in content:
+        if part.get("type") == "text":
+            parts.append(dict(type="text", text=part["text"]))
+        elif part.get("type") == "image_url":
+            parts.append(dict(type="image_url", image_url=part["image_url"]))
+        else:
+            raise BadRequestError(f"Unsupported content part type for Cohere: {part.get('type')}")
+    return parts
+
+
+def _message(message: dict[str, Any]) -> dict[str, Any]:
+    role = message.get("role")
+    if role in ("system", "developer"):
+        return dict(role="system", content=_content(message.get("content")))
+    if role == "user":
+        return dict(role="user", content=_content(message.get("content")))
+    if role == "assistant":
+        converted: dict[str, Any] = dict(role="assistant")
+        if message.get("content"):
+            converted["content"] = _content(message["content"])
+        if message.get("tool_calls"):
+            converted["tool_calls"] = [
+                dict(
+                    id=tool_call["id"],
+                    type="function",
+                    function=dict(
+                        name=tool_call["function"]["name"],
+                        arguments=tool_call["function"].get("arguments") or "{}",
+                    ),
+                )
+                for tool_call in message["tool_calls"]
+            ]
+        return converted
+    if role == "tool":
+        return dict(role="tool", tool_call_id=message["tool_call_id"], content=_content(message.get("content")))
+    raise BadRequestError(f"Unsupported message role for Cohere: {role}")
+
+
+def _response_format(response_format: dict[str, Any] | None) -> dict[str, Any] | None:
+    if not response_format or response_format.get("type") == "text":
+        return None
+    if response_format.get("type") == "json_schema":
+        return dict(type="json_object", json_schema=(response_format.get("json_schema") or {}).get("schema"))
+    return dict(type="json_object")
+
+
+def to_cohere_v2_request(
+    request: OpenAIChatNonStreamingRequest | OpenAIChatStreamingRequest,
+) -> CohereChatV2NonStreamRequest:
+    if (request.n or 1) > 1:
+        raise BadRequestError("Cohere does not support n > 1.")
+    tools = [dict(tool) for tool in request.tools or []]
+    tool_choice = request.tool_choice
+    if isinstance(tool_choice, dict):
+        # A named function: only that tool is offered, and it must be called.
+        name = tool_choice.get("function", {}).get("name")
+        tools = [tool for tool in tools if tool.get("function", {}).get("name") == name]
+        tool_choice = "required"
+    stop = request.stop
+    return CohereChatV2NonStreamRequest(
+        model=request.model,
+        messages=[_message(message) for message in request.messages],
+        tools=tools or None,
+        strict_tools=any(tool.get("function", {}).get("strict") for tool in tools) or None,
+        response_format=_response_format(request.response_format),
+        max_tokens=request.max_completion_tokens or request.max_tokens,
+        stop_sequences=[stop] if isinstance(stop, str) else stop,
+        temperature=request.temperature,
+        seed=request.seed,
+        frequency_penalty=request.frequency_penalty,
+        presence_penalty=request.presence_penalty,
+        p=request.top_p,
+        logprobs=request.logprobs,
+        tool_choice=_TOOL_CHOICES.get(tool_choice) if isinstance(tool_choice, str) else None,
+    )
+
+
+def _usage(usage: dict[str, Any] | None) -> dict[str, int] | None:
+    tokens = (usage or {}).get("tokens") or (usage or {}).get("billed_units")
+    if not tokens:
+        return None
+    prompt_tokens = int(tokens.get("input_tokens") or 0)
+    completion_tokens = int(tokens.get("output_tokens") or 0)
+    return dict(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+
+
+async def translate_v2_stream(
+    events: AsyncIterator[BaseModel | dict[str, Any]],
+    model: str,
+    include_usage: bool = False,
+) -> AsyncIterator[dict[str, Any]]:
+    """Turn each Cohere v2 stream event into the `chat.completion.chunk` it stands for, one by one."""
+    chunk_id = ""
+    created = int(time.time())
+
+    def chunk(delta: dict[str, Any], finish_reason: str | None = None) -> dict[str, Any]:
+        return dict(
+            id=chunk_id,
+            object="chat.completion.chunk",
+            created=created,
+            model=model,
+            choices=[dict(index=0, delta=delta, finish_reason=finish_reason)],
+        )
+
+    try:
+        async for event in events:
+            piece = to_dict(event)
+            event_type = piece.get("type")
+            delta = piece.get("delta") or {}
+            message = delta.get("message") or {}
+            if event_type == "message-start":
+                chunk_id = piece.get("id") or ""
+                yield chunk(dict(role="assistant", content=""))
+            elif event_type == "content-delta":
+                yield chunk(dict(content=(message.get("content") or {}).get("text") or ""))
+            elif event_type == "tool-call-start":
+                tool_call = message.get("tool_calls") or {}
+                function = tool_call.get("function") or {}
+                yield chunk(dict(tool_calls=[dict(
+                    index=piece.get("index") or 0,
+                    id=tool_call.get("id"),
+                    type="function",
+                    function=dict(name=function.get("name"), arguments=function.get("arguments") or ""),
+                )]))
+            elif event_type == "tool-call-delta":
+                function = (message.get("tool_calls") or {}).get("function") or {}
+                yield chunk(dict(tool_calls=[dict(
+                    index=piece.get("index") or 0,
+                    function=dict(arguments=function.get("arguments") or ""),
+                )]))
+            elif event_type == "message-end":
+                yield chunk({}, finish_reason=_finish_reason(delta.get("finish_reason")))
+                usage = _usage(delta.get("usage"))
+                if include_usage and usage is not None:
+                    yield dict(
+                        id=chunk_id, object="chat.completion.chunk", created=created, model=model,
+                        choices=[], usage=usage,
+                    )
+            # Other events (content-start/end, tool-plan-delta, citations, ...) have no chunk of their own.
+    finally:
+        await close_iterator_quietly(events)
+
+
+def to_chat_completion(response: cohere.V2ChatResponse, model: str) -> ChatCompletion:
+    piece = to_dict(response)
+    message = piece.get("message") or {}
+    texts = [item.get("text") or "" for item in message.get("content") or [] if item.get("type") == "text"]
+    tool_calls = [
+        dict(
+            id=tool_call.get("id"),
+            type="function",
+            function=dict(
+                name=(tool_call.get("function") or {}).get("name"),
+                arguments=(tool_call.get("function") or {}).get("arguments") or "{}",
+            ),
+        )
+        for tool_call in message.get("tool_calls") or []
+    ]
+    return ChatCompletion.model_validate(dict(
+        id=piece.get("id") or "",
+        object="chat.completion",
+        created=int(time.time()),
+        model=model,
+        choices=[dict(
+            index=0,
+            message=dict(
+                role="assistant",
+                content="".join(texts) if texts or not tool_calls else None,
+                tool_calls=tool_calls or None,
+            ),
+            finish_reason=_finish_reason(piece.get("finish_reason")),
+        )],
+        usage=_usage(piece.get("usage")),
+    ))
+
+
+async def openai_chat_stream_via_cohere_v2(
+    request: OpenAIChatStreamingRequest,
+    api_key: str | None = None,
+    x_client_name: str | None = None,
+    accepts: str = "text/event-stream",
+    base_url: str | None = None,
+) -> tuple[AsyncIterator[dict[str, Any]], dict | None]:
+    events, additional_info = await cohere_chat_v2_stream(
+        request=to_cohere_v2_request(request),
+        api_key=api_key,
+        x_client_name=x_client_name,
+        accepts=accepts,
+        base_url=base_url,
+    )
+    include_usage = bool((request.stream_options or {}).get("include_usage"))
+    return translate_v2_stream(events, model=request.model, include_usage=include_usage), additional_info
+
+
+async def openai_chat_non_stream_via_cohere_v2(
+    request: OpenAIChatNonStreamingRequest,
+    api_key: str | None = None,
+    x_client_name: str | None = None,
+    accepts: str = "application/json",
+    base_url: str | None = None,
+) -> tuple[ChatCompletion, dict | None]:
+    response, additional_info = await cohere_chat_v2_non_stream(
+        request=to_cohere_v2_request(request),
+        api_key=api_key,
+        x_client_name=x_client_name,
+        accepts=accepts,
+        base_url=base_url,
+    )
+    return to_chat_completion(response, model=request.model), additional_info
+
+
+# Cohere v1 -> v2
+
+_V1_PARAMETER_TYPES = {
+    "str": "string",
+    "int": "integer",
+    "float": "number",
+    "bool": "boolean",
+    "dict": "object",
+}
+
+_V1_CITATION_MODES = {
+    "enabled": "ACCURATE",
+    "disabled": "OFF",
+    "fast": "FAST",
+    "accurate": "ACCURATE",
+    "off": "OFF",
+}
+
+_V1_FINISH_REASONS = {
+    "TOOL_CALL": "COMPLETE",
+    "TIMEOUT": "ERROR",
+}
+
+
+def can_bridge_v1(request: CohereChatV1NonStreamRequest | CohereChatV1StreamRequest) -> bool:
+    """Whether a v1 request only uses what a v2 request can express."""
+    # v2 needs a model, where v1 picks a default one.
+    return bool(request.model) and not (
+        request.connectors or request.search_queries_only or request.conversation_id or
+        getattr(request, 'raw_prompting', None) or request.max_input_tokens or
+        request.prompt_truncation not in (None, "OFF")
+    )
+
+
+def _tool_call_id(call: dict[str, Any]) -> str:
+    # v1 tool calls have no id: the same call always gets the same one, so results find their call.
+    parameters = json.dumps(call.get("parameters") or {}, sort_keys=True)
+    return f'{call.get("name")}_{hashlib.sha1(parameters.encode()).hexdigest()[:12]}'
+
+
+def _v2_tool_call(call: dict[str, Any]) -> dict[str, Any]:
+    return dict(
+        id=_tool_call_id(call),
+        type="function",
+        function=dict(name=call.get("name"), arguments=json.dumps(call.get("parameters") or {})),
+    )
+
+
+def _v2_tool_messages(tool_results: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    return [
+        dict(
+            role="tool",
+            tool_call_id=_tool_call_id(result.get("call") or {}),
+            content=[
+                dict(type="document", document=dict(data=json.dumps(output)))
+                for output in result.get("outputs") or []
+            ],
+        )
+        for result in tool_results
+    ]
+
+
+def _v2_tool(tool: dict[str, Any]) -> dict[str, Any]:
+    definitions = tool.get("parameter_definitions") or {}
+    properties = {}
+    for name, definition in definitions.items():
+        v1_type = str(definition.get("type") or "str")
+        v2_type = "array" if v1_type.lower().startswith("list") else _V1_PARAMETER_TYPES.get(v1_type, "string")
+        properties[name] = dict(type=v2_type, description=definition.get("description") or "")
+    return dict(
+        type="function",
+        function=dict(
+            name=tool.get("name"),
+            description=tool.get("description") or "",
+            parameters=dict(
+                type="object",
+                properties=properties,
+                required=[name for name, definition in definitions.items() if definition.get("required")],
+            ),
+        ),
+    )
+
+
+def _v2_messages(request: CohereChatV1NonStreamRequest | CohereChatV1StreamRequest) -> list[dict[str, Any]]:
+    messages: list[dict[str, Any]] = []
+    if request.preamble:
+        messages.append(dict(role="system", content=request.preamble))
+    for turn in request.chat_history or []:
+        role = str(turn.get("role", "")).upper()
+        if role == "USER":
+            messages.append(dict(role="user", content=turn.get("message") or ""))
+        elif role == "SYSTEM":
+            messages.append(dict(role="system", content=turn.get("message") or ""))
+        elif role == "CHATBOT":
+            message: dict[str, Any] = dict(role="assistant")
+            if turn.get("message"):
+                message["content"] = turn["message"]
+            if turn.get("tool_calls"):
+                message["tool_calls"] = [_v2_tool_call(call) for call in turn["tool_calls"]]
+            messages.append(message)
+        elif role == "TOOL":
+            messages.extend(_v2_tool_messages(turn.get("tool_results") or []))
+        else:
+            raise BadRequestError(f"Unsupported chat_history role: {turn.get('role')}")
+    if request.tool_results:
+        last = messages[-1] if messages else {}
+        if not (last.get("role") == "assistant" and last.get("tool_calls")):
+            # v2 wants the calls before their results.
+            messages.append(dict(
+                role="assistant",
+                tool_calls=[_v2_tool_call(result.get("call") or {}) for result in request.tool_results],
+            ))
+        messages.extend(_v2_tool_messages(request.tool_results))
+    if request.message:
+        messages.append(dict(role="user", content=request.message))
+    return messages
+
+
+def v1_to_cohere_v2_request(
+    request: CohereChatV1NonStreamRequest | CohereChatV1StreamRequest,
+) -> CohereChatV2NonStreamRequest:
+    response_format = dict(request.response_format) if request.response_format else None
+    if response_format and "schema" in response_format:
+        response_format["json_schema"] = response_format.pop("schema")
+    citation_quality = str(request.citation_quality).lower() if request.citation_quality else None
+    return CohereChatV2NonStreamRequest(
+        model=request.model,
+        messages=_v2_messages(request),
+        tools=[_v2_tool(tool) for tool in request.tools] if request.tools else None,
+        documents=[
+            {**(dict(id=document["id"]) if "id" in document else {}),
+             "data": {key: value for key, value in document.items() if key != "id"}}
+            for document in request.documents
+        ] if request.documents else None,
+        citation_options=dict(mode=_V1_CITATION_MODES[citation_quality]) if citation_quality in _V1_CITATION_MODES else None,
+        response_format=response_format,
+        safety_mode="OFF" if request.safety_mode == "NONE" else request.safety_mode,
+        max_tokens=request.max_tokens,
+        stop_sequences=request.stop_sequences,
+        temperature=request.temperature,
+        seed=request.seed,
+        frequency_penalty=request.frequency_penalty,
+        presence_penalty=request.presence_penalty,
+        k=request.k,
+        p=request.p,
+    )
+
+
+def _v1_finish_reason(finish_reason: str | None) -> str:
+    finish_reason = finish_reason or "COMPLETE"
+    return _V1_FINISH_REASONS.get(finish_reason, finish_reason)
+
+
+def _v1_tool_calls(tool_calls: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    v1_tool_calls = []
+    for tool_call in tool_calls:
+        function = tool_call.get("function") or {}
+        try:
+            parameters = json.loads(function.get("arguments") or "{}")
+        except ValueError:
+            parameters = {}
+        v1_tool_calls.append(dict(name=function.get("name"), parameters=parameters))
+    return v1_tool_calls
+
+
+def _v1_citation(citation: dict[str, Any]) -> dict[str, Any]:
+    return dict(
+        start=citation.get("start"),
+        end=citation.get("end"),
+        text=citation.get("text"),
+        document_ids=[source.get("id") for source in citation.get("sources") or [] if source.get("id")],
+    )
+
+
+def _v1_meta(usage: dict[str, Any] | None) -> dict[str, Any] | None:
+    if not usage:
+        return None
+    return {key: usage[key] for key in ("billed_units", "tokens") if usage.get(key)}
+
+
+async def translate_v2_stream_to_v1(
+    events: AsyncIterator[BaseModel | dict[str, Any]],
+) -> AsyncIterator[dict[str, Any]]:
+    """Re-emit a Cohere v2 stream as the v1 stream events, one by one.
+
+    The text and the tool calls are also gathered, for the full response `stream-end` carries."""
+    generation_id = ""
+    texts: list[str] = []
+    tool_calls: dict[int, dict[str, Any]] = {}
+    citations: list[dict[str, Any]] = []
+    try:
+        async for event in events:
+            piece = to_dict(event)
+            event_type = piece.get("type")
+            delta = piece.get("delta") or {}
+            message = delta.get("message") or {}
+            if event_type == "message-start":
+                generation_id = piece.get("id") or ""
+                yield dict(event_type="stream-start", generation_id=generation_id, is_finished=False)
+            elif event_type == "content-delta":
+                text = (message.get("content") or {}).get("text") or ""
+                texts.append(text)
+                yield dict(event_type="text-generation", text=text, is_finished=False)
+            elif event_type == "tool-plan-delta":
+                yield dict(event_type="tool-calls-chunk", text=message.get("tool_plan") or "", is_finished=False)
+            elif event_type == "tool-call-start":
+                tool_call = message.get("tool_calls") or {}
+                function = tool_call.get("function") or {}
+                tool_calls[piece.get("index") or 0] = dict(
+                    function=dict(name=function.get("name"), arguments=function.get("arguments") or ""),
+                )
+                yield dict(
+                    event_type="tool-calls-chunk",
+                    tool_call_delta=dict(index=piece.get("index") or 0, name=function.get("name")),
+                    is_finished=False,
+                )
+            elif event_type == "tool-call-delta":
+                arguments = ((message.get("tool_calls") or {}).get("function") or {}).get("arguments") or ""
+                tool_call = tool_calls.get(piece.get("index") or 0)
+                if tool_call is not None:
+                    tool_call["function"]["arguments"] += arguments
+                yield dict(
+                    event_type="tool-calls-chunk",
+                    tool_call_delta=dict(index=piece.get("index") or 0, parameters=arguments),
+                    is_finished=False,
+                )
+            elif event_type == "citation-start":
+                citation = _v1_citation(message.get("citations") or {})
+                citations.append(citation)
+                yield dict(event_type="citation-generation", citations=[citation], is_finished=False)
+            elif event_type == "message-end":
+                v1_tool_calls = _v1_tool_calls([tool_calls[index] for index in sorted(tool_calls)])
+                if v1_tool_calls:
+                    yield dict(event_type="tool-calls-generation", text="", tool_calls=v1_tool_calls, is_finished=False)
+                finish_reason = _v1_finish_reason(delta.get("finish_reason"))
+                response = dict(text="".join(texts), generation_id=generation_id, finish_reason=finish_reason)
+                if v1_tool_calls:
+                    response["tool_calls"] = v1_tool_calls
+                if citations:
+                    response["citations"] = citations
+                meta = _v1_meta(delta.get("usage"))
+                if meta:
+                    response["meta"] = meta
+                yield dict(event_type="stream-end", finish_reason=finish_reason, response=response, is_finished=True)
+            # Other events (content-start/end, tool-call-end, citation-end, ...) have no v1 event of their own.
+    finally:
+        await close_iterator_quietly(events)
+
+
+def to_v1_chat_response(response: cohere.V2ChatResponse) -> cohere.NonStreamedChatResponse:
+    piece = to_dict(response)
+    message = piece.get("message") or {}
+    v1_tool_calls = _v1_tool_calls(message.get("tool_calls") or [])
+    v1_response: dict[str, Any] = dict(
+        text="".join(item.get("text") or "" for item in message.get("content") or [] if item.get("type") == "text"),
+        generation_id=piece.get("id"),
+        finish_reason=_v1_finish_reason(piece.get("finish_reason")),
+    )
+    if v1_tool_calls:
+        v1_response["tool_calls"] = v1_tool_calls
+    if message.get("citations"):
+        v1_response["citations"] = [_v1_citation(citation) for citation in message["citations"]]
+    meta = _v1_meta(piece.get("usage"))
+    if meta:
+        v1_response["meta"] = meta
+    return cohere.NonStreamedChatResponse.model_validate(v1_response)
+
+
+async def cohere_chat_v1_stream_via_v2(
+    request: CohereChatV1StreamRequest,
+    api_key: str | None = None,
+    x_client_name: str | None = None,
+    accepts: str = "text/event-stream",
+    base_url: str | None = None,
+) -> tuple[AsyncIterator[dict[str, Any]], dict | None]:
+    events, additional_info = await cohere_chat_v2_stream(
+        request=v1_to_cohere_v2_request(request),
+        api_key=api_key,
+        x_client_name=x_client_name,
+        accepts=accepts,
+        base_url=base_url,
+    )
+    return translate_v2_stream_to_v1(events), additional_info
+
+
+async def cohere_chat_v1_non_stream_via_v2(
+    request: CohereChatV1NonStreamRequest,
+    api_key: str | None = None,
+    x_client_name: str | None = None,
+    accepts: str = "application/json",
+    base_url: str | None = None,
+) -> tuple[cohere.NonStreamedChatResponse, dict | None]:
+    response, additional_info = await cohere_chat_v2_non_stream(
+        request=v1_to_cohere_v2_request(request),
+        api_key=api_key,
+        x_client_name=x_client_name,
+        accepts=accepts,
+        base_url=base_url,
+    )
+    return to_v1_chat_response(response), additional_info
@@ -1,12 +1,21 @@
 from __future__ import annotations
 from abc import abstractmethod
-from typing import Iterable, Iterator, TypeVar, Callable, Literal
+from typing import TYPE_CHECKING, AsyncIterable, AsyncIterator, Iterable, Iterator, TypeVar, Callable, Literal
 from pydantic import BaseModel
 from fastapi.responses import StreamingResponse
 from fastapi import HTTPException
+from starlette.concurrency import iterate_in_threadpool
+import asyncio
+import inspect
 import logging
 import sys
 import json
+from resources.environment import Environment
+from server.json_utils import to_dict
+from server.delta_coalescing import TextDelta, coalesce_deltas
+
+if TYPE_CHECKING:
+    from server.stream_cache import StreamRecorder
 
 
 T = TypeVar('T')
@@ -55,26 +64,136 @@ def get_wrapper_after_getting_first_item_successfully(
         raise wrapper_in_case_of_exception(e)
 
 
+async def close_iterator_quietly(iterator: ...) -> None:
+    """Close an (async) iterator, releasing the upstream HTTP response behind it."""
+    for name in ('aclose', 'close'):
+        closer = getattr(iterator, name, None)
+        if closer is None:
+            continue
+        try:
+            result = closer()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as exp:
+            CommonServiceLogger.get_instance().info(f"Ignored error while closing upstream iterator: {exp!r}")
+        return
+
+
+class ReleasingIterator:
+    """Async iterator that calls `release` once, when the wrapped iterator is exhausted, fails or is closed.
+
+    `release` gets the exception that ended the iteration, if any. Unlike an
+    async generator, closing it before the first item still releases.
+    """
+
+    def __init__(self, iterator: AsyncIterator[T], release: Callable[[BaseException | None], None]):
+        self.iterator = iterator
+        self._release = release
+        self.released = False
+
+    def release(self, exc: BaseException | None = None) -> None:
+        if not self.released:
+            self.released = True
+            self._release(exc)
+
+    def __aiter__(self) -> ReleasingIterator:
+        return self
+
+    async def __anext__(self) -> T:
+        try:
+            return await anext(self.iterator)
+        except StopAsyncIteration:
+            self.release()
+            raise
+        except BaseException as exp:
+            self.release(exp)
+            raise
+
+    async def aclose(self) -> None:
+        self.release()
+        await close_iterator_quietly(self.iterator)
+
+
+async def get_wrapper_after_getting_first_item_successfully_async(
+    responses: AsyncIterable[T] | Iterable[T],
+    exception_type_to_catch: type[E],
+    wrapper_in_case_of_success: Callable[[AsyncIterator[T]], T2],
+    wrapper_in_case_of_exception: Callable[[E], T3] | None = None,
+    first_item_timeout: float | None = None,
+) -> T2:
+    """Async counterpart of `get_wrapper_after_getting_first_item_successfully`.
+
+    The first item is awaited, so the event loop keeps serving other requests
+    while the upstream prepares its first chunk. Synchronous iterables are
+    advanced in the threadpool for the same reason. When `first_item_timeout`
+    elapses before the first item arrives, the upstream iterator is closed and
+    an HTTPException with status 504 is raised; it is closed as well when the
+    wait is cancelled.
+    """
+    one_time_sequence = (
+        aiter(responses) if hasattr(responses, '__aiter__') else
+        aiter(iterate_in_threadpool(responses))
+    )
+    try:
+        try:
+            first_item: T = await asyncio.wait_for(anext(one_time_sequence), timeout=first_item_timeout)
+            have_got_first = True
+        except StopAsyncIteration:
+            have_got_first = False
+        except asyncio.CancelledError:
+            # E.g. the losing attempt of a hedged request: do not leave the upstream response open.
+            await close_iterator_quietly(one_time_sequence)
+            raise
+        except asyncio.TimeoutError:
+            await close_iterator_quietly(one_time_sequence)
+            raise HTTPException(
+                status_code=504,
+                detail=f"Upstream did not send the first chunk within {first_item_timeout} seconds.",
+            )
+        async def emit():
+            try:
+                if not have_got_first:
+                    return
+                yield first_item
+                async for item in one_time_sequence:
+                    yield item
+            finally:
+                # Closed early (e.g. the client went away): do not leave the upstream to drain.
+                await close_iterator_quietly(one_time_sequence)
+
+        return wrapper_in_case_of_success(emit())
+    except exception_type_to_catch as e:
+        raise wrapper_in_case_of_exception(e)
+
+
 class StreamingResponseHTTPExceptionDispatcher:
     def __init__(
         self,
-        response: Iterator[BaseModel | dict[str, ...]],
+        response: AsyncIterator[BaseModel | dict[str, ...]] | Iterator[BaseModel | dict[str, ...]],
         exception_type_to_catch: type[E],
         additional_strings: list[str] | None = None,
         log_to_info: bool = False,
+        first_chunk_timeout: float | None = None,
+        recorder: StreamRecorder | None = None,
     ):
-        self.response = response
+        self.response = response if hasattr(response, '__aiter__') else iterate_in_threadpool(response)
+        self.first_chunk_timeout = (
+            first_chunk_timeout if first_chunk_timeout is not None else
+            Environment.get_instance().first_chunk_timeout_seconds
+        )
+        self.delta_coalescing = Environment.get_instance().delta_coalescing
         self.generation_id_in_stream_start: str | None = None
         self.exception_type_to_catch = exception_type_to_catch
         self.log_to_info = log_to_info
         self.additional_string = additional_strings or []
+        self.recorder = recorder
 
     @abstractmethod
-    def _set_generation_id(self, piece: ...):
+    def _set_generation_id(self, piece: dict[str, ...]):
         ...
 
     @abstractmethod
-    def _stringify(self, a_dict: dict[str, ...]) -> str:
+    def _stringify(self, a_dict: dict[str, ...]) -> bytes:
         ...
 
     @abstractmethod
@@ -85,45 +204,69 @@ class StreamingResponseHTTPExceptionDispatcher:
     def _create_intermediate_response(self, piece: str):
         ...
 
-    def _feed_response(self):
-        added = False
-        for piece in self.response:
-            if not added:
-                piece_dict = (
-                    piece.model_dump(exclude_unset=True, exclude_none=True) if hasattr(piece, 'model_dump') else
-                    piece if isinstance(piece, dict) else
-                    {}
-                )
-                # from icecream import ic; ic(type(piece_dict), piece_dict)
-                if self._detect_finishing(piece_dict):
-                    # from icecream import ic; ic(self.additional_string)
-                    for text in self.additional_string:
-                        intermediate_response = self._create_intermediate_response(text)
-                        yield intermediate_response
+    def _create_intermediate_responses(self, texts: list[str]) -> list:
+        return [self._create_intermediate_response(text) for text in texts]
+
+    def _create_http_exception(self, e: E) -> HTTPException:
+        return HTTPException(
+            status_code=e.status_code,
+            detail=e.body.get('message', 'An error occurred.') if isinstance(e.body, dict) else str(e.body),
+        )
+
+    def _text_delta(self, piece: dict[str, ...]) -> TextDelta | None:
+        """Where the text of a plain text delta is, for merging it with the next ones; None for any other piece."""
+        return None
+
+    async def _feed_response(self):
+        """Yield every piece as a dict, dumped exactly once and shared by all later stages."""
+        added = not self.additional_string
+        detect_finishing = self._detect_finishing
+        try:
+            async for piece in self.response:
+                piece_dict = to_dict(piece)
+                if not added and detect_finishing(piece_dict):
+                    for intermediate in self._create_intermediate_responses(self.additional_string):
+                        yield to_dict(intermediate)
                     added = True
-            yield piece
-
-    def _yield_items(self):
-        for piece in self._feed_response():
-            if self.log_to_info:
-                CommonServiceLogger.get_instance().info(f"Received piece: {piece}")
-            self._set_generation_id(piece)
-            # from icecream import ic
-            # ic(type(piece))
-            piece_model_dump = piece.model_dump(exclude_unset=True, exclude_none=True)
-            # ic(piece_model_dump)
-            yield self._stringify(piece.model_dump(exclude_unset=True, exclude_none=True))
-
-    def get_StreamingResponse_or_raise_HTTPException(self):
-        return get_wrapper_after_getting_first_item_successfully(
+                yield piece_dict
+        finally:
+            await close_iterator_quietly(self.response)
+
+    async def _yield_items(self):
+        set_generation_id = self._set_generation_id
+        stringify = self._stringify
+        recorder = self.recorder
+        pieces = self._feed_response()
+        if self.delta_coalescing:
+            env = Environment.get_instance()
+            pieces = coalesce_deltas(
+                pieces,
+                text_delta=self._text_delta,
+                max_bytes=env.delta_coalescing_max_bytes,
+                max_delay=env.delta_coalescing_max_delay_seconds,
+            )
+        try:
+            async for piece_dict in pieces:
+                if self.log_to_info:
+                    CommonServiceLogger.get_instance().info(f"Received piece: {piece_dict}")
+                set_generation_id(piece_dict)
+                chunk = stringify(piece_dict)
+                if recorder is not None:
+                    recorder.append(chunk)
+                yield chunk
+        finally:
+            await pieces.aclose()
+        if recorder is not None:
+            recorder.commit()
+
+    async def get_StreamingResponse_or_raise_HTTPException(self):
+        return await get_wrapper_after_getting_first_item_successfully_async(
             responses=self._yield_items(),
             exception_type_to_catch=self.exception_type_to_catch,
             wrapper_in_case_of_success=lambda items: StreamingResponse(
-                map(lambda item: item, items),
+                items,
                 media_type="text/event-stream",
             ),
-            wrapper_in_case_of_exception=lambda e: HTTPException(
-                status_code=e.status_code,
-                detail=e.body.get('message', 'An error occurred.') if isinstance(e.body, dict) else str(e.body),
-            ),
+            wrapper_in_case_of_exception=self._create_http_exception,
+            first_item_timeout=self.first_chunk_timeout,
         )
@@ -0,0 +1,134 @@
+"""
+Response compression negotiated on `Accept-Encoding` (gzip, and zstd when the
+`compression` extra is installed).
+
+A non-stream response is compressed as a whole, unless it is smaller than
+`COMPRESSION_MIN_BYTES`. A stream is compressed as it goes: the compressor is
+flushed at every event boundary (a body chunk ending with a newline, which
+is how SSE events and NDJSON lines end), so every token still reaches the
+client as soon as it is sent, while the repeated keys of consecutive events
+compress against each other.
+"""
+
+from __future__ import annotations
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from resources.environment import Environment
+from server.metrics import ProxyMetrics
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the installed extras
+    zstandard = None
+
+
+def choose_encoding(accept_encoding: str, available: tuple[str, ...]) -> str | None:
+    """The available encoding the client prefers, by q-value then by our order; None for identity."""
+    preferences: dict[str, float] = {}
+    for entry in accept_encoding.split(','):
+        name, *params = entry.strip().split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        preferences[name.strip().lower()] = quality
+    ranked = [
+        (quality, -order, encoding)
+        for order, encoding in enumerate(available)
+        if (quality := preferences.get(encoding, preferences.get('*', 0.0))) > 0
+    ]
+    return max(ranked)[2] if ranked else None
+
+
+class _Compressor:
+    def __init__(self, encoding: str, gzip_level: int, zstd_level: int):
+        if encoding == 'zstd':
+            self._compressobj = zstandard.ZstdCompressor(level=zstd_level).compressobj()
+            self._sync_flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            # wbits=31: zlib stream with a gzip header and trailer.
+            self._compressobj = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self._sync_flush = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data: bytes, flush: bool) -> bytes:
+        compressed = self._compressobj.compress(data)
+        if flush:
+            compressed += self._compressobj.flush(self._sync_flush)
+        return compressed
+
+    def finish(self) -> bytes:
+        return self._compressobj.flush()
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        env = Environment.get_instance()
+        self.gzip_level = env.compression_gzip_level
+        self.zstd_level = env.compression_zstd_level
+        self.min_bytes = env.compression_min_bytes
+        self.encodings = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Message | None = None
+        compressor: _Compressor | None = None
+        raw_bytes = sent_bytes = 0
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, compressor, raw_bytes, sent_bytes
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(scope=start)
+                compressible = (
+                    "content-encoding" not in headers and
+                    start["status"] not in (204, 304) and
+                    (more_body or len(body) >= self.min_bytes)
+                )
+                if compressible:
+                    compressor = _Compressor(encoding, self.gzip_level, self.zstd_level)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    del headers["Content-Length"]
+                await send(start)
+                start = None
+            if compressor is None:
+                await send(message)
+                return
+            raw_bytes += len(body)
+            if more_body:
+                body = compressor.compress(body, flush=body.endswith(b"\n"))
+            else:
+                body = compressor.compress(body, flush=False) + compressor.finish()
+            sent_bytes += len(body)
+            if body or not more_body:
+                await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        try:
+            await self.app(scope, receive, send_compressed)
+        finally:
+            if compressor is not None:
+                metrics = ProxyMetrics.get_instance()
+                metrics.increment('compression_input_bytes', raw_bytes, encoding=encoding)
+                metrics.increment('compression_output_bytes', sent_bytes, encoding=encoding)
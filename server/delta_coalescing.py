@@ -0,0 +1,110 @@
+"""
+Coalescing of consecutive text deltas of a stream into one event.
+
+Providers often send one or two characters per `text-generation` /
+`content-delta` / `chat.completion.chunk` event, and each one costs an event,
+an HTTP chunk and a write. When `DELTA_COALESCING` is on, a text delta is held
+back and the following deltas of the same stream position are appended to
+it, until `DELTA_COALESCING_MAX_BYTES` of text are held or
+`DELTA_COALESCING_MAX_DELAY_SECONDS` have passed since the first one. Any
+other piece (stream end, finish reason, tool calls, ...) first flushes what is
+held and is then passed on at once, so terminal events are never delayed.
+
+The stage works on the piece dicts, before they are stringified; the merged
+piece is an ordinary event of its kind, so the framing of every output style
+stays as valid as without coalescing.
+"""
+
+from __future__ import annotations
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Hashable
+import asyncio
+import copy
+
+from server.metrics import ProxyMetrics
+
+
+# Identifies a text delta: pieces with equal keys can be merged; `holder[field]` is their text.
+TextDelta = tuple[Hashable, dict[str, Any], str]
+
+
+async def coalesce_deltas(
+    pieces: AsyncGenerator[dict[str, Any], None],
+    text_delta: Callable[[dict[str, Any]], TextDelta | None],
+    max_bytes: int,
+    max_delay: float,
+) -> AsyncIterator[dict[str, Any]]:
+    loop = asyncio.get_running_loop()
+    held: dict[str, Any] | None = None
+    held_key: Hashable = None
+    held_texts: list[str] = []
+    held_bytes = 0
+    deadline = 0.0
+    pending: asyncio.Future | None = None
+    merged = 0
+
+    def release() -> dict[str, Any]:
+        nonlocal held
+        piece, held = held, None
+        if len(held_texts) > 1:
+            # The pieces may be shared with other readers: merge into a copy.
+            piece = copy.deepcopy(piece)
+            _, holder, field = text_delta(piece)
+            holder[field] = ''.join(held_texts)
+        return piece
+
+    try:
+        while True:
+            if held is not None and pending is None:
+                pending = asyncio.ensure_future(anext(pieces))
+            if pending is not None:
+                if held is not None:
+                    await asyncio.wait((pending,), timeout=max(0.0, deadline - loop.time()))
+                    if not pending.done():
+                        # The next piece is late: send what is held and keep waiting for it.
+                        yield release()
+                        continue
+                next_piece, pending = pending, None
+                try:
+                    piece = await next_piece
+                except StopAsyncIteration:
+                    break
+            else:
+                try:
+                    piece = await anext(pieces)
+                except StopAsyncIteration:
+                    break
+
+            delta = text_delta(piece)
+            if delta is not None and held is not None and delta[0] == held_key:
+                text = delta[1][delta[2]]
+                held_texts.append(text)
+                held_bytes += len(text.encode())
+                merged += 1
+                if held_bytes >= max_bytes:
+                    yield release()
+                continue
+            if held is not None:
+                yield release()
+            if delta is None:
+                yield piece
+                continue
+            held_key, holder, field = delta
+            held_texts = [holder[field]]
+            held_bytes = len(held_texts[0].encode())
+            if held_bytes >= max_bytes:
+                yield piece
+                continue
+            held = piece
+            deadline = loop.time() + max_delay
+        if held is not None:
+            yield release()
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration, Exception):
+                pass
+        await pieces.aclose()
+        if merged:
+            ProxyMetrics.get_instance().increment('coalesced_deltas', merged)
@@ -0,0 +1,70 @@
+"""
+Cancellation of requests whose client has gone away.
+
+Depending on the ASGI server, Starlette only notices a disconnected client
+when it next writes to it, so a stream keeps pulling from the upstream while
+the provider generates tokens nobody reads, and a non-stream call waits for
+its whole answer. This middleware listens for `http.disconnect` as soon as the
+request body has been read and cancels the request; the cancellation unwinds
+the stream iterators, which closes the upstream responses and gives back the
+slots and leases they hold. Each cancellation is counted as `client_cancelled`.
+"""
+
+from __future__ import annotations
+import asyncio
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from server.metrics import ProxyMetrics
+
+
+class CancelOnDisconnectMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        body_read = asyncio.Event()
+        response_complete = False
+
+        async def receive_body() -> Message:
+            message = await receive()
+            if message["type"] != "http.request" or not message.get("more_body", False):
+                body_read.set()
+            return message
+
+        async def send_response(message: Message) -> None:
+            nonlocal response_complete
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        async def wait_for_disconnect() -> None:
+            # The app owns `receive` until it has read the body; only then is a message here a disconnect.
+            await body_read.wait()
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        app_task = asyncio.ensure_future(self.app(scope, receive_body, send_response))
+        watcher = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            await asyncio.wait((app_task, watcher), return_when=asyncio.FIRST_COMPLETED)
+            if app_task.done():
+                app_task.result()
+                return
+            if response_complete:
+                await app_task
+                return
+            ProxyMetrics.get_instance().increment('client_cancelled', path=scope.get("path", ""))
+            app_task.cancel()
+            try:
+                await app_task
+            except (asyncio.CancelledError, Exception):
+                # Nobody is left to receive the outcome.
+                pass
+        finally:
+            watcher.cancel()
+            app_task.cancel()
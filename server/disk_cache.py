@@ -0,0 +1,264 @@
+"""
+Disk tier of the non-stream response cache, shared by the worker processes of one host.
+
+Layout of the cache directory:
+
+- `segment.dat`: append-only records `header | payload`, where the header holds
+  a magic number, the request fingerprint, the expiry time and the payload length.
+- `index.bin`: memory-mapped open-addressing hash table from fingerprints to
+  record offsets, so a lookup reads one slot and one record and never scans the
+  segment.
+- `lock`: `flock`ed by writers. Readers take no lock; every record repeats its
+  fingerprint, so a slot that is being rewritten concurrently reads as a miss.
+
+When the segment grows beyond its size limit, or the index gets too full, the
+newest live records are rewritten into a fresh segment and index (compaction);
+expired and superseded records are dropped, and the oldest records go first
+when the live ones still do not fit (size-based eviction). Processes notice a
+compaction by the changed inode of the index file and remap.
+"""
+
+from __future__ import annotations
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterator
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from resources.environment import Environment
+from server.json_utils import decode_response, dumps_bytes, encode_response, loads
+from server.metrics import ProxyMetrics
+
+
+_RECORD_HEADER = struct.Struct('<4s32sdI')
+_RECORD_MAGIC = b'LPR1'
+_INDEX_HEADER = struct.Struct('<4sII')
+_INDEX_HEADER_SIZE = 64
+_INDEX_MAGIC = b'LPI1'
+# key, offset + 1 (0 marks an empty slot), payload length, expiry time
+_SLOT = struct.Struct('<32sQId')
+_MAX_LOAD_FACTOR = 0.7
+# Fraction of the size limit kept by a compaction, so that appends do not trigger the next one right away.
+_COMPACTION_TARGET = 0.75
+
+
+def fingerprint_bytes(key: str) -> bytes:
+    return hashlib.sha256(key.encode('utf-8')).digest()
+
+
+@dataclass
+class _View:
+    """Mappings of one generation of the files; replaced, never closed, so concurrent readers stay valid."""
+    index_inode: int
+    index: mmap.mmap
+    capacity: int
+    segment: mmap.mmap | None
+
+
+class DiskCache:
+    instance: DiskCache | None = None
+    SEGMENT_FILE = 'segment.dat'
+    INDEX_FILE = 'index.bin'
+    LOCK_FILE = 'lock'
+
+    def __init__(self, enabled: bool, path: Path | None, max_bytes: int, ttl_seconds: float, index_slots: int):
+        self.enabled = enabled and path is not None
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.index_slots = index_slots
+        self._thread_lock = threading.Lock()
+        self._view: _View | None = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.compactions = 0
+        self.evictions = 0
+        if self.enabled:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with self._exclusive():
+                if not (self.path / self.INDEX_FILE).exists():
+                    self._write_files([], self.index_slots)
+
+    @classmethod
+    def get_instance(cls) -> DiskCache:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.disk_cache,
+                path=env.disk_cache_path,
+                max_bytes=env.disk_cache_max_bytes,
+                ttl_seconds=env.disk_cache_ttl_seconds,
+                index_slots=env.disk_cache_index_slots,
+            )
+            ProxyMetrics.get_instance().register_source('disk_cache', cls.instance.stats)
+        return cls.instance
+
+    # Files and mappings
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        """Serialize writers across the threads of this process and across processes."""
+        with self._thread_lock:
+            fd = os.open(self.path / self.LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _map(self, name: str, writable: bool) -> mmap.mmap | None:
+        with open(self.path / name, 'r+b' if writable else 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size == 0:
+                return None
+            return mmap.mmap(file.fileno(), size, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+    def _current_view(self, need_segment_bytes: int = 0) -> _View:
+        view = self._view
+        inode = os.stat(self.path / self.INDEX_FILE).st_ino
+        if view is None or view.index_inode != inode:
+            index = self._map(self.INDEX_FILE, writable=True)
+            magic, capacity, _ = _INDEX_HEADER.unpack_from(index, 0)
+            if magic != _INDEX_MAGIC:
+                raise ValueError(f"Not a response cache index: {self.path / self.INDEX_FILE}")
+            view = _View(index_inode=inode, index=index, capacity=capacity, segment=self._map(self.SEGMENT_FILE, writable=False))
+            self._view = view
+        elif need_segment_bytes and (view.segment is None or len(view.segment) < need_segment_bytes):
+            view = _View(view.index_inode, view.index, view.capacity, self._map(self.SEGMENT_FILE, writable=False))
+            self._view = view
+        return view
+
+    def _write_files(self, records: list[tuple[bytes, float, bytes]], capacity: int) -> None:
+        """Write `records` (fingerprint, expiry, payload) into a new segment and index and swap them in."""
+        segment_path = self.path / self.SEGMENT_FILE
+        index_path = self.path / self.INDEX_FILE
+        index = bytearray(_INDEX_HEADER_SIZE + capacity * _SLOT.size)
+        _INDEX_HEADER.pack_into(index, 0, _INDEX_MAGIC, capacity, len(records))
+        offset = 0
+        with open(segment_path.with_suffix('.tmp'), 'wb') as segment:
+            for fingerprint, expires_at, payload in records:
+                segment.write(_RECORD_HEADER.pack(_RECORD_MAGIC, fingerprint, expires_at, len(payload)))
+                segment.write(payload)
+                slot = self._probe(index, capacity, fingerprint)
+                _SLOT.pack_into(index, _INDEX_HEADER_SIZE + slot * _SLOT.size, fingerprint, offset + 1, len(payload), expires_at)
+                offset += _RECORD_HEADER.size + len(payload)
+        index_path.with_suffix('.tmp').write_bytes(index)
+        os.replace(segment_path.with_suffix('.tmp'), segment_path)
+        os.replace(index_path.with_suffix('.tmp'), index_path)
+
+    @staticmethod
+    def _probe(index, capacity: int, fingerprint: bytes) -> int:
+        """Slot holding `fingerprint`, or the empty slot where it would go."""
+        slot = int.from_bytes(fingerprint[:8], 'little') % capacity
+        for _ in range(capacity):
+            key, stored_offset, _, _ = _SLOT.unpack_from(index, _INDEX_HEADER_SIZE + slot * _SLOT.size)
+            if stored_offset == 0 or key == fingerprint:
+                return slot
+            slot = (slot + 1) % capacity
+        raise OverflowError("Response cache index is full.")
+
+    # Reads
+
+    def get(self, key: str) -> Any | None:
+        fingerprint = fingerprint_bytes(key)
+        view = self._current_view()
+        slot = self._probe(view.index, view.capacity, fingerprint)
+        _, stored_offset, length, expires_at = _SLOT.unpack_from(view.index, _INDEX_HEADER_SIZE + slot * _SLOT.size)
+        if stored_offset == 0 or expires_at <= time.time():
+            self.misses += 1
+            return None
+        offset = stored_offset - 1
+        end = offset + _RECORD_HEADER.size + length
+        view = self._current_view(need_segment_bytes=end)
+        if view.segment is None or len(view.segment) < end:
+            self.misses += 1
+            return None
+        magic, record_fingerprint, _, record_length = _RECORD_HEADER.unpack_from(view.segment, offset)
+        if magic != _RECORD_MAGIC or record_fingerprint != fingerprint or record_length != length:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return decode_response(loads(view.segment[offset + _RECORD_HEADER.size:end]))
+
+    # Writes
+
+    def put(self, key: str, value: Any) -> None:
+        fingerprint = fingerprint_bytes(key)
+        payload = dumps_bytes(encode_response(value))
+        expires_at = time.time() + self.ttl_seconds
+        with self._exclusive():
+            view = self._current_view()
+            _, _, count = _INDEX_HEADER.unpack_from(view.index, 0)
+            segment_path = self.path / self.SEGMENT_FILE
+            if (
+                (count + 1) > view.capacity * _MAX_LOAD_FACTOR or
+                os.stat(segment_path).st_size + _RECORD_HEADER.size + len(payload) > self.max_bytes
+            ):
+                self._compact(view, extra=(fingerprint, expires_at, payload))
+                return
+            with open(segment_path, 'ab') as segment:
+                offset = segment.tell()
+                segment.write(_RECORD_HEADER.pack(_RECORD_MAGIC, fingerprint, expires_at, len(payload)))
+                segment.write(payload)
+            slot = self._probe(view.index, view.capacity, fingerprint)
+            position = _INDEX_HEADER_SIZE + slot * _SLOT.size
+            is_new = _SLOT.unpack_from(view.index, position)[1] == 0
+            # Offset and length first, the fingerprint last, so a reader never pairs a new key with a stale offset.
+            _SLOT.pack_into(view.index, position, b'\0' * 32 if is_new else fingerprint, offset + 1, len(payload), expires_at)
+            view.index[position:position + 32] = fingerprint
+            if is_new:
+                _INDEX_HEADER.pack_into(view.index, 0, _INDEX_MAGIC, view.capacity, count + 1)
+            self.writes += 1
+
+    def _compact(self, view: _View, extra: tuple[bytes, float, bytes]) -> None:
+        now = time.time()
+        live: list[tuple[int, bytes, float, int]] = []
+        for slot in range(view.capacity):
+            key, stored_offset, length, expires_at = _SLOT.unpack_from(view.index, _INDEX_HEADER_SIZE + slot * _SLOT.size)
+            if stored_offset and expires_at > now and key != extra[0]:
+                live.append((stored_offset - 1, key, expires_at, length))
+        live.sort(reverse=True)
+        segment = self._map(self.SEGMENT_FILE, writable=False)
+        budget = int(self.max_bytes * _COMPACTION_TARGET) - _RECORD_HEADER.size - len(extra[2])
+        kept: list[tuple[bytes, float, bytes]] = []
+        for position, (offset, key, expires_at, length) in enumerate(live):
+            budget -= _RECORD_HEADER.size + length
+            if budget < 0:
+                self.evictions += len(live) - position
+                break
+            start = offset + _RECORD_HEADER.size
+            kept.append((key, expires_at, bytes(segment[start:start + length])))
+        kept.reverse()
+        kept.append(extra)
+        capacity = view.capacity
+        while len(kept) > capacity * _MAX_LOAD_FACTOR / 2:
+            capacity *= 2
+        self._write_files(kept, capacity)
+        self.compactions += 1
+        self.writes += 1
+
+    def stats(self) -> dict[str, Any]:
+        result: dict[str, Any] = dict(
+            enabled=self.enabled,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            writes=self.writes,
+            compactions=self.compactions,
+            evictions=self.evictions,
+        )
+        if self.enabled:
+            view = self._current_view()
+            result.update(
+                entries=_INDEX_HEADER.unpack_from(view.index, 0)[2],
+                index_slots=view.capacity,
+                bytes=os.stat(self.path / self.SEGMENT_FILE).st_size,
+            )
+        return result
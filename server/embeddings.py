@@ -0,0 +1,393 @@
+"""
+Embeddings with dynamic micro-batching and a per-text cache.
+
+`/v1/embeddings` (OpenAI) and `/v2/embed` (Cohere) callers often embed a few
+texts at a time. With `EMBEDDING_BATCHING`, the texts of concurrent requests
+for the same upstream, API key, model and parameters are gathered into one
+upstream call: a batch closes when it holds the provider's maximum number of
+inputs, or `EMBEDDING_BATCH_WINDOW_SECONDS` after its first text, and every
+caller gets its own slice of the result. With `EMBEDDING_CACHE`, the
+embeddings of every text are also kept under the hash of the text and the
+parameters, so only the texts not seen before go upstream.
+
+Vectors can be returned as base64 of little-endian float32 or float16
+(`X-Proxy-Embedding-Encoding: base64-float32` / `base64-float16`, or
+`encoding_format: base64` on the OpenAI route) to shrink the responses. The
+upstream is always asked for floats, so cached vectors serve every encoding.
+"""
+
+from __future__ import annotations
+from array import array
+from typing import Any, Awaitable, Callable, Hashable
+import asyncio
+import base64
+import hashlib
+import struct
+
+from resources.environment import Environment
+from server.cohere_service import cohere_embed_v2
+from server.errors import BadRequestError
+from server.generic_service import create_generation_id, fingerprint_api_key
+from server.json_utils import dumps_canonical_bytes
+from server.load_balancer import call_balanced
+from server.metrics import ProxyMetrics
+from server.openai_service import openai_embeddings
+from server.payloads_cohere import CohereEmbedV2Request
+from server.payloads_openai import OpenAIEmbeddingsRequest
+from server.response_cache import ResponseCache, is_cache_bypassed
+
+
+# Most inputs one upstream call takes.
+MAX_BATCH_SIZES = {
+    "cohere": 96,
+    "openai": 2048,
+}
+
+# Values of the `X-Proxy-Embedding-Encoding` request header.
+EMBEDDING_ENCODINGS = ('base64-float32', 'base64-float16')
+
+_BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+
+# Embedding types kept as packed arrays; the others (base64) are kept as they are.
+_TYPECODES = {
+    "float": "d",
+    "int8": "b",
+    "binary": "b",
+    "uint8": "B",
+    "ubinary": "B",
+}
+
+# The embeddings of one text: embedding type -> vector.
+Embeddings = dict[str, Any]
+EmbedCall = Callable[[list | None], Awaitable[tuple[list[Embeddings], float]]]
+
+
+def parse_embedding_encoding(value: str | None) -> str | None:
+    if value is None or not value.strip():
+        return None
+    encoding = value.strip().lower()
+    if encoding not in EMBEDDING_ENCODINGS:
+        raise BadRequestError(
+            f"Unsupported X-Proxy-Embedding-Encoding: {value}. Use one of {', '.join(EMBEDDING_ENCODINGS)}."
+        )
+    return encoding
+
+
+def encode_vector(vector: array, encoding: str) -> str:
+    """Base64 of the little-endian float32 or float16 values of `vector`."""
+    code = 'e' if encoding == 'base64-float16' else 'f'
+    return base64.b64encode(struct.pack(f'<{len(vector)}{code}', *vector)).decode('ascii')
+
+
+def _pack(embeddings: dict[str, Any]) -> Embeddings:
+    return {
+        kind: array(_TYPECODES[kind], vector) if kind in _TYPECODES else vector
+        for kind, vector in embeddings.items()
+    }
+
+
+def _unpack(vector: Any, encoding: str | None = None) -> Any:
+    if not isinstance(vector, array):
+        return vector
+    if encoding is not None and vector.typecode == 'd':
+        return encode_vector(vector, encoding)
+    return vector.tolist()
+
+
+def _size(embeddings: Embeddings) -> int:
+    return sum(
+        vector.itemsize * len(vector) if isinstance(vector, array) else len(vector)
+        for vector in embeddings.values()
+    )
+
+
+class EmbeddingCache(ResponseCache):
+    """LRU/TTL cache of the embeddings of single texts, bounded by entry count and by total bytes."""
+    instance: EmbeddingCache | None = None
+
+    def __init__(self, enabled: bool, max_entries: int, max_bytes: int, ttl_seconds: float):
+        super().__init__(enabled=enabled, max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    @classmethod
+    def get_instance(cls) -> EmbeddingCache:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.embedding_cache,
+                max_entries=env.embedding_cache_max_entries,
+                max_bytes=env.embedding_cache_max_bytes,
+                ttl_seconds=env.embedding_cache_ttl_seconds,
+            )
+            ProxyMetrics.get_instance().register_source('embedding_cache', cls.instance.stats)
+        return cls.instance
+
+    def _copy_value(self, value: Embeddings) -> Embeddings:
+        # Packed embeddings are never modified: they are only read to build responses.
+        return value
+
+    def _on_stored(self, value: Embeddings) -> None:
+        self.bytes += _size(value)
+
+    def _on_removed(self, value: Embeddings) -> None:
+        self.bytes -= _size(value)
+
+    def _is_over_capacity(self) -> bool:
+        return self.bytes > self.max_bytes and len(self._entries) > 0
+
+    def stats(self) -> dict[str, Any]:
+        return dict(super().stats(), bytes=self.bytes, max_bytes=self.max_bytes)
+
+
+def _mark_retrieved(future: asyncio.Future) -> None:
+    # Every caller of the batch may be gone; keep asyncio from reporting the exception as lost.
+    if not future.cancelled():
+        future.exception()
+
+
+class _Batch:
+    def __init__(self, call: EmbedCall):
+        self.call = call
+        self.texts: list[str] = []
+        self.positions: dict[str, int] = {}
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.future.add_done_callback(_mark_retrieved)
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class EmbeddingBatcher:
+    """Gathers the texts of concurrent embedding requests with the same key into shared upstream calls."""
+    instance: EmbeddingBatcher | None = None
+
+    def __init__(self, enabled: bool, window_seconds: float):
+        self.enabled = enabled
+        self.window_seconds = window_seconds
+        self._open: dict[Hashable, _Batch] = {}
+        self._running: set[asyncio.Task] = set()
+        self.batches = 0
+        self.batched_texts = 0
+
+    @classmethod
+    def get_instance(cls) -> EmbeddingBatcher:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.embedding_batching,
+                window_seconds=env.embedding_batch_window_seconds,
+            )
+            ProxyMetrics.get_instance().register_source('embedding_batcher', cls.instance.stats)
+        return cls.instance
+
+    async def embed(
+        self,
+        key: Hashable,
+        texts: list[str],
+        max_batch_size: int,
+        call: EmbedCall,
+    ) -> tuple[list[Embeddings], float]:
+        """The embeddings of `texts` and the tokens billed for them.
+
+        `call` embeds a list of texts; calls with equal keys must be interchangeable. A
+        batch is billed as a whole, so the tokens of each caller are its share by text length."""
+        if not self.enabled:
+            return await call(texts)
+        joined: list[tuple[_Batch, int]] = []
+        for text in texts:
+            batch = self._open.get(key)
+            if batch is None:
+                batch = self._open[key] = _Batch(call)
+                batch.timer = asyncio.get_running_loop().call_later(self.window_seconds, self._close, key, batch)
+            position = batch.positions.get(text)
+            if position is None:
+                position = batch.positions[text] = len(batch.texts)
+                batch.texts.append(text)
+                if len(batch.texts) >= max_batch_size:
+                    self._close(key, batch)
+            joined.append((batch, position))
+
+        results: dict[_Batch, tuple[list[Embeddings], float]] = {}
+        for batch, _ in joined:
+            if batch not in results:
+                # The batch serves other callers too: leaving must not cancel it.
+                results[batch] = await asyncio.shield(batch.future)
+        embeddings = [results[batch][0][position] for batch, position in joined]
+        tokens = sum(len(batch.texts[position]) * results[batch][1] for batch, position in joined)
+        return embeddings, tokens
+
+    def _close(self, key: Hashable, batch: _Batch) -> None:
+        if self._open.get(key) is batch:
+            del self._open[key]
+        batch.timer.cancel()
+        self.batches += 1
+        self.batched_texts += len(batch.texts)
+        ProxyMetrics.get_instance().observe('embedding_batch_size', len(batch.texts), buckets=_BATCH_SIZE_BUCKETS)
+        task = asyncio.create_task(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    @staticmethod
+    async def _run(batch: _Batch) -> None:
+        try:
+            embeddings, tokens = await batch.call(batch.texts)
+            if len(embeddings) != len(batch.texts):
+                raise ValueError(f"Upstream returned {len(embeddings)} embeddings for {len(batch.texts)} texts.")
+        except asyncio.CancelledError:
+            batch.future.cancel()
+            raise
+        except Exception as exp:
+            batch.future.set_exception(exp)
+        else:
+            # Tokens per character of the batch, for the callers' shares.
+            batch.future.set_result((embeddings, tokens / max(1, sum(len(text) for text in batch.texts))))
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            enabled=self.enabled,
+            window_seconds=self.window_seconds,
+            open_batches=len(self._open),
+            running_batches=len(self._running),
+            batches=self.batches,
+            batched_texts=self.batched_texts,
+        )
+
+
+async def embed_texts(
+    upstream: str,
+    scope: dict[str, Any],
+    texts: list[str],
+    call: EmbedCall,
+    x_proxy_cache: str | None = None,
+) -> tuple[list[Embeddings], float]:
+    """The embeddings of `texts`, cached ones first, and the tokens billed for those fetched.
+
+    `scope` is everything but the texts that the embeddings depend on (upstream,
+    tenant, model, parameters); it keys both the cache and the batches."""
+    cache = EmbeddingCache.get_instance()
+    use_cache = cache.enabled and not is_cache_bypassed(x_proxy_cache)
+    scope_bytes = dumps_canonical_bytes(scope)
+    keys = {
+        text: hashlib.sha256(scope_bytes + b'\0' + text.encode()).hexdigest()
+        for text in texts
+    } if use_cache else {}
+    found: dict[str, Embeddings] = {}
+    for text, key in keys.items():
+        hit = cache.get(key)
+        if hit is not None:
+            found[text] = hit
+
+    missing = [text for text in dict.fromkeys(texts) if text not in found]
+    tokens = 0.0
+    if missing:
+        fetched, tokens = await EmbeddingBatcher.get_instance().embed(
+            key=hashlib.sha256(scope_bytes).hexdigest(),
+            texts=missing,
+            max_batch_size=MAX_BATCH_SIZES[upstream],
+            call=call,
+        )
+        for text, embeddings in zip(missing, fetched):
+            found[text] = embeddings
+            if use_cache:
+                cache.put(keys[text], embeddings)
+    if keys:
+        ProxyMetrics.get_instance().increment('embedding_cache_hit_texts', len(texts) - len(missing), upstream=upstream)
+    return [found[text] for text in texts], tokens
+
+
+async def openai_create_embeddings(
+    request: OpenAIEmbeddingsRequest,
+    api_key: str | None = None,
+    base_url: str | None = None,
+    x_proxy_cache: str | None = None,
+    embedding_encoding: str | None = None,
+) -> dict[str, Any]:
+    async def call(inputs: list | None) -> tuple[list[Embeddings], float]:
+        batch_request = request.model_copy(update=dict(
+            input=request.input if inputs is None else inputs,
+            encoding_format="float",
+        ))
+        response = await call_balanced(
+            "openai",
+            lambda endpoint_url: openai_embeddings(request=batch_request, api_key=api_key, base_url=endpoint_url),
+        )
+        data = sorted(response.data, key=lambda item: item.index)
+        return [_pack(dict(float=item.embedding)) for item in data], float(response.usage.prompt_tokens)
+
+    inputs = [request.input] if isinstance(request.input, str) else request.input
+    if inputs and all(isinstance(item, str) for item in inputs):
+        embeddings, tokens = await embed_texts(
+            upstream="openai",
+            scope=dict(
+                upstream="openai",
+                base_url=base_url,
+                tenant=fingerprint_api_key(api_key),
+                body=request.model_dump(mode='json', exclude={'input', 'encoding_format'}, exclude_none=True),
+            ),
+            texts=inputs,
+            call=call,
+            x_proxy_cache=x_proxy_cache,
+        )
+    else:
+        # Token ids are sent as they are, in a call of their own.
+        embeddings, tokens = await call(None)
+
+    if embedding_encoding is None and request.encoding_format == "base64":
+        embedding_encoding = 'base64-float32'
+    return dict(
+        object="list",
+        data=[
+            dict(object="embedding", index=index, embedding=_unpack(item["float"], embedding_encoding))
+            for index, item in enumerate(embeddings)
+        ],
+        model=request.model,
+        usage=dict(prompt_tokens=round(tokens), total_tokens=round(tokens)),
+    )
+
+
+async def cohere_create_embeddings(
+    request: CohereEmbedV2Request,
+    api_key: str | None = None,
+    base_url: str | None = None,
+    x_proxy_cache: str | None = None,
+    embedding_encoding: str | None = None,
+) -> dict[str, Any]:
+    async def call(texts: list | None) -> tuple[list[Embeddings], float]:
+        batch_request = request if texts is None else request.model_copy(update=dict(texts=texts))
+        response = await call_balanced(
+            "cohere",
+            lambda endpoint_url: cohere_embed_v2(request=batch_request, api_key=api_key, base_url=endpoint_url),
+        )
+        by_type = response.embeddings.model_dump(by_alias=True, exclude_none=True)
+        count = max((len(vectors) for vectors in by_type.values()), default=0)
+        billed_units = response.meta.billed_units if response.meta is not None else None
+        tokens = float((billed_units.input_tokens if billed_units is not None else None) or 0)
+        return [_pack({kind: vectors[index] for kind, vectors in by_type.items()}) for index in range(count)], tokens
+
+    if request.texts and not (request.images or request.inputs):
+        embeddings, tokens = await embed_texts(
+            upstream="cohere",
+            scope=dict(
+                upstream="cohere",
+                base_url=base_url,
+                tenant=fingerprint_api_key(api_key),
+                body=request.model_dump(mode='json', exclude={'texts'}, exclude_none=True),
+            ),
+            texts=request.texts,
+            call=call,
+            x_proxy_cache=x_proxy_cache,
+        )
+    else:
+        # Images and mixed inputs are sent as they are, in a call of their own.
+        embeddings, tokens = await call(None)
+
+    kinds = list(embeddings[0]) if embeddings else list(request.embedding_types or ["float"])
+    return dict(
+        id=create_generation_id(),
+        embeddings={
+            kind: [_unpack(item[kind], embedding_encoding) for item in embeddings]
+            for kind in kinds
+        },
+        texts=request.texts or [],
+        meta=dict(api_version=dict(version="2"), billed_units=dict(input_tokens=round(tokens))),
+        response_type="embeddings_by_type",
+    )
@@ -15,6 +15,7 @@ from server.errors import (
     ConflictError,
     ForbiddenError,
     NotFoundError,
+    TooManyRequestsError,
     UnauthorizedError,
 )
 
@@ -25,6 +26,7 @@ HTTP_STATUS_TO_ERROR: Iterable[Tuple[Tuple[int, ...], Type[AppError]]] = (
     ((403,), ForbiddenError),
     ((404,), NotFoundError),
     ((409,), ConflictError),
+    ((429,), TooManyRequestsError),
 )
 
 
@@ -71,4 +73,5 @@ async def unified_exception_handler(request: Request, exc: Exception) -> JSONRes
     return JSONResponse(
         status_code=app_error.status_code,
         content=app_error.to_dict(),
+        headers=app_error.headers or None,
     )
@@ -22,7 +22,8 @@ class AppError(Exception):
         *,
         code: Optional[str] = None,
         status_code: Optional[int] = None,
-        extra: Optional[Dict[str, Any]] = None
+        extra: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None
     ) -> None:
         super().__init__(message)
         if code:
@@ -31,6 +32,7 @@ class AppError(Exception):
             self.status_code = status_code
         self.message = message or self.__class__.__name__
         self.extra = extra or {}
+        self.headers = headers or {}
         self.trace = traceback.format_exc()
 
     def to_dict(self) -> Dict[str, Any]:
@@ -63,3 +65,13 @@ class ForbiddenError(AppError):
 class ConflictError(AppError):
     code = "conflict"
     status_code = 409
+
+
+class TooManyRequestsError(AppError):
+    code = "rate_limited"
+    status_code = 429
+
+
+class UpstreamUnavailableError(AppError):
+    code = "upstream_unavailable"
+    status_code = 503
@@ -0,0 +1,230 @@
+"""
+Weighted fair scheduling of upstream slots across client applications.
+
+At most `FAIR_SCHEDULER_MAX_CONCURRENCY` chat requests are upstream at once.
+The others wait in one queue per client application (`X-Client-Name`), and
+the queues are served by deficit round robin: in every round a client earns
+`FAIR_SCHEDULER_QUANTUM_TOKENS` times its weight (`FAIR_SCHEDULER_WEIGHTS`),
+and spends the estimated tokens of the requests it sends. A client sending
+large batch requests therefore cannot starve one sending small interactive
+ones. The `priority` field of a request (lower is more urgent, as for Cohere)
+selects a priority class; a class is only served when the more urgent ones
+have nothing waiting.
+"""
+
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, TypeVar
+import asyncio
+import time
+
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+from resources.environment import Environment
+from server.common_service import ReleasingIterator
+from server.metrics import ProxyMetrics
+from server.rate_limiter import estimate_tokens
+
+
+T = TypeVar('T')
+
+ANONYMOUS_CLIENT = '-'
+
+
+def parse_weights(entries: list[str]) -> dict[str, float]:
+    """Parse `name:weight` entries."""
+    weights: dict[str, float] = {}
+    for entry in entries:
+        name, _, weight = entry.rpartition(':')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+@dataclass
+class _Waiter:
+    client: str
+    cost: int
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class _ClientQueue:
+    name: str
+    quantum: float
+    waiters: deque[_Waiter] = field(default_factory=deque)
+    deficit: float = 0.0
+    credited: bool = False
+
+
+class _PriorityClass:
+    def __init__(self):
+        # Clients with waiting requests, in round-robin order.
+        self.queues: dict[str, _ClientQueue] = {}
+        self.active: deque[_ClientQueue] = deque()
+
+    def _deactivate_head(self) -> None:
+        queue = self.active.popleft()
+        del self.queues[queue.name]
+
+    def next_waiter(self) -> _Waiter | None:
+        while self.active:
+            queue = self.active[0]
+            while queue.waiters and queue.waiters[0].future.done():  # cancelled while waiting
+                queue.waiters.popleft()
+            if not queue.waiters:
+                self._deactivate_head()
+                continue
+            if not queue.credited:
+                queue.deficit += queue.quantum
+                queue.credited = True
+            waiter = queue.waiters[0]
+            if waiter.cost > queue.deficit:
+                queue.credited = False
+                self.active.rotate(-1)
+                continue
+            queue.deficit -= waiter.cost
+            queue.waiters.popleft()
+            if not queue.waiters:
+                # An emptied queue keeps no deficit into its next busy period.
+                self._deactivate_head()
+            return waiter
+        return None
+
+
+class FairScheduler:
+    instance: FairScheduler | None = None
+
+    def __init__(
+        self,
+        enabled: bool,
+        max_concurrency: int,
+        quantum_tokens: float,
+        weights: dict[str, float],
+    ):
+        self.enabled = enabled
+        self.max_concurrency = max_concurrency
+        self.quantum_tokens = quantum_tokens
+        self.weights = weights
+        self.in_flight = 0
+        self.classes: dict[int, _PriorityClass] = {}
+
+    @classmethod
+    def get_instance(cls) -> FairScheduler:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.fair_scheduler,
+                max_concurrency=env.fair_scheduler_max_concurrency,
+                quantum_tokens=env.fair_scheduler_quantum_tokens,
+                weights=parse_weights(env.fair_scheduler_weights),
+            )
+            ProxyMetrics.get_instance().register_source('fair_scheduler', cls.instance.stats)
+        return cls.instance
+
+    def _queue_of(self, priority: int, client: str) -> _ClientQueue:
+        priority_class = self.classes.get(priority)
+        if priority_class is None:
+            priority_class = self.classes[priority] = _PriorityClass()
+        queue = priority_class.queues.get(client)
+        if queue is None:
+            queue = priority_class.queues[client] = _ClientQueue(
+                name=client, quantum=self.quantum_tokens * self.weights.get(client, 1.0),
+            )
+            priority_class.active.append(queue)
+        return queue
+
+    def _dispatch(self) -> None:
+        for priority in sorted(self.classes):
+            priority_class = self.classes[priority]
+            while self.in_flight < self.max_concurrency:
+                waiter = priority_class.next_waiter()
+                if waiter is None:
+                    break
+                self.in_flight += 1
+                waiter.future.set_result(None)
+            if not priority_class.active:
+                del self.classes[priority]
+            if self.in_flight >= self.max_concurrency:
+                return
+
+    async def acquire(self, client: str, priority: int, cost: int) -> None:
+        if self.in_flight < self.max_concurrency and not self.classes:
+            self.in_flight += 1
+            ProxyMetrics.get_instance().observe('fair_scheduler_wait_seconds', 0.0, client=client)
+            return
+        waiter = _Waiter(client=client, cost=cost, future=asyncio.get_running_loop().create_future())
+        self._queue_of(priority, client).waiters.append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # The slot was granted just as the caller went away.
+                self.release()
+            raise
+        ProxyMetrics.get_instance().observe(
+            'fair_scheduler_wait_seconds', time.monotonic() - waiter.enqueued_at, client=client,
+        )
+
+    def release(self, exc: BaseException | None = None) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def stats(self) -> dict[str, Any]:
+        depths: dict[str, int] = {}
+        for priority_class in self.classes.values():
+            for queue in priority_class.queues.values():
+                waiting = sum(not waiter.future.done() for waiter in queue.waiters)
+                if waiting:
+                    depths[queue.name] = depths.get(queue.name, 0) + waiting
+        return dict(
+            enabled=self.enabled,
+            max_concurrency=self.max_concurrency,
+            in_flight=self.in_flight,
+            queue_depth=depths,
+        )
+
+
+def _ticket(x_client_name: str | None, request: BaseModel) -> tuple[str, int, int]:
+    priority = getattr(request, 'priority', None)
+    return x_client_name or ANONYMOUS_CLIENT, 0 if priority is None else priority, estimate_tokens(request)
+
+
+async def call_scheduled(
+    x_client_name: str | None,
+    request: BaseModel,
+    call: Callable[[], Awaitable[T]],
+) -> T:
+    scheduler = FairScheduler.get_instance()
+    if not scheduler.enabled:
+        return await call()
+    await scheduler.acquire(*_ticket(x_client_name, request))
+    try:
+        return await call()
+    finally:
+        scheduler.release()
+
+
+async def stream_scheduled(
+    x_client_name: str | None,
+    request: BaseModel,
+    open_response: Callable[[], Awaitable[Response]],
+) -> Response:
+    """Like `call_scheduled`, but the slot is held until the stream is over."""
+    scheduler = FairScheduler.get_instance()
+    if not scheduler.enabled:
+        return await open_response()
+    await scheduler.acquire(*_ticket(x_client_name, request))
+    try:
+        response = await open_response()
+    except BaseException:
+        scheduler.release()
+        raise
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = ReleasingIterator(response.body_iterator, scheduler.release)
+    else:
+        scheduler.release()
+    return response
@@ -25,11 +25,12 @@ def show_result(func, to_show: Callable[[], bool] | None = None, exception_types
             # from traceback import print_exc; print_exc()
             if to_show() and (exception_types_to_omit_traceback is None or not isinstance(exp, exception_types_to_omit_traceback)):
                 if info:
-                    ic('raising exception', func.__name__, info, type(result), result)
+                    ic('raising exception', func.__name__, info, type(exp), exp)
                 else:
-                    ic('raising exception', func.__name__, type(result), result)
+                    ic('raising exception', func.__name__, type(exp), exp)
                 from traceback import print_exc; print_exc()
-            
+            raise
+
         if to_show is not None and to_show():
             if info:
                 ic(func.__name__, info, type(result), result)
@@ -54,10 +55,11 @@ def show_result(func, to_show: Callable[[], bool] | None = None, exception_types
             # from traceback import print_exc; print_exc()
             if to_show() and (exception_types_to_omit_traceback is None or not isinstance(exp, exception_types_to_omit_traceback)):
                 if info:
-                    ic('raising exception', func.__name__, info, type(result), result)
+                    ic('raising exception', func.__name__, info, type(exp), exp)
                 else:
-                    ic('raising exception', func.__name__, type(result), result)
+                    ic('raising exception', func.__name__, type(exp), exp)
                 from traceback import print_exc; print_exc()
+            raise
         if to_show is not None and to_show():
             if info:
                 ic(func.__name__, info, type(result), result)
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import hashlib
 import logging
 import uuid
 from logging import Logger, NOTSET
@@ -9,6 +10,13 @@ def create_generation_id() -> str:
     return str(uuid.uuid4())
 
 
+def fingerprint_api_key(api_key: str | None) -> str:
+    """Return a short, non-reversible fingerprint usable as a key for per-tenant state."""
+    if api_key is None:
+        return '-'
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
 class NullLogger(Logger):
     def __init__(self):
         super().__init__('null', level=NOTSET)
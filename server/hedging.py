@@ -0,0 +1,128 @@
+"""
+Hedged upstream requests.
+
+When the first chunk (or, for a non-stream call, the response) of a request
+has not arrived within the hedge delay, the same request is sent once more,
+preferably to another endpoint of the provider. Whichever attempt answers
+first is used and the other one is cancelled, which closes its upstream
+connection. The delay is `HEDGE_DELAY_SECONDS`, or, when that is 0, the
+`HEDGE_DELAY_PERCENTILE` of the recent time-to-first-token of the provider.
+
+Hedges are paid from a budget: every request earns `HEDGE_BUDGET_PERCENT`/100
+of a hedge, so at most that share of the traffic is duplicated.
+"""
+
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, TypeVar
+import asyncio
+
+from resources.environment import Environment
+from server.metrics import ProxyMetrics
+
+
+T = TypeVar('T')
+
+# Unused budget is capped so that a quiet period cannot buy a burst of hedges.
+_MAX_CREDITS = 10.0
+
+
+def _retrieve_outcome(task: asyncio.Future) -> None:
+    if not task.cancelled():
+        task.exception()
+
+
+class HedgePolicy:
+    instance: HedgePolicy | None = None
+
+    def __init__(self, enabled: bool, delay_seconds: float, delay_percentile: float, budget_percent: float):
+        self.enabled = enabled
+        self.delay_seconds = delay_seconds
+        self.delay_percentile = delay_percentile
+        self.budget_percent = budget_percent
+        self.credits = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.denied_by_budget = 0
+
+    @classmethod
+    def get_instance(cls) -> HedgePolicy:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.hedging,
+                delay_seconds=env.hedge_delay_seconds,
+                delay_percentile=env.hedge_delay_percentile,
+                budget_percent=env.hedge_budget_percent,
+            )
+            ProxyMetrics.get_instance().register_source('hedging', cls.instance.stats)
+        return cls.instance
+
+    def admit(self) -> None:
+        self.requests += 1
+        self.credits = min(_MAX_CREDITS, self.credits + self.budget_percent / 100)
+
+    def try_spend(self) -> bool:
+        if self.credits < 1:
+            self.denied_by_budget += 1
+            return False
+        self.credits -= 1
+        self.hedges += 1
+        return True
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            enabled=self.enabled,
+            requests=self.requests,
+            hedges=self.hedges,
+            hedge_wins=self.hedge_wins,
+            denied_by_budget=self.denied_by_budget,
+            budget_percent=self.budget_percent,
+        )
+
+
+async def run_hedged(
+    primary: Callable[[], Awaitable[T]],
+    hedge: Callable[[], Awaitable[T] | None],
+    delay: float | None,
+    discard: Callable[[T], Awaitable[None]],
+) -> T:
+    """Await `primary`; after `delay` also start `hedge` (within the budget) and return the first success.
+
+    `hedge` returns None when there is nowhere to send the duplicate; `discard`
+    disposes of a result that finished second.
+    """
+    policy = HedgePolicy.get_instance()
+    policy.admit()
+    if not policy.enabled or delay is None:
+        return await primary()
+
+    first = asyncio.ensure_future(primary())
+    pending: set[asyncio.Future] = {first}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done or not policy.try_spend():
+            return await first
+        second = hedge()
+        if second is None:
+            return await first
+        second = asyncio.ensure_future(second)
+        pending.add(second)
+        error: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                winner, *late = succeeded
+                for task in late:
+                    await discard(task.result())
+                if winner is second:
+                    policy.hedge_wins += 1
+                return winner.result()
+            if error is None:
+                error = next(iter(done)).exception()
+        raise error
+    finally:
+        for task in pending:
+            task.add_done_callback(_retrieve_outcome)
+            task.cancel()
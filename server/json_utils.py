@@ -0,0 +1,73 @@
+"""
+JSON encoding helpers used on the streaming hot path.
+
+orjson is used when it is installed (see the `speedups` extra); otherwise the
+standard library encoder produces the same compact, UTF-8 encoded output.
+"""
+
+from __future__ import annotations
+from typing import Any
+import importlib
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the installed extras
+    orjson = None
+
+
+def _dumps_bytes_stdlib(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _dumps_bytes_orjson(obj: Any) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+# Serialize an object to compact UTF-8 encoded JSON bytes.
+dumps_bytes = _dumps_bytes_orjson if orjson is not None else _dumps_bytes_stdlib
+
+
+def dumps_canonical_bytes(obj: Any) -> bytes:
+    """Serialize `obj` with sorted keys so that equal objects always give equal bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def to_dict(piece: Any) -> dict[str, Any]:
+    """Dump a streamed piece (pydantic model or dict) once, the way every stringifier expects it."""
+    if isinstance(piece, dict):
+        return piece
+    serializer = getattr(piece, '__pydantic_serializer__', None)
+    if serializer is not None:
+        # Same result as piece.model_dump(exclude_unset=True, exclude_none=True) minus the wrapper overhead.
+        return serializer.to_python(piece, exclude_unset=True, exclude_none=True, warnings=False)
+    if hasattr(piece, 'model_dump'):
+        return piece.model_dump(exclude_unset=True, exclude_none=True)
+    return {}
+
+
+def encode_response(value: tuple[Any, dict | None]) -> dict[str, Any]:
+    """Turn a `(response, additional_info)` pair into plain JSON data that `decode_response` restores."""
+    response, additional_info = value
+    response_type = type(response)
+    return dict(
+        type=f'{response_type.__module__}:{response_type.__qualname__}',
+        response=response.model_dump(mode='json', by_alias=True),
+        additional_info=additional_info,
+    )
+
+
+def decode_response(payload: dict[str, Any]) -> tuple[Any, dict | None]:
+    module_name, qualname = payload['type'].split(':', 1)
+    response_type: Any = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        response_type = getattr(response_type, name)
+    return response_type.model_validate(payload['response']), payload.get('additional_info')
@@ -0,0 +1,335 @@
+"""
+Latency-aware balancing of requests over interchangeable upstream endpoints.
+
+Every provider has a list of endpoints (`COHERE_URLS`, `OPENAI_URLS`; each entry
+is `url` or `url|weight`). A request goes to the endpoint with the lowest
+`(outstanding requests + 1) * EWMA time-to-first-token / weight`; endpoints
+without a measurement yet are tried first, and a call failing before its first
+token counts as a slow one. A non-stream call has no first token: it lasts as
+long as its output does, so it gives no latency sample, and only its success or
+failure counts. Endpoints whose circuit breaker is open are skipped
+(see `server.circuit_breaker`), and slow requests can be hedged on a second
+endpoint (see `server.hedging`).
+"""
+
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Literal, TypeVar
+import math
+import time
+
+from fastapi.responses import Response, StreamingResponse
+
+from resources.environment import Environment
+from server.circuit_breaker import CircuitBreaker, is_upstream_failure
+from server.common_service import ReleasingIterator, close_iterator_quietly
+from server.errors import UpstreamUnavailableError
+from server.hedging import HedgePolicy, run_hedged
+from server.metrics import ProxyMetrics
+
+
+T = TypeVar('T')
+
+UpstreamName = Literal["cohere", "openai", "anthropic"]
+
+_TTFT_SAMPLES = 256
+_MIN_TTFT_SAMPLES = 20
+# A failure without a first token counts as a time-to-first-token this many times the best endpoint's.
+_FAILURE_TTFT_PENALTY = 4.0
+
+
+def parse_endpoint(entry: str) -> tuple[str, float]:
+    url, _, weight = entry.partition('|')
+    return Environment._ensure_trailing_slash(url.strip()), float(weight) if weight.strip() else 1.0
+
+
+@dataclass
+class Endpoint:
+    url: str | None
+    weight: float = 1.0
+    outstanding: int = 0
+    requests: int = 0
+    errors: int = 0
+    ewma_ttft: float | None = None
+    last_ttft: float | None = None
+    breaker: CircuitBreaker | None = field(default=None, repr=False)
+
+    @property
+    def name(self) -> str:
+        return self.url or 'default'
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            weight=self.weight,
+            outstanding=self.outstanding,
+            requests=self.requests,
+            errors=self.errors,
+            ewma_ttft_ms=None if self.ewma_ttft is None else round(self.ewma_ttft * 1000, 1),
+            last_ttft_ms=None if self.last_ttft is None else round(self.last_ttft * 1000, 1),
+            circuit=None if self.breaker is None else self.breaker.stats(),
+        )
+
+
+class EndpointLease:
+    """One request on an endpoint, from the pick until the response (or stream) is over."""
+
+    def __init__(self, balancer: UpstreamBalancer, endpoint: Endpoint):
+        self.balancer = balancer
+        self.endpoint = endpoint
+        self.started = time.monotonic()
+        self.ttft: float | None = None
+        self.released = False
+        self.probe = endpoint.breaker.on_start()
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+
+    @property
+    def url(self) -> str | None:
+        return self.endpoint.url
+
+    def first_token(self) -> None:
+        self.ttft = time.monotonic() - self.started
+        self.balancer.observe_ttft(self.endpoint, self.ttft)
+
+    def release(self, exc: BaseException | None = None, timed: bool = True) -> None:
+        """`timed` is False for a non-stream call, whose duration is not a time-to-first-token."""
+        if self.released:
+            return
+        self.released = True
+        self.endpoint.outstanding -= 1
+        failed = exc is not None and is_upstream_failure(exc)
+        if failed:
+            self.endpoint.errors += 1
+            if self.ttft is None:
+                self.balancer.observe_failure(self.endpoint, time.monotonic() - self.started)
+        elif not timed and exc is None:
+            self.balancer.observe_success(self.endpoint)
+        self.endpoint.breaker.on_finish(
+            self.probe,
+            failed=failed,
+            latency=(
+                None if not timed else
+                self.ttft if self.ttft is not None else
+                time.monotonic() - self.started
+            ),
+        )
+
+
+class UpstreamBalancer:
+    def __init__(self, name: str, endpoints: list[Endpoint], ewma_alpha: float):
+        if not endpoints:
+            raise ValueError(f"No upstream endpoint configured for {name}.")
+        self.name = name
+        self.endpoints = endpoints
+        self.ewma_alpha = ewma_alpha
+        self._rotation = 0
+        self.recent_ttfts: deque[float] = deque(maxlen=_TTFT_SAMPLES)
+        for endpoint in endpoints:
+            if endpoint.breaker is None:
+                endpoint.breaker = CircuitBreaker.from_environment(name, endpoint.name)
+
+    @property
+    def primary_url(self) -> str | None:
+        return self.endpoints[0].url
+
+    def _default_ttft(self) -> float:
+        measured = [endpoint.ewma_ttft for endpoint in self.endpoints if endpoint.ewma_ttft]
+        return min(measured) if measured else 1.0
+
+    def _score(self, endpoint: Endpoint, default_ttft: float) -> float:
+        return (endpoint.outstanding + 1) * (endpoint.ewma_ttft or default_ttft) / endpoint.weight
+
+    def pick(self, exclude: Callable[[Endpoint], bool] | None = None) -> Endpoint | None:
+        candidates = [endpoint for endpoint in self.endpoints if exclude is None or not exclude(endpoint)]
+        if not candidates:
+            return None
+        unmeasured = [endpoint for endpoint in candidates if endpoint.ewma_ttft is None]
+        if unmeasured:
+            candidates = unmeasured
+        default_ttft = self._default_ttft()
+        # Rotate the starting point so that ties are spread instead of always hitting the first endpoint.
+        self._rotation = (self._rotation + 1) % len(candidates)
+        rotated = candidates[self._rotation:] + candidates[:self._rotation]
+        return min(rotated, key=lambda endpoint: self._score(endpoint, default_ttft))
+
+    def acquire(self, exclude: Callable[[Endpoint], bool] | None = None) -> EndpointLease:
+        """Lease the best endpoint whose circuit lets calls through, or fail fast."""
+        endpoint = self.pick(
+            lambda endpoint: not endpoint.breaker.is_available() or (exclude is not None and exclude(endpoint))
+        )
+        if endpoint is None:
+            ProxyMetrics.get_instance().increment('circuit_breaker_rejections', upstream=self.name)
+            retry_after = min(endpoint.breaker.retry_after() for endpoint in self.endpoints)
+            raise UpstreamUnavailableError(
+                f"No {self.name} endpoint is available; the circuit of every endpoint is open.",
+                extra=dict(upstream=self.name, retry_after_seconds=round(retry_after, 1)),
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+        return EndpointLease(self, endpoint)
+
+    def observe_ttft(self, endpoint: Endpoint, ttft: float) -> None:
+        self.recent_ttfts.append(ttft)
+        endpoint.last_ttft = ttft
+        self._update_ewma(endpoint, ttft)
+
+    def observe_failure(self, endpoint: Endpoint, elapsed: float) -> None:
+        """Count a call that failed before its first token as a slow one.
+
+        Otherwise an endpoint that only fails would stay unmeasured, and so preferred, forever.
+        Failures are kept out of the samples the hedging delay is taken from."""
+        self._update_ewma(endpoint, max(elapsed, self._default_ttft() * _FAILURE_TTFT_PENALTY))
+
+    def observe_success(self, endpoint: Endpoint) -> None:
+        """Count a successful non-stream call as a call as fast as the best endpoint's.
+
+        It has no time-to-first-token of its own; this only lets an endpoint recover from failure penalties."""
+        if endpoint.ewma_ttft is not None:
+            self._update_ewma(endpoint, self._default_ttft())
+
+    def _update_ewma(self, endpoint: Endpoint, ttft: float) -> None:
+        endpoint.ewma_ttft = (
+            ttft if endpoint.ewma_ttft is None else
+            self.ewma_alpha * ttft + (1 - self.ewma_alpha) * endpoint.ewma_ttft
+        )
+
+    def ttft_percentile(self, percentile: float) -> float | None:
+        """Percentile of the recent time-to-first-token over all endpoints; None while there are too few samples."""
+        if len(self.recent_ttfts) < _MIN_TTFT_SAMPLES:
+            return None
+        ordered = sorted(self.recent_ttfts)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def stats(self) -> dict[str, Any]:
+        return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
+
+
+class LoadBalancer:
+    instance: LoadBalancer | None = None
+
+    def __init__(self, balancers: dict[str, UpstreamBalancer]):
+        self.balancers = balancers
+
+    @classmethod
+    def get_instance(cls) -> LoadBalancer:
+        if cls.instance is None:
+            env = Environment.get_instance()
+
+            def endpoints(entries: list[str], fallback: str | None) -> list[Endpoint]:
+                if not entries:
+                    return [Endpoint(url=fallback)]
+                return [Endpoint(url=url, weight=weight) for url, weight in map(parse_endpoint, entries)]
+
+            cls.instance = cls({
+                "cohere": UpstreamBalancer(
+                    "cohere", endpoints(env.cohere_urls, env.cohere_url or "https://api.cohere.com/"), env.lb_ewma_alpha,
+                ),
+                "openai": UpstreamBalancer(
+                    "openai", endpoints(env.openai_urls, env.openai_url), env.lb_ewma_alpha,
+                ),
+                "anthropic": UpstreamBalancer(
+                    "anthropic", endpoints(env.anthropic_urls, env.anthropic_url), env.lb_ewma_alpha,
+                ),
+            })
+            ProxyMetrics.get_instance().register_source('upstreams', cls.instance.stats)
+        return cls.instance
+
+    def __getitem__(self, upstream: UpstreamName) -> UpstreamBalancer:
+        return self.balancers[upstream]
+
+    def stats(self) -> dict[str, Any]:
+        return {name: balancer.stats() for name, balancer in self.balancers.items()}
+
+
+def join_url(base_url: str | None, base_path: str) -> str | None:
+    if base_url is None or not base_path:
+        return base_url
+    return f'{base_url}{base_path}'
+
+
+def _hedge_target(balancer: UpstreamBalancer, primary: list[EndpointLease]) -> EndpointLease | None:
+    """Lease for a hedge: another endpoint if one is available, else another connection to the same one."""
+    for exclude in (lambda endpoint: endpoint is primary[0].endpoint, None):
+        try:
+            return balancer.acquire(exclude)
+        except UpstreamUnavailableError:
+            continue
+    return None
+
+
+async def _balanced(
+    upstream: UpstreamName,
+    attempt: Callable[[EndpointLease], Awaitable[T]],
+    discard: Callable[[T], Awaitable[None]],
+) -> T:
+    balancer = LoadBalancer.get_instance()[upstream]
+    policy = HedgePolicy.get_instance()
+    primary: list[EndpointLease] = []
+
+    def start_primary() -> Awaitable[T]:
+        primary.append(balancer.acquire())
+        return attempt(primary[0])
+
+    def start_hedge() -> Awaitable[T] | None:
+        lease = _hedge_target(balancer, primary) if primary else None
+        return None if lease is None else attempt(lease)
+
+    delay = policy.delay_seconds or balancer.ttft_percentile(policy.delay_percentile)
+    return await run_hedged(start_primary, start_hedge, delay=delay, discard=discard)
+
+
+async def _call_on(lease: EndpointLease, call: Callable[[str | None], Awaitable[T]], base_path: str) -> T:
+    try:
+        result = await call(join_url(lease.url, base_path))
+    except BaseException as exp:
+        lease.release(exp, timed=False)
+        raise
+    lease.release(timed=False)
+    return result
+
+
+async def _open_on(
+    lease: EndpointLease,
+    open_response: Callable[[str | None], Awaitable[Response]],
+    base_path: str,
+) -> Response:
+    try:
+        response = await open_response(join_url(lease.url, base_path))
+    except BaseException as exp:
+        lease.release(exp)
+        raise
+    lease.first_token()
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = ReleasingIterator(response.body_iterator, lease.release)
+    else:
+        lease.release()
+    return response
+
+
+async def _discard_response(response: Response) -> None:
+    if isinstance(response, StreamingResponse):
+        await close_iterator_quietly(response.body_iterator)
+
+
+async def _ignore(result: Any) -> None:
+    pass
+
+
+async def call_balanced(
+    upstream: UpstreamName,
+    call: Callable[[str | None], Awaitable[T]],
+    base_path: str = '',
+) -> T:
+    """Run a non-stream call against the best endpoint; only whether it failed is recorded, not its duration."""
+    return await _balanced(upstream, lambda lease: _call_on(lease, call, base_path), discard=_ignore)
+
+
+async def stream_balanced(
+    upstream: UpstreamName,
+    open_response: Callable[[str | None], Awaitable[Response]],
+    base_path: str = '',
+) -> Response:
+    """Open a stream on the best endpoint; the endpoint stays busy until the stream is over."""
+    return await _balanced(
+        upstream, lambda lease: _open_on(lease, open_response, base_path), discard=_discard_response,
+    )
@@ -0,0 +1,91 @@
+"""
+In-process metrics shared by the proxy components.
+"""
+
+from __future__ import annotations
+from typing import Any, Callable
+import bisect
+import threading
+
+
+# Upper bounds (seconds) of the default histogram buckets; an implicit +Inf bucket follows.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _render_name(name: str, labels: dict[str, Any]) -> str:
+    if not labels:
+        return name
+    rendered = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f'{name}{{{rendered}}}'
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict[str, Any]:
+        cumulative = 0
+        buckets: dict[str, int] = {}
+        for bound, count in zip([*map(str, self.buckets), '+Inf'], self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return dict(buckets=buckets, count=self.count, sum=self.sum)
+
+
+class ProxyMetrics:
+    """Counters, gauges, histograms and pluggable stat sources, exposed as one JSON snapshot."""
+    instance: ProxyMetrics | None = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.sources: dict[str, Callable[[], dict[str, Any]]] = {}
+
+    @classmethod
+    def get_instance(cls) -> ProxyMetrics:
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = _render_name(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        key = _render_name(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **labels: Any) -> None:
+        key = _render_name(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register_source(self, name: str, source: Callable[[], dict[str, Any]]) -> None:
+        """Register a callable whose result is embedded in every snapshot under `name`."""
+        self.sources[name] = source
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            result: dict[str, Any] = dict(
+                counters=dict(self.counters),
+                gauges=dict(self.gauges),
+                histograms={key: histogram.to_dict() for key, histogram in self.histograms.items()},
+            )
+        for name, source in list(self.sources.items()):
+            result[name] = source()
+        return result
@@ -1,12 +1,12 @@
 from __future__ import annotations
-from typing import Iterable, Literal, Iterator, TypeVar
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, Literal, Iterator, TypeVar
 from pydantic import BaseModel
 import logging
 from logging import Logger
 import sys
 import json
 # %%
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 from server.func_utils import show_result
 from server.payloads_openai import (
@@ -14,15 +14,24 @@ from server.payloads_openai import (
     openai_spec_types,
     openai_spec_chunk_types,
     OpenAIChatNonStreamingRequest,
-    OpenAIChatStreamingRequest
+    OpenAIChatStreamingRequest,
+    OpenAIEmbeddingsRequest,
 )
 from server.common_service import StreamingResponseHTTPExceptionDispatcher
+from server.delta_coalescing import TextDelta
+from server.json_utils import dumps_bytes
+from server.client_pool import UpstreamClientRegistry
+from server.adaptive_concurrency import AdaptiveConcurrencyLimiter
 from server.generic_service import create_generation_id
 from openai import APIError
+from openai.types import CreateEmbeddingResponse
 import server.payloads_openai as payloads
 from resources.environment import Environment
 from server.debug_utils import get_test_info_for_debug
 
+if TYPE_CHECKING:
+    from server.stream_cache import StreamRecorder
+
 load_dotenv()
 
 
@@ -86,38 +95,51 @@ E = TypeVar('E', bound=Exception)
 class StreamingResponseHTTPExceptionDispatcherForOpenAI(StreamingResponseHTTPExceptionDispatcher):
     def __init__(
         self,
-        response: Iterator[BaseModel | dict[str, ...]],
+        response: AsyncIterator[BaseModel | dict[str, ...]],
         exception_type_to_catch: type[E] = APIError,
         additional_strings: list[str] | None = None,
         log_to_info: bool = False,
+        first_chunk_timeout: float | None = None,
+        recorder: StreamRecorder | None = None,
     ):
         super().__init__(
             response=response,
             exception_type_to_catch=exception_type_to_catch,
             log_to_info=log_to_info,
             additional_strings=additional_strings,
+            first_chunk_timeout=first_chunk_timeout,
+            recorder=recorder,
         )
 
-    def _set_generation_id(self, piece: ...):
-        if hasattr(piece, 'model_dump'):
-            piece_dict = piece.model_dump(exclude_unset=True, exclude_none=True)
-        elif isinstance(piece, dict):
-            piece_dict = piece
-        else:
-            piece_dict = {}
-        if 'id' in piece_dict:
-            self.generation_id_in_stream_start = piece_dict.get('id') or ""
+    def _set_generation_id(self, piece: dict[str, ...]):
+        if 'id' in piece:
+            self.generation_id_in_stream_start = piece.get('id') or ""
 
     @staticmethod
-    def _stringify(a_dict: dict[str, ...]) -> str:
-        return f'data: {json.dumps(a_dict)}\n\n'
+    def _stringify(a_dict: dict[str, ...]) -> bytes:
+        return b"data: " + dumps_bytes(a_dict) + b"\n\n"
 
     # @staticmethod
     # def _stringify_proper(a_dict: dict[str, ...]) -> str:
     #     return f'data: {json.dumps(a_dict)}\n\n'
 
     def _detect_finishing(self, piece: dict[str, ...]) -> bool:
-        return piece.get('choices', {})[0].get('finish_reason')
+        return (piece.get('choices') or [{}])[0].get('finish_reason')
+
+    @staticmethod
+    def _text_delta(a_dict: dict[str, ...]) -> TextDelta | None:
+        choices = a_dict.get('choices')
+        if not choices or len(choices) != 1 or a_dict.get('usage') is not None:
+            return None
+        choice = choices[0]
+        if choice.get('finish_reason') is not None or choice.get('logprobs') is not None:
+            return None
+        delta = choice.get('delta') or {}
+        if not isinstance(delta.get('content'), str):
+            return None
+        if any(value is not None for key, value in delta.items() if key != 'content'):
+            return None
+        return (a_dict.get('id'), choice.get('index')), delta, 'content'
 
     def _create_intermediate_response(self, text: str) :
         data = openai_spec.ChatCompletionChunk(
@@ -137,7 +159,7 @@ class StreamingResponseHTTPExceptionDispatcherForOpenAI(StreamingResponseHTTPExc
         )
         return data
 
-def openai_chat_stream(
+async def openai_chat_stream(
     request: OpenAIChatStreamingRequest,
     api_key: str | None = None,
     x_client_name: str | None = None,
@@ -145,16 +167,27 @@ def openai_chat_stream(
     base_url: str | None = None,
     organization: str | None = None,
     project: str | None = None,
+    upstream: str = "openai",
     # ) -> openai_spec.ChatCompletion:
-) -> tuple[openai_spec.Stream[openai_spec.ChatCompletionChunk], dict | None]:
+) -> tuple[openai_spec.AsyncStream[openai_spec.ChatCompletionChunk], dict | None]:
 
-    client = OpenAI(api_key=api_key, base_url=base_url, organization=organization, project=project)
+    client: AsyncOpenAI = UpstreamClientRegistry.get_instance().get_client(
+        "openai", api_key=api_key, base_url=base_url, organization=organization, project=project,
+    )
 
     opts = request.model_dump(exclude_defaults=True, exclude_none=True, exclude_unset=True)
-    reqponse_iterator: openai_spec.Stream[openai_spec.ChatCompletionChunk] = \
-        client.chat.completions.create(
-            **opts,
-        )
+    # The SDK sends the request here, so the slot is taken before and handed over to the stream.
+    limiter = AdaptiveConcurrencyLimiter.get_instance(upstream)
+    slot = await limiter.acquire("stream")
+    try:
+        reqponse_iterator: openai_spec.AsyncStream[openai_spec.ChatCompletionChunk] = \
+            await client.chat.completions.create(
+                **opts,
+            )
+    except BaseException as exp:
+        slot.release(exp)
+        raise
+    reqponse_iterator = limiter.stream(reqponse_iterator, slot=slot)
 
     additional_info = (
         get_test_info_for_debug()
@@ -165,7 +198,7 @@ def openai_chat_stream(
 
 
 @show_result
-def openai_chat_non_stream(
+async def openai_chat_non_stream(
     request: OpenAIChatNonStreamingRequest,
     api_key: str | None = None,
     x_client_name: str | None = None,
@@ -173,14 +206,19 @@ def openai_chat_non_stream(
     base_url: str | None = None,
     organization: str | None = None,
     project: str | None = None,
+    upstream: str = "openai",
 ) -> tuple[openai_spec.ChatCompletion, dict | None]:
 
-    client = OpenAI(api_key=api_key, base_url=base_url, organization=organization, project=project)
+    client: AsyncOpenAI = UpstreamClientRegistry.get_instance().get_client(
+        "openai", api_key=api_key, base_url=base_url, organization=organization, project=project,
+    )
 
     opts = request.model_dump(exclude_defaults=True, exclude_none=True, exclude_unset=True)
     response = \
-        client.chat.completions.create(
-            **opts,
+        await AdaptiveConcurrencyLimiter.get_instance(upstream).call(
+            lambda: client.chat.completions.create(
+                **opts,
+            )
         )
     # from icecream import ic; ic('openai_chat_non_stream', type(response))
     additional_info = (
@@ -191,6 +229,23 @@ def openai_chat_non_stream(
     return response, additional_info
 
 
+async def openai_embeddings(
+    request: OpenAIEmbeddingsRequest,
+    api_key: str | None = None,
+    base_url: str | None = None,
+    upstream: str = "openai",
+) -> CreateEmbeddingResponse:
+
+    client: AsyncOpenAI = UpstreamClientRegistry.get_instance().get_client(
+        "openai", api_key=api_key, base_url=base_url,
+    )
+
+    opts = request.model_dump(exclude_defaults=True, exclude_none=True, exclude_unset=True)
+    return await AdaptiveConcurrencyLimiter.get_instance(upstream).call(
+        lambda: client.embeddings.create(**opts)
+    )
+
+
 def generate_openai_style_response_json_strings(
     chunked_message: Iterable[str],
     generation_id: str | None = None,
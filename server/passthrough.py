@@ -0,0 +1,269 @@
+"""
+Zero-copy forwarding of upstream SSE streams for same-protocol routes.
+
+When the client and the upstream speak the same protocol (Cohere v2 to Cohere v2,
+OpenAI to OpenAI), the upstream bytes are forwarded as they arrive. The stream is
+only split at event boundaries while looking for the event before which the
+additional texts have to be injected; afterwards, and when there is nothing to
+inject at all, it is pure byte forwarding.
+"""
+
+from __future__ import annotations
+from typing import Any, AsyncIterator, Literal
+import asyncio
+import re
+
+import httpx
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from resources.environment import Environment
+from server.client_pool import UpstreamClientRegistry
+from server.cohere_service import StreamingResponseHTTPExceptionDispatcherForCohere, omit_none_values
+from server.debug_utils import get_test_info_for_debug
+from server.common_service import CommonServiceLogger
+from server.json_utils import dumps_bytes, loads
+from server.openai_service import StreamingResponseHTTPExceptionDispatcherForOpenAI
+from server.payloads_cohere import CohereChatV2Request
+from server.payloads_openai import OpenAIChatStreamingRequest
+from server.stream_cache import StreamRecorder
+
+
+PassthroughProtocol = Literal["cohere_v2", "openai"]
+
+_EVENT_BOUNDARY = re.compile(rb'\r?\n\r?\n')
+_FINISHING_EVENT: dict[str, re.Pattern[bytes]] = {
+    "cohere_v2": re.compile(rb'"type"\s*:\s*"content-end"'),
+    "openai": re.compile(rb'"finish_reason"\s*:\s*"'),
+}
+_OPENAI_CHUNK_ID = re.compile(rb'"id"\s*:\s*"([^"]*)"')
+
+# Request fields understood by the OpenAI SDK only; they never go over the wire as is.
+OPENAI_SDK_ONLY_FIELDS = ('extra_headers', 'extra_query', 'extra_body', 'timeout')
+
+
+class SSEPassthroughForwarder:
+    def __init__(
+        self,
+        protocol: PassthroughProtocol,
+        url: str,
+        body: dict[str, Any],
+        api_key: str | None,
+        additional_strings: list[str] | None = None,
+        extra_headers: dict[str, str] | None = None,
+        first_chunk_timeout: float | None = None,
+        recorder: StreamRecorder | None = None,
+    ):
+        self.protocol = protocol
+        self.url = url
+        self.body = body
+        self.api_key = api_key
+        self.additional_strings = additional_strings or []
+        self.extra_headers = extra_headers or {}
+        self.first_chunk_timeout = (
+            first_chunk_timeout if first_chunk_timeout is not None else
+            Environment.get_instance().first_chunk_timeout_seconds
+        )
+        self.generation_id: str = ""
+        self.recorder = recorder
+
+    def _headers(self) -> dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+            # Raw bytes are forwarded, so they must not be content-encoded.
+            "Accept-Encoding": "identity",
+            **self.extra_headers,
+        }
+
+    async def _open(self) -> tuple[httpx.Response, AsyncIterator[bytes]]:
+        """Send the request and read the first chunk of the body, both within `first_chunk_timeout`;
+        return the response and its raw body, first chunk included."""
+        http_client = UpstreamClientRegistry.get_instance().get_http_client_for_url(self.url)
+        request = http_client.build_request(
+            "POST", self.url, content=dumps_bytes(self.body), headers=self._headers(),
+        )
+        opened: list[httpx.Response] = []
+
+        async def send_and_read_first_chunk() -> tuple[httpx.Response, AsyncIterator[bytes]]:
+            response = await http_client.send(request, stream=True)
+            opened.append(response)
+            raw = response.aiter_raw()
+            if response.status_code >= 400:
+                return response, raw
+            first_chunk = await anext(raw, b'')
+            return response, _prepend(first_chunk, raw)
+
+        try:
+            response, chunks = await asyncio.wait_for(send_and_read_first_chunk(), timeout=self.first_chunk_timeout)
+        except BaseException as exp:
+            if opened:
+                await opened[0].aclose()
+            if isinstance(exp, asyncio.TimeoutError):
+                raise HTTPException(
+                    status_code=504,
+                    detail=f"Upstream did not send the first chunk within {self.first_chunk_timeout} seconds.",
+                )
+            raise
+        if response.status_code >= 400:
+            try:
+                content = await response.aread()
+            finally:
+                await response.aclose()
+            raise HTTPException(status_code=response.status_code, detail=self._extract_message(content))
+        return response, chunks
+
+    @staticmethod
+    def _extract_message(content: bytes) -> str:
+        try:
+            body = loads(content)
+        except ValueError:
+            return content.decode('utf-8', errors='replace') or 'An error occurred.'
+        if isinstance(body, dict):
+            error = body.get('error')
+            if isinstance(error, dict) and 'message' in error:
+                return str(error['message'])
+            return str(body.get('message', 'An error occurred.'))
+        return str(body)
+
+    def _render_additional_events(self) -> bytes:
+        if self.protocol == "cohere_v2":
+            return b''.join(
+                StreamingResponseHTTPExceptionDispatcherForCohere._stringify_v2(
+                    StreamingResponseHTTPExceptionDispatcherForCohere._create_intermediate_response_v2(text).model_dump(
+                        exclude_unset=True, exclude_none=True,
+                    )
+                )
+                for text in self.additional_strings
+            )
+        return b''.join(
+            StreamingResponseHTTPExceptionDispatcherForOpenAI._stringify(dict(
+                id=self.generation_id,
+                object="chat.completion.chunk",
+                choices=[dict(delta=dict(content=text), finish_reason=None, index=0)],
+                created=0,
+                model="",
+            ))
+            for text in self.additional_strings
+        )
+
+    async def _forward(self, response: httpx.Response, raw: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        recorder = self.recorder
+        chunks = self._forward_raw(response, raw)
+        try:
+            async for chunk in chunks:
+                if recorder is not None:
+                    recorder.append(chunk)
+                yield chunk
+        finally:
+            # Also runs when the client went away: closes the upstream response right away.
+            await chunks.aclose()
+        if recorder is not None:
+            recorder.commit()
+
+    async def _forward_raw(self, response: httpx.Response, raw: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        try:
+            if self.additional_strings:
+                pending = b''
+                finishing = _FINISHING_EVENT[self.protocol]
+                injected = False
+                async for chunk in raw:
+                    out, injected, pending = self._scan_events(pending + chunk, finishing)
+                    if out:
+                        yield out
+                    if injected:
+                        break
+                if not injected:
+                    if pending:
+                        yield pending
+                    return
+            async for chunk in raw:
+                yield chunk
+        finally:
+            await response.aclose()
+
+    def _scan_events(self, pending: bytes, finishing: re.Pattern[bytes]) -> tuple[bytes, bool, bytes]:
+        """Split `pending` at complete events; return what to emit, whether the injection happened,
+        and the bytes still waiting for their event boundary."""
+        out = []
+        start = 0
+        for boundary in _EVENT_BOUNDARY.finditer(pending):
+            event = pending[start:boundary.end()]
+            if not self.generation_id and self.protocol == "openai":
+                found = _OPENAI_CHUNK_ID.search(event)
+                if found is not None:
+                    self.generation_id = found.group(1).decode('utf-8', errors='replace')
+            if finishing.search(event):
+                out.append(self._render_additional_events())
+                out.append(pending[start:])
+                return b''.join(out), True, b''
+            out.append(event)
+            start = boundary.end()
+        return b''.join(out), False, pending[start:]
+
+    async def get_StreamingResponse_or_raise_HTTPException(self) -> StreamingResponse:
+        response, raw = await self._open()
+        CommonServiceLogger.get_instance().debug(f"Passthrough stream opened: {self.url}")
+        return StreamingResponse(
+            self._forward(response, raw),
+            status_code=response.status_code,
+            media_type=response.headers.get('content-type', 'text/event-stream'),
+        )
+
+
+async def _prepend(first_chunk: bytes, rest: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    if first_chunk:
+        yield first_chunk
+    async for chunk in rest:
+        yield chunk
+
+
+def cohere_chat_v2_stream_passthrough(
+    request: CohereChatV2Request,
+    api_key: str | None = None,
+    x_client_name: str | None = None,
+    base_url: str | None = None,
+) -> tuple[SSEPassthroughForwarder, dict | None]:
+    base_url = Environment._ensure_trailing_slash(
+        base_url or Environment.get_instance().cohere_url or "https://api.cohere.com/"
+    )
+    forwarder = SSEPassthroughForwarder(
+        protocol="cohere_v2",
+        url=f'{base_url}v2/chat',
+        body={**omit_none_values(request, keys_to_exclude=('stream',)), "stream": True},
+        api_key=api_key,
+        extra_headers={"X-Client-Name": x_client_name} if x_client_name else None,
+    )
+    additional_info = (
+        get_test_info_for_debug()
+        if Environment.get_instance().debug_append_test_info else
+        None
+    )
+    return forwarder, additional_info
+
+
+def openai_chat_stream_passthrough(
+    request: OpenAIChatStreamingRequest,
+    api_key: str | None = None,
+    x_client_name: str | None = None,
+    base_url: str | None = None,
+) -> tuple[SSEPassthroughForwarder, dict | None]:
+    base_url = Environment._ensure_trailing_slash(base_url or "https://api.openai.com/v1/")
+    opts = request.model_dump(mode='json', exclude_defaults=True, exclude_none=True, exclude_unset=True)
+    body = {key: value for key, value in opts.items() if key not in OPENAI_SDK_ONLY_FIELDS}
+    body.update(opts.get('extra_body') or {})
+    body["stream"] = True
+    forwarder = SSEPassthroughForwarder(
+        protocol="openai",
+        url=f'{base_url}chat/completions',
+        body=body,
+        api_key=api_key,
+        extra_headers={key: value for key, value in (opts.get('extra_headers') or {}).items() if value is not None},
+    )
+    additional_info = (
+        get_test_info_for_debug()
+        if Environment.get_instance().debug_append_test_info else
+        None
+    )
+    return forwarder, additional_info
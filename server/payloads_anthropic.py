@@ -0,0 +1,42 @@
+from pydantic import BaseModel, ConfigDict, field_serializer, field_validator
+from typing import Iterable, Union, Optional, Literal
+import anthropic.resources.messages.messages as anthropic_spec
+import server.compatible_types as compat_spec
+from server.payloads_openai import materialize_iterables
+
+
+class AnthropicMessagesNonStreamingRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    max_tokens: int
+    messages: Iterable[anthropic_spec.MessageParam]
+    model: anthropic_spec.ModelParam
+    inference_geo: Optional[str] = None
+    metadata: Optional[anthropic_spec.MetadataParam] = None
+    output_config: Optional[anthropic_spec.OutputConfigParam] = None
+    service_tier: Optional[Literal["auto", "standard_only"]] = None
+    stop_sequences: Optional[list[str]] = None
+    stream: Optional[Literal[False]] = None
+    system: Union[str, Iterable[anthropic_spec.TextBlockParam], None] = None
+    temperature: Optional[float] = None
+    thinking: Optional[anthropic_spec.ThinkingConfigParam] = None
+    tool_choice: Optional[anthropic_spec.ToolChoiceParam] = None
+    tools: Iterable[anthropic_spec.ToolUnionParam] = None
+    top_k: Optional[int] = None
+    top_p: Optional[float] = None
+    # Use the following arguments if you need to pass additional parameters to the API that aren't available via kwargs.
+    # The extra values given here take precedence over values defined on the client or passed to this method.
+    extra_headers: Optional[compat_spec.OpenAIHeaders | None] = None
+    extra_query: Optional[anthropic_spec.Query | None] = None
+    extra_body: Optional[anthropic_spec.Body | None] = None
+    timeout: float | compat_spec.Httpx_Timeout | None = None
+
+    _materialize_iterables = field_validator('messages', 'system', 'tools', mode='after')(
+        lambda value: materialize_iterables(value)
+    )
+    _serialize_materialized = field_serializer('messages', 'system', 'tools')(
+        lambda self, value: value
+    )
+
+
+class AnthropicMessagesStreamingRequest(AnthropicMessagesNonStreamingRequest):
+    stream: Literal[True]
@@ -147,3 +147,35 @@ class CohereChatV2Response(BaseModel):
     message: dict
     usage: Optional[dict] = None
     logprobs: Optional[list[dict]] = None
+
+
+class CohereEmbedV2Request(BaseModel):
+    """request for embedding with Cohere's embed API V2
+
+    See https://docs.cohere.com/v2/reference/embed for details.
+    """
+    model_config = ConfigDict(extra="ignore")
+    model: str
+    input_type: Optional[Union[Literal["search_document", "search_query", "classification", "clustering", "image"], Any]] = None
+    texts: Optional[list[str]] = None
+    images: Optional[list[str]] = None
+    inputs: Optional[list[dict]] = None  # actual element type is EmbedInput
+    max_tokens: Optional[int] = None
+    output_dimension: Optional[int] = None
+    embedding_types: Optional[list[Literal["float", "int8", "uint8", "binary", "ubinary", "base64"]]] = None
+    truncate: Optional[Literal["NONE", "START", "END"]] = None
+    priority: Optional[int] = None
+
+
+class CohereRerankV2Request(BaseModel):
+    """request for reranking with Cohere's rerank API V2
+
+    See https://docs.cohere.com/v2/reference/rerank for details.
+    """
+    model_config = ConfigDict(extra="ignore")
+    model: str
+    query: str
+    documents: list[str]
+    top_n: Optional[int] = None
+    max_tokens_per_doc: Optional[int] = None
+    priority: Optional[int] = None
@@ -1,11 +1,22 @@
-from pydantic import BaseModel, Field, ConfigDict
-from typing import Iterable, Union, Optional, Dict, List, Literal, Sequence
+from pydantic import BaseModel, Field, ConfigDict, field_serializer, field_validator
+from collections.abc import Iterator
+from typing import Any, Iterable, Union, Optional, Dict, List, Literal, Sequence
 import openai.resources.chat.completions.completions as openai_spec
 import openai.types.chat.chat_completion as openai_spec_types
 import openai.types.chat.chat_completion_chunk as openai_spec_chunk_types
 import server.compatible_types as compat_spec
 
 
+def materialize_iterables(value: Any) -> Any:
+    """Turn the one-shot iterators pydantic creates for `Iterable` fields into lists, recursively,
+    so that a request can be dumped more than once (e.g. to fingerprint it and to send it)."""
+    if isinstance(value, dict):
+        return {key: materialize_iterables(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, Iterator)):
+        return [materialize_iterables(item) for item in value]
+    return value
+
+
 class OpenAIChatNonStreamingRequest(BaseModel):
     model_config = ConfigDict(extra="ignore")
     messages: Iterable[openai_spec.ChatCompletionMessageParam]
@@ -50,6 +61,13 @@ class OpenAIChatNonStreamingRequest(BaseModel):
     extra_body: Optional[openai_spec.Body | None] = None
     timeout: float | compat_spec.Httpx_Timeout | None = None
 
+    _materialize_iterables = field_validator('messages', 'functions', 'tools', mode='after')(
+        lambda value: materialize_iterables(value)
+    )
+    _serialize_materialized = field_serializer('messages', 'functions', 'tools')(
+        lambda self, value: value
+    )
+
 
 class OpenAIChatStreamingRequest(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -95,6 +113,26 @@ class OpenAIChatStreamingRequest(BaseModel):
     extra_body: Optional[openai_spec.Body | None] = None
     timeout: float | compat_spec.Httpx_Timeout | None = None
 
+    _materialize_iterables = field_validator('messages', 'functions', 'tools', mode='after')(
+        lambda value: materialize_iterables(value)
+    )
+    _serialize_materialized = field_serializer('messages', 'functions', 'tools')(
+        lambda self, value: value
+    )
+
+
+class OpenAIEmbeddingsRequest(BaseModel):
+    """request for creating embeddings with OpenAI's embeddings API
+
+    See https://platform.openai.com/docs/api-reference/embeddings/create for details.
+    """
+    model_config = ConfigDict(extra="ignore")
+    input: Union[str, List[str], List[int], List[List[int]]]
+    model: str
+    dimensions: Optional[int] = None
+    encoding_format: Optional[Literal["float", "base64"]] = None
+    user: Optional[str] = None
+
 
 # Original: openai.typees.chat.chat_completion.Choice
 class Choice(BaseModel):
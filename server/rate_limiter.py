@@ -0,0 +1,206 @@
+"""
+Per-tenant, per-model rate limiting of chat requests.
+
+Every (API key, model) pair has two token buckets: requests per second and
+estimated tokens per minute. A request takes what it needs from both, letting
+them go negative, and then waits until they are back at zero. This makes the
+waiting requests a FIFO queue without any queue object: the wait of a request
+is known when it arrives. A request that would wait longer than
+`RATE_LIMIT_MAX_WAIT_SECONDS`, or that finds `RATE_LIMIT_QUEUE_SIZE` requests
+of its pair already waiting, is rejected right away with 429 and `Retry-After`,
+before anything is reserved or scheduled.
+
+The check runs in the route handler, so the body of a rejected request has
+already been read and validated; the model it is keyed on is in that body.
+What the check avoids is serializing the request once more: the tokens are
+first bounded from the `Content-Length` of the body, and the request is only
+serialized for the proper estimate once it is admitted, the bucket then being
+settled with it.
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Any
+import asyncio
+import math
+import time
+
+from pydantic import BaseModel
+
+from resources.environment import Environment
+from server.errors import TooManyRequestsError
+from server.generic_service import fingerprint_api_key
+from server.json_utils import dumps_bytes
+from server.metrics import ProxyMetrics
+
+
+# Rough size of a token in bytes of request JSON.
+_BYTES_PER_TOKEN = 4
+
+
+def estimate_tokens(request: BaseModel) -> int:
+    """Prompt tokens guessed from the size of the request plus the completion tokens it allows."""
+    body = request.model_dump(mode='json', exclude_none=True)
+    completion = body.get('max_completion_tokens') or body.get('max_tokens') or 0
+    return len(dumps_bytes(body)) // _BYTES_PER_TOKEN + int(completion)
+
+
+def bound_tokens(request: BaseModel, content_length: int) -> int:
+    """Like `estimate_tokens`, from the size of the raw body instead of a serialization of the request."""
+    completion = getattr(request, 'max_completion_tokens', None) or getattr(request, 'max_tokens', None) or 0
+    return content_length // _BYTES_PER_TOKEN + int(completion)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until `amount` can be taken, given the reservations made so far."""
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+
+class _Limits:
+    def __init__(self, requests: TokenBucket, tokens: TokenBucket | None):
+        self.requests = requests
+        self.tokens = tokens
+        self.waiting = 0
+
+
+class RateLimiter:
+    instance: RateLimiter | None = None
+
+    def __init__(
+        self,
+        enabled: bool,
+        requests_per_second: float,
+        burst: float,
+        tokens_per_minute: float,
+        queue_size: int,
+        max_wait_seconds: float,
+        max_keys: int,
+    ):
+        self.enabled = enabled
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.tokens_per_minute = tokens_per_minute
+        self.queue_size = queue_size
+        self.max_wait_seconds = max_wait_seconds
+        self.max_keys = max_keys
+        self._limits: OrderedDict[tuple[str, str], _Limits] = OrderedDict()
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected = 0
+
+    @classmethod
+    def get_instance(cls) -> RateLimiter:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.rate_limit,
+                requests_per_second=env.rate_limit_requests_per_second,
+                burst=env.rate_limit_burst,
+                tokens_per_minute=env.rate_limit_tokens_per_minute,
+                queue_size=env.rate_limit_queue_size,
+                max_wait_seconds=env.rate_limit_max_wait_seconds,
+                max_keys=env.rate_limit_max_keys,
+            )
+            ProxyMetrics.get_instance().register_source('rate_limiter', cls.instance.stats)
+        return cls.instance
+
+    def _get_limits(self, key: tuple[str, str]) -> _Limits:
+        limits = self._limits.get(key)
+        if limits is not None:
+            self._limits.move_to_end(key)
+            return limits
+        limits = _Limits(
+            requests=TokenBucket(self.requests_per_second, max(1.0, self.burst)),
+            tokens=TokenBucket(self.tokens_per_minute / 60, self.tokens_per_minute) if self.tokens_per_minute else None,
+        )
+        self._limits[key] = limits
+        # Idle pairs are forgotten first; a forgotten pair simply starts again with full buckets.
+        while len(self._limits) > self.max_keys:
+            oldest_key, oldest = next(iter(self._limits.items()))
+            if oldest.waiting:
+                break
+            del self._limits[oldest_key]
+        return limits
+
+    def _reject(self, reason: str, retry_after: float) -> TooManyRequestsError:
+        self.rejected += 1
+        ProxyMetrics.get_instance().increment('rate_limit_rejections', reason=reason)
+        seconds = max(1, math.ceil(retry_after))
+        return TooManyRequestsError(
+            f"Rate limit exceeded ({reason}); retry after {seconds} second(s).",
+            extra=dict(reason=reason, retry_after_seconds=seconds),
+            headers={"Retry-After": str(seconds)},
+        )
+
+    async def admit(
+        self,
+        api_key: str | None,
+        model: str | None,
+        request: BaseModel,
+        content_length: int | None = None,
+    ) -> None:
+        """Return once the request may go upstream; raise `TooManyRequestsError` when it may not soon enough.
+
+        `content_length` is the size of the request body, when known.
+        """
+        if not self.enabled:
+            return
+        limits = self._get_limits((fingerprint_api_key(api_key), model or '-'))
+        now = time.monotonic()
+        limits.requests.refill(now)
+        wait = limits.requests.wait_for(1)
+        amount = 0
+        if limits.tokens is not None:
+            limits.tokens.refill(now)
+            estimate = estimate_tokens(request) if content_length is None else bound_tokens(request, content_length)
+            amount = min(estimate, limits.tokens.capacity)
+            wait = max(wait, limits.tokens.wait_for(amount))
+        if wait > 0 and limits.waiting >= self.queue_size:
+            raise self._reject("queue_full", wait)
+        if wait > self.max_wait_seconds:
+            raise self._reject("wait_too_long", wait)
+
+        limits.requests.tokens -= 1
+        if limits.tokens is not None:
+            limits.tokens.tokens -= amount
+            if content_length is not None:
+                # Admitted on the bound; settle with the proper estimate.
+                settled = min(estimate_tokens(request), limits.tokens.capacity)
+                limits.tokens.tokens += amount - settled
+                amount = settled
+        self.admitted += 1
+        if wait <= 0:
+            return
+        self.delayed += 1
+        limits.waiting += 1
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # The client is gone; give its reservation back to the ones behind it.
+            limits.requests.tokens += 1
+            if limits.tokens is not None:
+                limits.tokens.tokens += amount
+            raise
+        finally:
+            limits.waiting -= 1
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            enabled=self.enabled,
+            tracked_keys=len(self._limits),
+            waiting=sum(limits.waiting for limits in self._limits.values()),
+            admitted=self.admitted,
+            delayed=self.delayed,
+            rejected=self.rejected,
+        )
@@ -0,0 +1,104 @@
+"""
+Rerank with a per-document score cache.
+
+Retrieval pipelines rerank mostly the same documents for the same queries.
+With `RERANK_CACHE`, the relevance score of every (query, document) pair is
+kept under the hash of the query, the document and the parameters that
+affect the score (model, `max_tokens_per_doc`, tenant). A `/v2/rerank`
+request then sends only the documents without a cached score upstream, asking
+for all of their scores, and the results are merged back: sorted by score,
+indexed by the caller's document positions and cut to the caller's `top_n`.
+"""
+
+from __future__ import annotations
+from typing import Any
+import hashlib
+
+from resources.environment import Environment
+from server.cohere_service import cohere_rerank_v2
+from server.generic_service import create_generation_id, fingerprint_api_key
+from server.json_utils import dumps_canonical_bytes
+from server.load_balancer import call_balanced
+from server.metrics import ProxyMetrics
+from server.payloads_cohere import CohereRerankV2Request
+from server.response_cache import ResponseCache, is_cache_bypassed
+
+
+class RerankCache(ResponseCache):
+    """LRU/TTL cache of the relevance scores of (query, document) pairs."""
+    instance: RerankCache | None = None
+
+    @classmethod
+    def get_instance(cls) -> RerankCache:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.rerank_cache,
+                max_entries=env.rerank_cache_max_entries,
+                ttl_seconds=env.rerank_cache_ttl_seconds,
+            )
+            ProxyMetrics.get_instance().register_source('rerank_cache', cls.instance.stats)
+        return cls.instance
+
+    def _copy_value(self, value: float) -> float:
+        return value
+
+
+async def cohere_rerank(
+    request: CohereRerankV2Request,
+    api_key: str | None = None,
+    base_url: str | None = None,
+    x_proxy_cache: str | None = None,
+) -> dict[str, Any]:
+    async def call(batch_request: CohereRerankV2Request) -> dict[str, Any]:
+        response = await call_balanced(
+            "cohere",
+            lambda endpoint_url: cohere_rerank_v2(request=batch_request, api_key=api_key, base_url=endpoint_url),
+        )
+        return response.model_dump(exclude_none=True)
+
+    cache = RerankCache.get_instance()
+    if not cache.enabled or is_cache_bypassed(x_proxy_cache) or not request.documents:
+        return await call(request)
+
+    scope = dumps_canonical_bytes(dict(
+        upstream="cohere",
+        base_url=base_url,
+        tenant=fingerprint_api_key(api_key),
+        model=request.model,
+        max_tokens_per_doc=request.max_tokens_per_doc,
+        query=hashlib.sha256(request.query.encode()).hexdigest(),
+    ))
+    keys = {
+        document: hashlib.sha256(scope + b'\0' + hashlib.sha256(document.encode()).digest()).hexdigest()
+        for document in request.documents
+    }
+    scores: dict[str, float] = {}
+    for document, key in keys.items():
+        score = cache.get(key)
+        if score is not None:
+            scores[document] = score
+
+    missing = [document for document in keys if document not in scores]
+    meta: dict[str, Any] = dict(api_version=dict(version="2"), billed_units=dict(search_units=0))
+    response_id = create_generation_id()
+    if missing:
+        # Every score is needed for the merge: top_n applies to the merged results only.
+        response = await call(request.model_copy(update=dict(documents=missing, top_n=None)))
+        for result in response.get('results', []):
+            document = missing[result['index']]
+            scores[document] = result['relevance_score']
+            cache.put(keys[document], result['relevance_score'])
+        meta = response.get('meta') or meta
+        response_id = response.get('id') or response_id
+    ProxyMetrics.get_instance().increment('rerank_cache_hit_documents', len(request.documents) - len(missing))
+
+    # Ties keep the caller's order, as the upstream does.
+    ranked = sorted(range(len(request.documents)), key=lambda index: -scores[request.documents[index]])
+    if request.top_n is not None:
+        ranked = ranked[:request.top_n]
+    return dict(
+        id=response_id,
+        results=[dict(index=index, relevance_score=scores[request.documents[index]]) for index in ranked],
+        meta=meta,
+    )
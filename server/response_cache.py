@@ -0,0 +1,190 @@
+"""
+Exact-match cache of non-stream chat responses for deterministic requests.
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, TypeVar
+import copy
+import hashlib
+import time
+
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from resources.environment import Environment
+from server.disk_cache import DiskCache
+from server.generic_service import fingerprint_api_key
+from server.json_utils import dumps_canonical_bytes
+from server.metrics import ProxyMetrics
+from server.semantic_cache import SemanticCache
+
+
+T = TypeVar('T')
+
+# Values of the `X-Proxy-Cache` request header that make a request skip every proxy-side cache.
+CACHE_BYPASS_VALUES = ('bypass', 'no-cache', 'no-store', 'off')
+
+
+def is_cache_bypassed(x_proxy_cache: str | None) -> bool:
+    return x_proxy_cache is not None and x_proxy_cache.strip().lower() in CACHE_BYPASS_VALUES
+
+
+def is_deterministic_request(request: BaseModel) -> bool:
+    """A request is worth caching when it asks for greedy decoding or pins the sampling seed."""
+    return getattr(request, 'temperature', None) == 0 or getattr(request, 'seed', None) is not None
+
+
+def canonical_request_key(
+    route: str,
+    request: BaseModel,
+    api_key: str | None,
+    base_url: str | None = None,
+) -> str:
+    """Fingerprint of a request: key order normalized, defaults stripped, scoped to the tenant's API key."""
+    body = request.model_dump(mode='json', exclude_defaults=True, exclude_none=True)
+    canonical = dumps_canonical_bytes(dict(
+        route=route,
+        base_url=base_url,
+        tenant=fingerprint_api_key(api_key),
+        body=body,
+    ))
+    return hashlib.sha256(canonical).hexdigest()
+
+
+def copy_response(value: T) -> T:
+    """Callers mutate responses (e.g. to append additional texts), so every hit gets its own copy."""
+    if isinstance(value, tuple):
+        return tuple(copy_response(item) for item in value)
+    if isinstance(value, BaseModel):
+        return value.model_copy(deep=True)
+    return copy.deepcopy(value)
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    expires_at: float
+
+
+class ResponseCache:
+    """Size-bounded LRU cache whose entries expire after their own TTL."""
+    instance: ResponseCache | None = None
+
+    def __init__(self, enabled: bool, max_entries: int, ttl_seconds: float):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @classmethod
+    def get_instance(cls) -> ResponseCache:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.response_cache,
+                max_entries=env.response_cache_max_entries,
+                ttl_seconds=env.response_cache_ttl_seconds,
+            )
+            ProxyMetrics.get_instance().register_source('response_cache', cls.instance.stats)
+        return cls.instance
+
+    def get(self, key: str) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            self._discard(key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._copy_value(entry.value)
+
+    def put(self, key: str, value: Any, ttl_seconds: float | None = None) -> None:
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._discard(key)
+        self._entries[key] = CacheEntry(value=self._copy_value(value), expires_at=time.monotonic() + ttl_seconds)
+        self._on_stored(self._entries[key].value)
+        while len(self._entries) > self.max_entries or self._is_over_capacity():
+            _, entry = self._entries.popitem(last=False)
+            self._on_removed(entry.value)
+            self.evictions += 1
+
+    def _discard(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._on_removed(entry.value)
+
+    # Hooks for caches of immutable or size-accounted values.
+    def _copy_value(self, value: Any) -> Any:
+        return copy_response(value)
+
+    def _on_stored(self, value: Any) -> None:
+        pass
+
+    def _on_removed(self, value: Any) -> None:
+        pass
+
+    def _is_over_capacity(self) -> bool:
+        return False
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            enabled=self.enabled,
+            entries=len(self._entries),
+            max_entries=self.max_entries,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
+
+
+async def call_with_response_cache(
+    route: str,
+    request: BaseModel,
+    api_key: str | None,
+    call: Callable[[], Awaitable[T]],
+    base_url: str | None = None,
+    x_proxy_cache: str | None = None,
+) -> T:
+    """Serve a non-stream call from the exact-match cache, its disk tier, then the semantic cache,
+    and fill them with the upstream result on a miss."""
+    if is_cache_bypassed(x_proxy_cache):
+        return await call()
+    cache = ResponseCache.get_instance()
+    disk_cache = DiskCache.get_instance()
+    key = None
+    if (cache.enabled or disk_cache.enabled) and is_deterministic_request(request):
+        key = canonical_request_key(route=route, request=request, api_key=api_key, base_url=base_url)
+        cached = cache.get(key) if cache.enabled else None
+        if cached is not None:
+            return cached
+        cached = disk_cache.get(key) if disk_cache.enabled else None
+        if cached is not None:
+            if cache.enabled:
+                cache.put(key, cached)
+            return cached
+    semantic_cache = SemanticCache.get_instance()
+    semantic_token = None
+    if semantic_cache.enabled:
+        cached, semantic_token = await semantic_cache.lookup(route=route, request=request, api_key=api_key, base_url=base_url)
+        if cached is not None:
+            if key is not None and cache.enabled:
+                cache.put(key, cached)
+            return cached
+    result = await call()
+    if key is not None:
+        if cache.enabled:
+            cache.put(key, result)
+        if disk_cache.enabled:
+            await run_in_threadpool(disk_cache.put, key, result)
+    await semantic_cache.store(semantic_token, result)
+    return result
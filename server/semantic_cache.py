@@ -0,0 +1,377 @@
+"""
+Semantic cache of non-stream chat responses.
+
+The last user message of a request is embedded and looked up by cosine
+similarity among the past prompts sharing everything else with it (route,
+tenant, model, parameters and the preceding conversation). Embeddings are
+stored as float16 or int8 rows of a NumPy matrix which, when a snapshot path
+is configured, is a memory-mapped `.npy` file, so a restart keeps the cache warm.
+
+Needs the `semantic-cache` extra (numpy and sentence-transformers).
+"""
+
+from __future__ import annotations
+from pathlib import Path
+from typing import Any, Literal, Protocol
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from resources.environment import Environment
+from server.generic_service import fingerprint_api_key
+from server.json_utils import decode_response, dumps_canonical_bytes, encode_response
+from server.metrics import ProxyMetrics
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depends on the installed extras
+    np = None
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # pragma: no cover - depends on the installed extras
+    SentenceTransformer = None
+
+
+StorageDType = Literal["float16", "int8"]
+
+_INT8_SCALE = 127.0
+
+
+class SemanticCacheLogger(logging.Logger):
+    instance: SemanticCacheLogger | None = None
+
+    def __init__(self):
+        super().__init__(__name__, level=logging.INFO)
+        logging.basicConfig(
+            stream=sys.stdout,
+            level=logging.INFO,
+        )
+
+    @classmethod
+    def get_instance(cls) -> SemanticCacheLogger:
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+
+def _text_of(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return '\n'.join(
+            part.get('text', '') for part in content
+            if isinstance(part, dict) and part.get('type', 'text') == 'text'
+        )
+    return ''
+
+
+def split_last_user_message(request: BaseModel) -> tuple[str | None, dict[str, Any]]:
+    """Return the last user message of a chat request and the request body without it."""
+    body = request.model_dump(mode='json', exclude_defaults=True, exclude_none=True)
+    if isinstance(body.get('message'), str):  # Cohere v1
+        return body.pop('message'), body
+    messages = body.get('messages') or []
+    for index in range(len(messages) - 1, -1, -1):
+        message = messages[index]
+        if isinstance(message, dict) and message.get('role') == 'user':
+            body['messages'] = messages[:index] + [dict(message, content=None)] + messages[index + 1:]
+            return _text_of(message.get('content')), body
+    return None, body
+
+
+def semantic_scope(route: str, body: dict[str, Any], api_key: str | None, base_url: str | None) -> int:
+    canonical = dumps_canonical_bytes(dict(
+        route=route,
+        base_url=base_url,
+        tenant=fingerprint_api_key(api_key),
+        body=body,
+    ))
+    return int.from_bytes(hashlib.sha256(canonical).digest()[:8], 'little')
+
+
+class Embedder(Protocol):
+    dimension: int
+
+    async def embed(self, text: str) -> Any:
+        ...
+
+
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name: str):
+        if SentenceTransformer is None:
+            raise ImportError("sentence-transformers is required; install the `semantic-cache` extra.")
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name)
+        self.dimension: int = self.model.get_sentence_embedding_dimension()
+
+    async def embed(self, text: str) -> Any:
+        return await run_in_threadpool(
+            self.model.encode,
+            text,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+
+
+class VectorIndex:
+    """Fixed-capacity matrix of normalized embeddings with LRU replacement of rows."""
+    VECTORS_FILE = 'vectors.npy'
+    META_FILE = 'entries.json'
+
+    def __init__(self, dimension: int, capacity: int, dtype: StorageDType, path: Path | None = None, model_name: str = ''):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"Invalid storage dtype: {dtype}. Expected 'float16' or 'int8'.")
+        self.dimension = dimension
+        self.capacity = capacity
+        self.dtype = dtype
+        self.path = path
+        self.model_name = model_name
+        self.scopes = np.zeros(capacity, dtype=np.uint64)
+        self.used = np.zeros(capacity, dtype=bool)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.payloads: list[dict[str, Any] | None] = [None] * capacity
+        self.evictions = 0
+        self.vectors = self._open_vectors()
+
+    def _open_vectors(self):
+        if self.path is None:
+            return np.zeros((self.capacity, self.dimension), dtype=self.dtype)
+        self.path.mkdir(parents=True, exist_ok=True)
+        vectors_path = self.path / self.VECTORS_FILE
+        if vectors_path.exists() and self._restore_meta():
+            vectors = np.load(vectors_path, mmap_mode='r+')
+            if vectors.shape == (self.capacity, self.dimension) and vectors.dtype == np.dtype(self.dtype):
+                return vectors
+            self._reset()
+        return np.lib.format.open_memmap(
+            vectors_path, mode='w+', dtype=self.dtype, shape=(self.capacity, self.dimension),
+        )
+
+    def _reset(self) -> None:
+        self.scopes[:] = 0
+        self.used[:] = False
+        self.last_used[:] = 0
+        self.payloads = [None] * self.capacity
+
+    def _restore_meta(self) -> bool:
+        meta_path = self.path / self.META_FILE
+        try:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return False
+        if (meta.get('dimension'), meta.get('capacity'), meta.get('dtype'), meta.get('model')) != (
+            self.dimension, self.capacity, self.dtype, self.model_name,
+        ):
+            return False
+        for entry in meta.get('entries', []):
+            row = entry['row']
+            self.scopes[row] = entry['scope']
+            self.used[row] = True
+            self.last_used[row] = entry['last_used']
+            self.payloads[row] = entry['payload']
+        return True
+
+    def snapshot_meta(self) -> dict[str, Any]:
+        """Row metadata to pass to `save`; taken on the event loop so that it is consistent."""
+        return dict(
+            dimension=self.dimension,
+            capacity=self.capacity,
+            dtype=self.dtype,
+            model=self.model_name,
+            entries=[
+                dict(row=int(row), scope=int(self.scopes[row]), last_used=float(self.last_used[row]), payload=self.payloads[row])
+                for row in np.flatnonzero(self.used)
+            ],
+        )
+
+    def save(self, meta: dict[str, Any]) -> None:
+        """Flush the vectors and write `meta`; blocking, so run it in the threadpool."""
+        if self.path is None:
+            return
+        self.vectors.flush()
+        meta_path = self.path / self.META_FILE
+        temporary_path = meta_path.with_suffix('.tmp')
+        temporary_path.write_text(json.dumps(meta, ensure_ascii=False), encoding='utf-8')
+        os.replace(temporary_path, meta_path)
+
+    def _quantize(self, vector):
+        if self.dtype == "int8":
+            return np.clip(np.rint(vector * _INT8_SCALE), -_INT8_SCALE, _INT8_SCALE).astype(np.int8)
+        return vector.astype(np.float16)
+
+    def search(self, scope: int, query) -> tuple[int, float] | None:
+        rows = np.flatnonzero(self.used & (self.scopes == np.uint64(scope)))
+        if rows.size == 0:
+            return None
+        scores = self.vectors[rows].astype(np.float32) @ query.astype(np.float32)
+        if self.dtype == "int8":
+            scores /= _INT8_SCALE
+        best = int(np.argmax(scores))
+        return int(rows[best]), float(scores[best])
+
+    def add(self, scope: int, vector, payload: dict[str, Any]) -> int:
+        free = np.flatnonzero(~self.used)
+        if free.size:
+            row = int(free[0])
+        else:
+            row = int(np.argmin(self.last_used))
+            self.evictions += 1
+        self.vectors[row] = self._quantize(vector)
+        self.scopes[row] = np.uint64(scope)
+        self.used[row] = True
+        self.last_used[row] = time.time()
+        self.payloads[row] = payload
+        return row
+
+    def touch(self, row: int) -> None:
+        self.last_used[row] = time.time()
+
+    def __len__(self) -> int:
+        return int(self.used.sum())
+
+
+class SemanticCache:
+    instance: SemanticCache | None = None
+
+    def __init__(
+        self,
+        enabled: bool,
+        threshold: float,
+        capacity: int,
+        dtype: StorageDType,
+        path: Path | None,
+        snapshot_every: int,
+        model_name: str,
+        embedder: Embedder | None = None,
+    ):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.capacity = capacity
+        self.dtype = dtype
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.model_name = model_name
+        self._embedder = embedder
+        self._index: VectorIndex | None = None
+        self._index_lock = asyncio.Lock()
+        self._stores_since_snapshot = 0
+        self._snapshot_running = False
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @classmethod
+    def get_instance(cls) -> SemanticCache:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            enabled = env.semantic_cache
+            if enabled and (np is None or SentenceTransformer is None):
+                SemanticCacheLogger.get_instance().warning(
+                    "SEMANTIC_CACHE is enabled but numpy or sentence-transformers is missing; "
+                    "install the `semantic-cache` extra. The semantic cache stays disabled."
+                )
+                enabled = False
+            cls.instance = cls(
+                enabled=enabled,
+                threshold=env.semantic_cache_threshold,
+                capacity=env.semantic_cache_capacity,
+                dtype=env.semantic_cache_dtype,
+                path=env.semantic_cache_path,
+                snapshot_every=env.semantic_cache_snapshot_every,
+                model_name=env.semantic_cache_model,
+            )
+            ProxyMetrics.get_instance().register_source('semantic_cache', cls.instance.stats)
+        return cls.instance
+
+    def _load_index(self) -> tuple[Embedder, VectorIndex]:
+        embedder = self._embedder or SentenceTransformerEmbedder(self.model_name)
+        index = VectorIndex(
+            dimension=embedder.dimension,
+            capacity=self.capacity,
+            dtype=self.dtype,
+            path=self.path,
+            model_name=self.model_name,
+        )
+        return embedder, index
+
+    async def _get_index(self) -> tuple[Embedder, VectorIndex]:
+        # Loading the model and opening the snapshot block for seconds: keep them off the event loop.
+        async with self._index_lock:
+            if self._index is None:
+                self._embedder, self._index = await run_in_threadpool(self._load_index)
+        return self._embedder, self._index
+
+    async def load(self) -> None:
+        """Load the model and the index ahead of the first request."""
+        if self.enabled:
+            await self._get_index()
+
+    async def _prepare(self, route: str, request: BaseModel, api_key: str | None, base_url: str | None):
+        text, body = split_last_user_message(request)
+        if not text:
+            return None
+        embedder, index = await self._get_index()
+        return index, semantic_scope(route, body, api_key, base_url), await embedder.embed(text)
+
+    async def lookup(
+        self,
+        route: str,
+        request: BaseModel,
+        api_key: str | None,
+        base_url: str | None = None,
+    ) -> tuple[tuple[BaseModel, dict | None] | None, Any]:
+        """Return the cached value (or None) and a token to pass to `store` on a miss."""
+        prepared = await self._prepare(route, request, api_key, base_url)
+        if prepared is None:
+            return None, None
+        index, scope, query = prepared
+        found = index.search(scope, query)
+        if found is not None and found[1] >= self.threshold:
+            row, _ = found
+            self.hits += 1
+            index.touch(row)
+            return decode_response(index.payloads[row]), None
+        self.misses += 1
+        return None, prepared
+
+    async def store(self, token: Any, value: tuple[BaseModel, dict | None]) -> None:
+        if token is None:
+            return
+        index, scope, vector = token
+        index.add(scope, vector, encode_response(value))
+        self.stores += 1
+        self._stores_since_snapshot += 1
+        if self._stores_since_snapshot >= self.snapshot_every and not self._snapshot_running:
+            await self.snapshot()
+
+    async def snapshot(self) -> None:
+        if self._index is None:
+            return
+        self._snapshot_running = True
+        self._stores_since_snapshot = 0
+        try:
+            await run_in_threadpool(self._index.save, self._index.snapshot_meta())
+        finally:
+            self._snapshot_running = False
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            enabled=self.enabled,
+            entries=0 if self._index is None else len(self._index),
+            capacity=self.capacity,
+            dtype=self.dtype,
+            threshold=self.threshold,
+            hits=self.hits,
+            misses=self.misses,
+            stores=self.stores,
+            evictions=0 if self._index is None else self._index.evictions,
+        )
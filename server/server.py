@@ -1,4 +1,5 @@
 from typing import Iterable, Union
+from contextlib import asynccontextmanager
 import asyncio
 import threading
 import os
@@ -12,6 +13,8 @@ from server.payloads_cohere import (
     # CohereChatV1Response,
     CohereChatV2Request,
     CohereChatV2Response,
+    CohereEmbedV2Request,
+    CohereRerankV2Request,
 )
 from server.error_utils import unified_exception_handler
 from server.cohere_service import (
@@ -24,23 +27,72 @@ from server.cohere_service import (
     StreamingResponseHTTPExceptionDispatcherForCohere,
     create_generation_id,
     cohere,
+    ApiError,
 )
 from resources.environment import Environment
 from server.openai_service import (
     openai_spec,
+    APIError,
     OpenAIChatNonStreamingRequest,
     OpenAIChatStreamingRequest,
+    OpenAIEmbeddingsRequest,
     openai_chat_stream,
     openai_chat_non_stream,
     generate_openai_style_response_json_strings,
     StreamingResponseHTTPExceptionDispatcherForOpenAI,
 )
+from server.payloads_anthropic import (
+    AnthropicMessagesNonStreamingRequest,
+    AnthropicMessagesStreamingRequest,
+)
+from server.anthropic_service import (
+    anthropic_messages_stream,
+    anthropic_messages_non_stream,
+    append_text,
+    StreamingResponseHTTPExceptionDispatcherForAnthropic,
+)
+from server.cohere_translation import (
+    can_bridge_v1,
+    cohere_chat_v1_non_stream_via_v2,
+    cohere_chat_v1_stream_via_v2,
+    openai_chat_non_stream_via_cohere_v2,
+    openai_chat_stream_via_cohere_v2,
+)
 import server.compatible_types as compat_spec
 from server import payloads_openai
 from server.func_utils import show_result_with_control
+from server.client_pool import UpstreamClientRegistry
+from server.metrics import ProxyMetrics
+from server.passthrough import cohere_chat_v2_stream_passthrough, openai_chat_stream_passthrough
+from server.response_cache import call_with_response_cache
+from server.stream_cache import lookup_stream, replay_StreamingResponse
+from server.single_flight import call_coalesced, stream_coalesced
+from server.semantic_cache import SemanticCache
+from server.load_balancer import UpstreamName, call_balanced, stream_balanced
+from server.rate_limiter import RateLimiter
+from server.fair_scheduler import call_scheduled, stream_scheduled
+from server.disconnect import CancelOnDisconnectMiddleware
+from server.stream_buffer import buffer_stream
+from server.compression import CompressionMiddleware
+from server.embeddings import cohere_create_embeddings, openai_create_embeddings, parse_embedding_encoding
+from server.rerank import cohere_rerank
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    UpstreamClientRegistry.get_instance()
+    await SemanticCache.get_instance().load()
+    yield
+    await SemanticCache.get_instance().snapshot()
+    await UpstreamClientRegistry.get_instance().aclose()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 app.add_exception_handler(Exception, unified_exception_handler)
+if Environment.get_instance().cancel_on_disconnect:
+    app.add_middleware(CancelOnDisconnectMiddleware)
+if Environment.get_instance().compression:
+    app.add_middleware(CompressionMiddleware)
 
 
 async def get_session_str():
@@ -83,17 +135,27 @@ async def compatibility_v1_chat_completions(
     authorization: str | None = Header(None),
     accepts: str = Header("text/event-stream"),
     x_client_name: str | None = Header(None),
+    x_proxy_cache: str | None = Header(None),
+    content_length: int | None = Header(None),
+    x_proxy_replay: str | None = Header(None),
 ) -> openai_spec.Stream[openai_spec.ChatCompletionChunk] | openai_spec.ChatCompletion:
     base_url = Environment._ensure_trailing_slash(
         Environment.get_instance().cohere_url or "https://api.cohere.com/"
     )
     
+    via_cohere_v2 = Environment.get_instance().compatibility_via_v2
     result = await openai_chat_completions(
         request=request,
         authorization=authorization,
         accepts=accepts,
         x_client_name=x_client_name,
-        base_url=f'{base_url}compatibility/v1',
+        x_proxy_cache=x_proxy_cache,
+        content_length=content_length,
+        x_proxy_replay=x_proxy_replay,
+        base_url=f'{base_url}v2' if via_cohere_v2 else f'{base_url}compatibility/v1',
+        upstream="cohere",
+        base_path='' if via_cohere_v2 else "compatibility/v1",
+        via_cohere_v2=via_cohere_v2,
     )
     if request.stream:
         return result
@@ -125,6 +187,9 @@ async def v1_chat_completions(
     authorization: str | None = Header(None),
     accepts: str = Header("text/event-stream"),
     x_client_name: str | None = Header(None),
+    x_proxy_cache: str | None = Header(None),
+    content_length: int | None = Header(None),
+    x_proxy_replay: str | None = Header(None),
     base_url: str | None = None,
 ) -> openai_spec.Stream[openai_spec.ChatCompletionChunk] | openai_spec.ChatCompletion:
     result = await openai_chat_completions(
@@ -132,6 +197,9 @@ async def v1_chat_completions(
         authorization=authorization,
         accepts=accepts,
         x_client_name=x_client_name,
+        x_proxy_cache=x_proxy_cache,
+        content_length=content_length,
+        x_proxy_replay=x_proxy_replay,
         base_url=Environment.get_instance().openai_url,
     )
     if request.stream:
@@ -147,6 +215,12 @@ async def openai_chat_completions(
     authorization: str | None = Header(None),
     accepts: str = Header("text/event-stream"),
     x_client_name: str | None = Header(None),
+    x_proxy_cache: str | None = Header(None),
+    content_length: int | None = Header(None),
+    x_proxy_replay: str | None = Header(None),
+    upstream: UpstreamName = "openai",
+    base_path: str = '',
+    via_cohere_v2: bool = False,
 # ) -> openai_spec.Stream[openai_spec.ChatCompletionChunk] | payloads_openai.ChatCompletion:
 ) -> openai_spec.Stream[openai_spec.ChatCompletionChunk] | openai_spec.ChatCompletion:
     if authorization is not None and authorization.lower().startswith("bearer "):
@@ -162,20 +236,64 @@ async def openai_chat_completions(
     else:
         api_key = 'invalid_key'
 
-    if request.stream:
-        try:
-            stream, additional_info = openai_chat_stream(
+    await RateLimiter.get_instance().admit(
+        api_key=api_key, model=request.model, request=request, content_length=content_length,
+    )
+
+    recorded, recorder = lookup_stream(
+        route="openai_chat",
+        request=request,
+        api_key=api_key,
+        base_url=base_url,
+        x_proxy_cache=x_proxy_cache,
+    ) if request.stream else (None, None)
+    if recorded is not None:
+        return replay_StreamingResponse(recorded, x_proxy_replay=x_proxy_replay)
+
+    async def open_stream(endpoint_url: str | None) -> StreamingResponse:
+        # Hedged attempts must not write into the same recording: each gets its own.
+        attempt_recorder = recorder.for_attempt() if recorder is not None else None
+        if not via_cohere_v2 and Environment.get_instance().passthrough_same_protocol:
+            forwarder, additional_info = openai_chat_stream_passthrough(
                 request=request,
                 api_key=api_key,
                 x_client_name=x_client_name,
-                accepts=accepts,
-                base_url=base_url,
+                base_url=endpoint_url,
+            )
+            forwarder.recorder = attempt_recorder
+            forwarder.additional_strings = await prepend_zwsp_to_each_lines(
+                await make_additional_texts(additional_info)
             )
+            return await forwarder.get_StreamingResponse_or_raise_HTTPException()
+        try:
+            if via_cohere_v2:
+                stream, additional_info = await openai_chat_stream_via_cohere_v2(
+                    request=request,
+                    api_key=api_key,
+                    x_client_name=x_client_name,
+                    accepts=accepts,
+                    base_url=endpoint_url,
+                )
+            else:
+                stream, additional_info = await openai_chat_stream(
+                    request=request,
+                    api_key=api_key,
+                    x_client_name=x_client_name,
+                    accepts=accepts,
+                    base_url=endpoint_url,
+                    upstream=upstream,
+                )
             additional_texts = await prepend_zwsp_to_each_lines(
                 await make_additional_texts(additional_info)
             )
-            dispatcher = StreamingResponseHTTPExceptionDispatcherForOpenAI(response=stream, additional_strings=additional_texts)
-            return dispatcher.get_StreamingResponse_or_raise_HTTPException()
+            # The translated stream is made of OpenAI chunks, but fails with the errors of the Cohere SDK.
+            dispatcher = StreamingResponseHTTPExceptionDispatcherForOpenAI(
+                response=stream,
+                exception_type_to_catch=ApiError if via_cohere_v2 else APIError,
+                additional_strings=additional_texts,
+                recorder=attempt_recorder,
+            )
+            return await dispatcher.get_StreamingResponse_or_raise_HTTPException()
         except Exception as exp:  # TODO: should shrink the range from general Exception
             if 'block' not in exp.__class__.__name__.lower():
                 raise
@@ -198,14 +316,55 @@ async def openai_chat_completions(
                     ),
                     media_type="text/event-stream",
                 )
+
+    if request.stream:
+        return buffer_stream("openai_chat", await stream_coalesced(
+            route="openai_chat",
+            request=request,
+            api_key=api_key,
+            base_url=base_url,
+            x_proxy_cache=x_proxy_cache,
+            open_response=lambda: stream_scheduled(
+                x_client_name, request, lambda: stream_balanced(upstream, open_stream, base_path=base_path),
+            ),
+        ))
     else:
         try:
-            response, additional_info = openai_chat_non_stream(
+            response, additional_info = await call_with_response_cache(
+                route="openai_chat",
                 request=request,
                 api_key=api_key,
-                x_client_name=x_client_name,
-                accepts=accepts,
                 base_url=base_url,
+                x_proxy_cache=x_proxy_cache,
+                call=lambda: call_coalesced(
+                    route="openai_chat",
+                    request=request,
+                    api_key=api_key,
+                    base_url=base_url,
+                    x_proxy_cache=x_proxy_cache,
+                    call=lambda: call_scheduled(
+                        x_client_name,
+                        request,
+                        lambda: call_balanced(
+                            upstream,
+                            lambda endpoint_url: openai_chat_non_stream_via_cohere_v2(
+                                request=request,
+                                api_key=api_key,
+                                x_client_name=x_client_name,
+                                accepts=accepts,
+                                base_url=endpoint_url,
+                            ) if via_cohere_v2 else openai_chat_non_stream(
+                                request=request,
+                                api_key=api_key,
+                                x_client_name=x_client_name,
+                                accepts=accepts,
+                                base_url=endpoint_url,
+                                upstream=upstream,
+                            ),
+                            base_path=base_path,
+                        ),
+                    ),
+                ),
             )
             additional_texts = await prepend_zwsp_to_each_lines(await make_additional_texts(additional_info))
             if additional_texts:
@@ -224,6 +383,9 @@ async def cohere_v1_chat(
     ocp_apim_subscription_key: str | None = Header(None),
     accepts: str = Header("text/event-stream"),
     x_client_name: str | None = Header(None),
+    x_proxy_cache: str | None = Header(None),
+    content_length: int | None = Header(None),
+    x_proxy_replay: str | None = Header(None),
 # ) -> StreamingResponse | CohereChatV1Response:
 ) -> cohere.NonStreamedChatResponse | cohere.StreamedChatResponse:
     # from icecream import ic; ic(request)
@@ -249,20 +411,39 @@ async def cohere_v1_chat(
     else:
         api_key = 'invalid_key'
 
-    if request.stream:
+    await RateLimiter.get_instance().admit(
+        api_key=api_key, model=request.model, request=request, content_length=content_length,
+    )
+
+    via_v2 = Environment.get_instance().cohere_v1_via_v2 and can_bridge_v1(request)
+    # Bridged responses are kept apart from those of the v1 API.
+    cache_route = "cohere_chat_v1_via_v2" if via_v2 else "cohere_chat_v1"
+    recorded, recorder = lookup_stream(
+        route=cache_route,
+        request=request,
+        api_key=api_key,
+        base_url=Environment.get_instance().cohere_url,
+        x_proxy_cache=x_proxy_cache,
+    ) if request.stream else (None, None)
+    if recorded is not None:
+        return replay_StreamingResponse(recorded, x_proxy_replay=x_proxy_replay)
+
+    async def open_stream(endpoint_url: str | None) -> StreamingResponse:
+        # Hedged attempts must not write into the same recording: each gets its own.
+        attempt_recorder = recorder.for_attempt() if recorder is not None else None
         try:
-            stream, additional_info = cohere_chat_v1_stream(
+            stream, additional_info = await (cohere_chat_v1_stream_via_v2 if via_v2 else cohere_chat_v1_stream)(
                 request=request,
                 api_key=api_key,
                 x_client_name=x_client_name,
                 accepts=accepts,
+                base_url=endpoint_url,
             )
             additional_texts = await prepend_zwsp_to_each_lines(
                 await make_additional_texts(additional_info)
             )
-            request_model_dump = request.model_dump(exclude_none=True, exclude_unset=True, exclude_defaults=True); from icecream import ic; ic(additional_texts, request_model_dump)
-            dispatcher = StreamingResponseHTTPExceptionDispatcherForCohere(response=stream, api_version="v1", additional_strings=additional_texts)
-            return dispatcher.get_StreamingResponse_or_raise_HTTPException()
+            dispatcher = StreamingResponseHTTPExceptionDispatcherForCohere(response=stream, api_version="v1", additional_strings=additional_texts, recorder=attempt_recorder)
+            return await dispatcher.get_StreamingResponse_or_raise_HTTPException()
         except Exception as exp:  # TODO: should shrink the range from general Exception
             if 'block' not in exp.__class__.__name__.lower():
                 raise
@@ -285,17 +466,51 @@ async def cohere_v1_chat(
                     ),
                     media_type="text/event-stream",
                 )
+
+    if request.stream:
+        return buffer_stream("cohere_chat_v1", await stream_coalesced(
+            route=cache_route,
+            request=request,
+            api_key=api_key,
+            base_url=Environment.get_instance().cohere_url,
+            x_proxy_cache=x_proxy_cache,
+            open_response=lambda: stream_scheduled(
+                x_client_name, request, lambda: stream_balanced("cohere", open_stream),
+            ),
+        ))
     else:
         # raise HTTPException(
         #     status_code=400,
         #     detail="Streaming is required for this endpoint. Please set 'stream' to true in the request."
         # )
         try:
-            response, additional_info = cohere_chat_v1_non_stream(
+            response, additional_info = await call_with_response_cache(
+                route=cache_route,
                 request=request,
                 api_key=api_key,
-                x_client_name=x_client_name,
-                accepts=accepts,
+                base_url=Environment.get_instance().cohere_url,
+                x_proxy_cache=x_proxy_cache,
+                call=lambda: call_coalesced(
+                    route=cache_route,
+                    request=request,
+                    api_key=api_key,
+                    base_url=Environment.get_instance().cohere_url,
+                    x_proxy_cache=x_proxy_cache,
+                    call=lambda: call_scheduled(
+                        x_client_name,
+                        request,
+                        lambda: call_balanced(
+                            "cohere",
+                            lambda endpoint_url: (cohere_chat_v1_non_stream_via_v2 if via_v2 else cohere_chat_v1_non_stream)(
+                                request=request,
+                                api_key=api_key,
+                                x_client_name=x_client_name,
+                                accepts=accepts,
+                                base_url=endpoint_url,
+                            ),
+                        ),
+                    ),
+                ),
             )
         except Exception:
             import traceback; traceback.print_exc()
@@ -315,11 +530,14 @@ async def cohere_v2_chat(
     ocp_apim_subscription_key: str | None = Header(None),
     accepts: str = Header("text/event-stream"),
     x_client_name: str | None = Header(None),
+    x_proxy_cache: str | None = Header(None),
+    content_length: int | None = Header(None),
+    x_proxy_replay: str | None = Header(None),
 # ) -> StreamingResponse | CohereChatV2Response:
 ) -> cohere.V2ChatResponse | StreamingResponse | CohereChatV2Response:
     if Environment.get_instance().dev_show_incoming_message:
         LF = '\n'
-        print(f'''{datetime.now().strftime("%Y-%m-%d %H:%M:%S")} [Cohere V2 Chat] Incoming message:{LF}{LF.join(f"{message.get("role", "-")}: {message.get("content", "")}" for message in request.messages)}''')
+        print(f'''{datetime.now().strftime("%Y-%m-%d %H:%M:%S")} [Cohere V2 Chat] Incoming message:{LF}{LF.join(f"{message.get('role', '-')}: {message.get('content', '')}" for message in request.messages)}''')
     if authorization is not None and authorization.lower().startswith("bearer "):
         api_key = authorization[len("bearer "):].strip()
     elif ocp_apim_subscription_key is not None:
@@ -335,19 +553,48 @@ async def cohere_v2_chat(
     else:
         api_key = 'invalid_key'
 
-    if request.stream:
+    await RateLimiter.get_instance().admit(
+        api_key=api_key, model=request.model, request=request, content_length=content_length,
+    )
+
+    recorded, recorder = lookup_stream(
+        route="cohere_chat_v2",
+        request=request,
+        api_key=api_key,
+        base_url=Environment.get_instance().cohere_url,
+        x_proxy_cache=x_proxy_cache,
+    ) if request.stream else (None, None)
+    if recorded is not None:
+        return replay_StreamingResponse(recorded, x_proxy_replay=x_proxy_replay)
+
+    async def open_stream(endpoint_url: str | None) -> StreamingResponse:
+        # Hedged attempts must not write into the same recording: each gets its own.
+        attempt_recorder = recorder.for_attempt() if recorder is not None else None
+        if Environment.get_instance().passthrough_same_protocol:
+            forwarder, additional_info = cohere_chat_v2_stream_passthrough(
+                request=request,
+                api_key=api_key,
+                x_client_name=x_client_name,
+                base_url=endpoint_url,
+            )
+            forwarder.recorder = attempt_recorder
+            forwarder.additional_strings = await prepend_zwsp_to_each_lines(
+                await make_additional_texts(additional_info)
+            )
+            return await forwarder.get_StreamingResponse_or_raise_HTTPException()
         try:
-            stream, additional_info = cohere_chat_v2_stream(
+            stream, additional_info = await cohere_chat_v2_stream(
                 request=request,
                 api_key=api_key,
                 x_client_name=x_client_name,
                 accepts=accepts,
+                base_url=endpoint_url,
             )
             additional_texts = await prepend_zwsp_to_each_lines(
                 await make_additional_texts(additional_info)
             )
-            dispatcher = StreamingResponseHTTPExceptionDispatcherForCohere(response=stream, api_version="v2", additional_strings=additional_texts)
-            return dispatcher.get_StreamingResponse_or_raise_HTTPException()
+            dispatcher = StreamingResponseHTTPExceptionDispatcherForCohere(response=stream, api_version="v2", additional_strings=additional_texts, recorder=attempt_recorder)
+            return await dispatcher.get_StreamingResponse_or_raise_HTTPException()
         except Exception as exp:
             if 'block' not in exp.__class__.__name__.lower():
                 raise
@@ -370,17 +617,51 @@ async def cohere_v2_chat(
                     ),
                     media_type="text/event-stream",
                 )
+
+    if request.stream:
+        return buffer_stream("cohere_chat_v2", await stream_coalesced(
+            route="cohere_chat_v2",
+            request=request,
+            api_key=api_key,
+            base_url=Environment.get_instance().cohere_url,
+            x_proxy_cache=x_proxy_cache,
+            open_response=lambda: stream_scheduled(
+                x_client_name, request, lambda: stream_balanced("cohere", open_stream),
+            ),
+        ))
     else:
         # raise HTTPException(
         #     status_code=400,
         #     detail="Streaming is required for this endpoint. Please set 'stream' to true in the request."
         # )
         try:
-            response, additional_info = cohere_chat_v2_non_stream(
+            response, additional_info = await call_with_response_cache(
+                route="cohere_chat_v2",
                 request=request,
                 api_key=api_key,
-                x_client_name=x_client_name,
-                accepts=accepts,
+                base_url=Environment.get_instance().cohere_url,
+                x_proxy_cache=x_proxy_cache,
+                call=lambda: call_coalesced(
+                    route="cohere_chat_v2",
+                    request=request,
+                    api_key=api_key,
+                    base_url=Environment.get_instance().cohere_url,
+                    x_proxy_cache=x_proxy_cache,
+                    call=lambda: call_scheduled(
+                        x_client_name,
+                        request,
+                        lambda: call_balanced(
+                            "cohere",
+                            lambda endpoint_url: cohere_chat_v2_non_stream(
+                                request=request,
+                                api_key=api_key,
+                                x_client_name=x_client_name,
+                                accepts=accepts,
+                                base_url=endpoint_url,
+                            ),
+                        ),
+                    ),
+                ),
             )
             if additional_info and response.message.role == 'assistant':
                 additional_texts = await prepend_zwsp_to_each_lines(
@@ -392,6 +673,229 @@ async def cohere_v2_chat(
             import traceback; traceback.print_exc()
             raise
 
+
+@app.post("/v1/messages", response_model=dict)
+@show_result_with_control(to_show=lambda: Environment.get_instance().debug_trace_response)
+async def anthropic_messages(
+    request: Union[AnthropicMessagesNonStreamingRequest, AnthropicMessagesStreamingRequest],
+    authorization: str | None = Header(None),
+    x_api_key: str | None = Header(None),
+    anthropic_beta: str | None = Header(None),
+    accepts: str = Header("text/event-stream"),
+    x_client_name: str | None = Header(None),
+    x_proxy_cache: str | None = Header(None),
+    content_length: int | None = Header(None),
+    x_proxy_replay: str | None = Header(None),
+) -> StreamingResponse | dict:
+    if x_api_key is not None:
+        api_key = x_api_key.strip()
+    elif authorization is not None and authorization.lower().startswith("bearer "):
+        api_key = authorization[len("bearer "):].strip()
+    elif Environment.get_instance().precheck_api_key:
+        raise HTTPException(
+            status_code=401,
+            detail=(
+                "Access denied due to invalid subscription key. Make sure to provide a valid key for an active subscription. "
+                "Either 'X-Api-Key' header or 'Authorization' header with bearer token is required."
+            )
+        )
+    else:
+        api_key = 'invalid_key'
+    if anthropic_beta is not None:
+        request.extra_headers = {**(request.extra_headers or {}), "anthropic-beta": anthropic_beta}
+
+    await RateLimiter.get_instance().admit(
+        api_key=api_key, model=request.model, request=request, content_length=content_length,
+    )
+
+    recorded, recorder = lookup_stream(
+        route="anthropic_messages",
+        request=request,
+        api_key=api_key,
+        base_url=Environment.get_instance().anthropic_url,
+        x_proxy_cache=x_proxy_cache,
+    ) if request.stream else (None, None)
+    if recorded is not None:
+        return replay_StreamingResponse(recorded, x_proxy_replay=x_proxy_replay)
+
+    async def open_stream(endpoint_url: str | None) -> StreamingResponse:
+        # Hedged attempts must not write into the same recording: each gets its own.
+        attempt_recorder = recorder.for_attempt() if recorder is not None else None
+        stream, additional_info = await anthropic_messages_stream(
+            request=request,
+            api_key=api_key,
+            x_client_name=x_client_name,
+            accepts=accepts,
+            base_url=endpoint_url,
+        )
+        additional_texts = await prepend_zwsp_to_each_lines(
+            await make_additional_texts(additional_info)
+        )
+        dispatcher = StreamingResponseHTTPExceptionDispatcherForAnthropic(response=stream, additional_strings=additional_texts, recorder=attempt_recorder)
+        return await dispatcher.get_StreamingResponse_or_raise_HTTPException()
+
+    if request.stream:
+        return buffer_stream("anthropic_messages", await stream_coalesced(
+            route="anthropic_messages",
+            request=request,
+            api_key=api_key,
+            base_url=Environment.get_instance().anthropic_url,
+            x_proxy_cache=x_proxy_cache,
+            open_response=lambda: stream_scheduled(
+                x_client_name, request, lambda: stream_balanced("anthropic", open_stream),
+            ),
+        ))
+    else:
+        response, additional_info = await call_with_response_cache(
+            route="anthropic_messages",
+            request=request,
+            api_key=api_key,
+            base_url=Environment.get_instance().anthropic_url,
+            x_proxy_cache=x_proxy_cache,
+            call=lambda: call_coalesced(
+                route="anthropic_messages",
+                request=request,
+                api_key=api_key,
+                base_url=Environment.get_instance().anthropic_url,
+                x_proxy_cache=x_proxy_cache,
+                call=lambda: call_scheduled(
+                    x_client_name,
+                    request,
+                    lambda: call_balanced(
+                        "anthropic",
+                        lambda endpoint_url: anthropic_messages_non_stream(
+                            request=request,
+                            api_key=api_key,
+                            x_client_name=x_client_name,
+                            accepts=accepts,
+                            base_url=endpoint_url,
+                        ),
+                    ),
+                ),
+            ),
+        )
+        additional_texts = await prepend_zwsp_to_each_lines(await make_additional_texts(additional_info))
+        if additional_texts:
+            append_text(response, ''.join(additional_texts))
+        return response.model_dump(exclude_unset=True)
+
+
+@app.post("/v1/embeddings", response_model=dict)
+@show_result_with_control(to_show=lambda: Environment.get_instance().debug_trace_response)
+async def v1_embeddings(
+    request: OpenAIEmbeddingsRequest,
+    authorization: str | None = Header(None),
+    x_proxy_cache: str | None = Header(None),
+    content_length: int | None = Header(None),
+    x_proxy_embedding_encoding: str | None = Header(None),
+) -> dict:
+    if authorization is not None and authorization.lower().startswith("bearer "):
+        api_key = authorization[len("bearer "):].strip()
+    elif Environment.get_instance().precheck_api_key:
+        raise HTTPException(
+            status_code=401,
+            detail=(
+                "Access denied due to invalid subscription key. Make sure to provide a valid key for an active subscription. "
+                "Either 'Authorization' header with bearer token is required."
+            )
+        )
+    else:
+        api_key = 'invalid_key'
+    embedding_encoding = parse_embedding_encoding(x_proxy_embedding_encoding)
+
+    await RateLimiter.get_instance().admit(
+        api_key=api_key, model=request.model, request=request, content_length=content_length,
+    )
+
+    return await openai_create_embeddings(
+        request=request,
+        api_key=api_key,
+        base_url=Environment.get_instance().openai_url,
+        x_proxy_cache=x_proxy_cache,
+        embedding_encoding=embedding_encoding,
+    )
+
+
+@app.post("/v2/embed", response_model=dict)
+@show_result_with_control(to_show=lambda: Environment.get_instance().debug_trace_response)
+async def cohere_v2_embed(
+    request: CohereEmbedV2Request,
+    authorization: str | None = Header(None),
+    ocp_apim_subscription_key: str | None = Header(None),
+    x_proxy_cache: str | None = Header(None),
+    content_length: int | None = Header(None),
+    x_proxy_embedding_encoding: str | None = Header(None),
+) -> dict:
+    if authorization is not None and authorization.lower().startswith("bearer "):
+        api_key = authorization[len("bearer "):].strip()
+    elif ocp_apim_subscription_key is not None:
+        api_key = ocp_apim_subscription_key.strip()
+    elif Environment.get_instance().precheck_api_key:
+        raise HTTPException(
+            status_code=401,
+            detail=(
+                "Access denied due to invalid subscription key. Make sure to provide a valid key for an active subscription. "
+                "Either 'Authorization' header with bearer token is required."
+            )
+        )
+    else:
+        api_key = 'invalid_key'
+    embedding_encoding = parse_embedding_encoding(x_proxy_embedding_encoding)
+
+    await RateLimiter.get_instance().admit(
+        api_key=api_key, model=request.model, request=request, content_length=content_length,
+    )
+
+    return await cohere_create_embeddings(
+        request=request,
+        api_key=api_key,
+        base_url=Environment.get_instance().cohere_url,
+        x_proxy_cache=x_proxy_cache,
+        embedding_encoding=embedding_encoding,
+    )
+
+
+@app.post("/v2/rerank", response_model=dict)
+@show_result_with_control(to_show=lambda: Environment.get_instance().debug_trace_response)
+async def cohere_v2_rerank(
+    request: CohereRerankV2Request,
+    authorization: str | None = Header(None),
+    ocp_apim_subscription_key: str | None = Header(None),
+    x_proxy_cache: str | None = Header(None),
+    content_length: int | None = Header(None),
+) -> dict:
+    if authorization is not None and authorization.lower().startswith("bearer "):
+        api_key = authorization[len("bearer "):].strip()
+    elif ocp_apim_subscription_key is not None:
+        api_key = ocp_apim_subscription_key.strip()
+    elif Environment.get_instance().precheck_api_key:
+        raise HTTPException(
+            status_code=401,
+            detail=(
+                "Access denied due to invalid subscription key. Make sure to provide a valid key for an active subscription. "
+                "Either 'Authorization' header with bearer token is required."
+            )
+        )
+    else:
+        api_key = 'invalid_key'
+
+    await RateLimiter.get_instance().admit(
+        api_key=api_key, model=request.model, request=request, content_length=content_length,
+    )
+
+    return await cohere_rerank(
+        request=request,
+        api_key=api_key,
+        base_url=Environment.get_instance().cohere_url,
+        x_proxy_cache=x_proxy_cache,
+    )
+
+
 @app.get("/ping")
 def pong() -> str:
     return "pong2"
+
+
+@app.get("/metrics")
+async def metrics() -> dict:
+    return ProxyMetrics.get_instance().snapshot()
@@ -0,0 +1,289 @@
+"""
+Single-flight coalescing of identical in-flight chat requests.
+
+While a deterministic request (temperature 0 or a seed, as for the caches) is
+in flight, identical requests (same canonical key as the response caches)
+attach to it instead of calling the upstream; sampled requests each get their
+own sample. Non-stream callers share the result; stream callers share the
+bytes written by the first caller's dispatcher, fanned out through one bounded
+queue per subscriber so a slow reader cannot stall the others. When the first
+caller goes away before the response arrives, the others are not failed with
+it: one of them takes over.
+"""
+
+from __future__ import annotations
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, TypeVar
+import asyncio
+
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+from resources.environment import Environment
+from server.common_service import close_iterator_quietly
+from server.metrics import ProxyMetrics
+from server.response_cache import canonical_request_key, copy_response, is_cache_bypassed, is_deterministic_request
+
+
+T = TypeVar('T')
+
+# Outcome of a flight whose leader was cancelled: its followers retry, and one of them leads.
+_LEADER_GONE = object()
+
+
+class SubscriberTooSlowError(Exception):
+    """Raised into a coalesced stream whose reader fell more than its queue size behind."""
+
+
+def _mark_retrieved(future: asyncio.Future) -> None:
+    # Nobody may have attached to the flight; keep asyncio from reporting the exception as lost.
+    if not future.cancelled():
+        future.exception()
+
+
+class _Subscriber:
+    def __init__(self, max_chunks: int):
+        self.max_chunks = max_chunks
+        self.chunks: deque[bytes] = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    def offer(self, chunk: bytes) -> None:
+        if len(self.chunks) >= self.max_chunks:
+            self.overflowed = True
+        else:
+            self.chunks.append(chunk)
+        self.ready.set()
+
+
+class StreamFlight:
+    """One upstream stream pumped into every subscriber.
+
+    The chunks sent so far are kept so that late arrivals start from the
+    beginning; once they exceed `max_history_bytes` the flight stops accepting
+    new subscribers and the history is released.
+    """
+
+    def __init__(
+        self,
+        source: StreamingResponse,
+        queue_size: int,
+        max_history_bytes: int,
+        on_unjoinable: Callable[[], None],
+    ):
+        self.source = source
+        self.queue_size = queue_size
+        self.max_history_bytes = max_history_bytes
+        self.on_unjoinable = on_unjoinable
+        self.history: list[bytes] | None = []
+        self.history_bytes = 0
+        self.subscribers: set[_Subscriber] = set()
+        self.done = False
+        self.error: BaseException | None = None
+        self.task: asyncio.Task | None = None
+
+    @property
+    def joinable(self) -> bool:
+        return self.history is not None and not self.done
+
+    def _close_for_joining(self) -> None:
+        if self.history is not None:
+            self.history = None
+            self.on_unjoinable()
+
+    async def _pump(self) -> None:
+        iterator = self.source.body_iterator
+        try:
+            async for chunk in iterator:
+                if self.history is not None:
+                    self.history.append(chunk)
+                    self.history_bytes += len(chunk)
+                    if self.history_bytes > self.max_history_bytes:
+                        self._close_for_joining()
+                for subscriber in self.subscribers:
+                    subscriber.offer(chunk)
+        except asyncio.CancelledError:
+            await close_iterator_quietly(iterator)
+            raise
+        except Exception as exp:
+            self.error = exp
+        finally:
+            self.done = True
+            self._close_for_joining()
+            for subscriber in self.subscribers:
+                subscriber.ready.set()
+
+    def subscribe(self) -> StreamingResponse:
+        subscriber = _Subscriber(self.queue_size)
+        backlog = list(self.history or [])
+        self.subscribers.add(subscriber)
+        if self.task is None:
+            self.task = asyncio.create_task(self._pump())
+        return StreamingResponse(
+            self._stream(subscriber, backlog),
+            status_code=self.source.status_code,
+            media_type=self.source.media_type,
+        )
+
+    async def _stream(self, subscriber: _Subscriber, backlog: list[bytes]) -> AsyncIterator[bytes]:
+        try:
+            for chunk in backlog:
+                yield chunk
+            while True:
+                while subscriber.chunks:
+                    yield subscriber.chunks.popleft()
+                if subscriber.overflowed:
+                    ProxyMetrics.get_instance().increment('single_flight_slow_subscribers')
+                    raise SubscriberTooSlowError(
+                        f"Coalesced stream reader fell more than {self.queue_size} chunks behind."
+                    )
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                subscriber.ready.clear()
+                await subscriber.ready.wait()
+        finally:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers and not self.done and self.task is not None:
+                self._close_for_joining()
+                self.task.cancel()
+
+
+class SingleFlight:
+    instance: SingleFlight | None = None
+
+    def __init__(self, enabled: bool, queue_size: int, max_history_bytes: int):
+        self.enabled = enabled
+        self.queue_size = queue_size
+        self.max_history_bytes = max_history_bytes
+        self._calls: dict[str, asyncio.Future] = {}
+        self._streams: dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    @classmethod
+    def get_instance(cls) -> SingleFlight:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.single_flight,
+                queue_size=env.single_flight_queue_chunks,
+                max_history_bytes=env.single_flight_max_history_bytes,
+            )
+            ProxyMetrics.get_instance().register_source('single_flight', cls.instance.stats)
+        return cls.instance
+
+    async def call(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        future = self._calls.get(key)
+        if future is not None:
+            self.followers += 1
+            outcome = await asyncio.shield(future)
+            if outcome is _LEADER_GONE:
+                return await self.call(key, call)
+            return copy_response(outcome)
+
+        self.leaders += 1
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_mark_retrieved)
+        self._calls[key] = future
+        try:
+            result = await call()
+        except BaseException as exp:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+            if isinstance(exp, asyncio.CancelledError):
+                # Only the leader's client is gone: the followers still want the response.
+                future.set_result(_LEADER_GONE)
+            else:
+                future.set_exception(exp)
+            raise
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # The callers modify what they get, so the leader gets a copy too.
+        future.set_result(result)
+        return copy_response(result)
+
+    async def stream(self, key: str, open_response: Callable[[], Awaitable[Response]]) -> Response:
+        future = self._streams.get(key)
+        if future is not None:
+            self.followers += 1
+            outcome = await asyncio.shield(future)
+            if outcome is _LEADER_GONE:
+                return await self.stream(key, open_response)
+            if not isinstance(outcome, StreamFlight):
+                return outcome
+            if outcome.joinable:
+                return outcome.subscribe()
+            return await self.stream(key, open_response)
+
+        self.leaders += 1
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_mark_retrieved)
+        self._streams[key] = future
+
+        def forget() -> None:
+            if self._streams.get(key) is future:
+                del self._streams[key]
+
+        try:
+            response = await open_response()
+        except BaseException as exp:
+            forget()
+            if isinstance(exp, asyncio.CancelledError):
+                # Only the leader's client is gone: the followers still want the stream.
+                future.set_result(_LEADER_GONE)
+            else:
+                future.set_exception(exp)
+            raise
+        if not isinstance(response, StreamingResponse):
+            forget()
+            future.set_result(response)
+            return response
+        flight = StreamFlight(
+            source=response,
+            queue_size=self.queue_size,
+            max_history_bytes=self.max_history_bytes,
+            on_unjoinable=forget,
+        )
+        future.set_result(flight)
+        return flight.subscribe()
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            enabled=self.enabled,
+            in_flight_calls=len(self._calls),
+            in_flight_streams=len(self._streams),
+            leaders=self.leaders,
+            followers=self.followers,
+        )
+
+
+async def call_coalesced(
+    route: str,
+    request: BaseModel,
+    api_key: str | None,
+    call: Callable[[], Awaitable[T]],
+    base_url: str | None = None,
+    x_proxy_cache: str | None = None,
+) -> T:
+    single_flight = SingleFlight.get_instance()
+    if not single_flight.enabled or is_cache_bypassed(x_proxy_cache) or not is_deterministic_request(request):
+        return await call()
+    key = canonical_request_key(route=route, request=request, api_key=api_key, base_url=base_url)
+    return await single_flight.call(key, call)
+
+
+async def stream_coalesced(
+    route: str,
+    request: BaseModel,
+    api_key: str | None,
+    open_response: Callable[[], Awaitable[Response]],
+    base_url: str | None = None,
+    x_proxy_cache: str | None = None,
+) -> Response:
+    single_flight = SingleFlight.get_instance()
+    if not single_flight.enabled or is_cache_bypassed(x_proxy_cache) or not is_deterministic_request(request):
+        return await open_response()
+    key = canonical_request_key(route=route, request=request, api_key=api_key, base_url=base_url)
+    return await single_flight.stream(key, open_response)
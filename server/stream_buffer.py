@@ -0,0 +1,204 @@
+"""
+Bounded buffer between the upstream side of a stream and the client socket.
+
+The upstream is read by its own task into a per-stream buffer, so a fast
+upstream is not slowed down by a client that reads in bursts, while the
+memory a slow or stalled client can pin is bounded twice: by
+`STREAM_BUFFER_MAX_BYTES` per stream and by `STREAM_BUFFER_GLOBAL_MAX_BYTES`
+across all active streams. What happens when a bound is reached is the
+policy of the route (`STREAM_BUFFER_POLICIES`):
+
+- `block`: stop reading the upstream until the client catches up;
+- `coalesce`: merge the buffered chunks so the client gets them in one
+  write, then block;
+- `abort`: drop the buffer, close the upstream and end the stream with an
+  error.
+"""
+
+from __future__ import annotations
+from collections import deque
+from typing import Any, AsyncIterator, Literal
+import asyncio
+
+from fastapi.responses import Response, StreamingResponse
+
+from resources.environment import Environment
+from server.common_service import close_iterator_quietly
+from server.metrics import ProxyMetrics
+
+
+BufferPolicy = Literal["block", "coalesce", "abort"]
+
+_POLICIES = ("block", "coalesce", "abort")
+
+
+class StreamBufferOverflowError(Exception):
+    """Raised into a stream whose client fell too far behind under the `abort` policy."""
+
+
+def parse_policies(entries: list[str]) -> dict[str, BufferPolicy]:
+    """Parse `route:policy` entries."""
+    policies: dict[str, BufferPolicy] = {}
+    for entry in entries:
+        route, _, policy = entry.rpartition(':')
+        if policy not in _POLICIES:
+            raise ValueError(f"Invalid stream buffer policy: {policy}. Expected one of {', '.join(_POLICIES)}.")
+        policies[route.strip()] = policy
+    return policies
+
+
+class _BufferedStream:
+    def __init__(self, owner: StreamBuffer, route: str, source: AsyncIterator[bytes], policy: BufferPolicy):
+        self.owner = owner
+        self.route = route
+        self.source = source
+        self.policy = policy
+        self.chunks: deque[bytes] = deque()
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.done = False
+        self.error: BaseException | None = None
+
+    def _over_limit(self, size: int) -> bool:
+        # An empty buffer always takes one chunk, so a chunk larger than the limits still goes through.
+        return bool(self.chunks) and (
+            self.bytes + size > self.owner.max_bytes_per_stream or
+            self.owner.total_bytes + size > self.owner.global_max_bytes
+        )
+
+    def _push(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self.bytes += len(chunk)
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+        self.owner.total_bytes += len(chunk)
+        self.readable.set()
+
+    def _pop(self) -> bytes:
+        chunk = self.chunks.popleft()
+        self.bytes -= len(chunk)
+        self.owner.total_bytes -= len(chunk)
+        self.owner.wake_writers()
+        return chunk
+
+    def _drop(self) -> None:
+        self.owner.total_bytes -= self.bytes
+        self.chunks.clear()
+        self.bytes = 0
+        self.owner.wake_writers()
+
+    async def _produce(self) -> None:
+        try:
+            async for chunk in self.source:
+                while self._over_limit(len(chunk)):
+                    if self.policy == "abort":
+                        self.owner.aborted += 1
+                        ProxyMetrics.get_instance().increment('stream_buffer_aborts', route=self.route)
+                        self._drop()
+                        raise StreamBufferOverflowError(
+                            f"Stream aborted: the client fell more than {self.owner.max_bytes_per_stream} bytes behind."
+                        )
+                    if self.policy == "coalesce" and len(self.chunks) > 1:
+                        self.owner.coalesced += len(self.chunks) - 1
+                        self.chunks = deque([b''.join(self.chunks)])
+                    self.owner.blocked += 1
+                    self.writable.clear()
+                    self.owner.waiting_writers.add(self)
+                    try:
+                        await self.writable.wait()
+                    finally:
+                        self.owner.waiting_writers.discard(self)
+                self._push(chunk)
+        except Exception as exp:
+            self.error = exp
+        finally:
+            self.done = True
+            self.readable.set()
+            await close_iterator_quietly(self.source)
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        self.owner.active_streams += 1
+        producer = asyncio.create_task(self._produce())
+        try:
+            while True:
+                while self.chunks:
+                    yield self._pop()
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                self.readable.clear()
+                await self.readable.wait()
+        finally:
+            producer.cancel()
+            self._drop()
+            self.owner.active_streams -= 1
+            self.owner.peak_stream_bytes = max(self.owner.peak_stream_bytes, self.peak_bytes)
+
+
+class StreamBuffer:
+    instance: StreamBuffer | None = None
+
+    def __init__(
+        self,
+        enabled: bool,
+        max_bytes_per_stream: int,
+        global_max_bytes: int,
+        default_policy: BufferPolicy,
+        policies: dict[str, BufferPolicy],
+    ):
+        self.enabled = enabled
+        self.max_bytes_per_stream = max_bytes_per_stream
+        self.global_max_bytes = global_max_bytes
+        self.default_policy = default_policy
+        self.policies = policies
+        self.total_bytes = 0
+        self.active_streams = 0
+        self.peak_stream_bytes = 0
+        self.waiting_writers: set[_BufferedStream] = set()
+        self.blocked = 0
+        self.coalesced = 0
+        self.aborted = 0
+
+    @classmethod
+    def get_instance(cls) -> StreamBuffer:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            policies = parse_policies(env.stream_buffer_policies)
+            cls.instance = cls(
+                enabled=env.stream_buffer,
+                max_bytes_per_stream=env.stream_buffer_max_bytes,
+                global_max_bytes=env.stream_buffer_global_max_bytes,
+                default_policy=policies.pop('default', "block"),
+                policies=policies,
+            )
+            ProxyMetrics.get_instance().register_source('stream_buffer', cls.instance.stats)
+        return cls.instance
+
+    def wake_writers(self) -> None:
+        for buffered in self.waiting_writers:
+            buffered.writable.set()
+
+    def wrap(self, route: str, response: Response) -> Response:
+        if not self.enabled or not isinstance(response, StreamingResponse):
+            return response
+        buffered = _BufferedStream(self, route, response.body_iterator, self.policies.get(route, self.default_policy))
+        response.body_iterator = buffered.stream()
+        return response
+
+    def stats(self) -> dict[str, Any]:
+        return dict(
+            enabled=self.enabled,
+            active_streams=self.active_streams,
+            buffered_bytes=self.total_bytes,
+            global_max_bytes=self.global_max_bytes,
+            peak_stream_bytes=self.peak_stream_bytes,
+            blocked=self.blocked,
+            coalesced_chunks=self.coalesced,
+            aborted=self.aborted,
+        )
+
+
+def buffer_stream(route: str, response: Response) -> Response:
+    return StreamBuffer.get_instance().wrap(route, response)
@@ -0,0 +1,154 @@
+"""
+Record-and-replay cache of streamed chat responses for deterministic requests.
+
+The first response is recorded exactly as it was written to the client, as one
+contiguous byte buffer with the end offset and the delay of every chunk, so a
+replay gives byte-identical v1 NDJSON, v2 SSE or OpenAI SSE framing.
+"""
+
+from __future__ import annotations
+from array import array
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Literal
+import asyncio
+import time
+
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from resources.environment import Environment
+from server.metrics import ProxyMetrics
+from server.response_cache import (
+    ResponseCache,
+    canonical_request_key,
+    is_cache_bypassed,
+    is_deterministic_request,
+)
+
+
+ReplayTiming = Literal["instant", "original"]
+
+
+@dataclass(frozen=True)
+class RecordedStream:
+    buffer: bytes
+    # End offset of each chunk in `buffer`.
+    offsets: array
+    # Seconds elapsed before each chunk, measured from the previous one.
+    delays: array
+    media_type: str
+
+    @property
+    def size(self) -> int:
+        return len(self.buffer) + self.offsets.itemsize * len(self.offsets) + self.delays.itemsize * len(self.delays)
+
+
+class StreamRecorder:
+    """Collects the chunks sent to the client and stores them once the stream completed."""
+
+    def __init__(self, key: str, media_type: str = "text/event-stream"):
+        self.key = key
+        self.media_type = media_type
+        self._buffer = bytearray()
+        self._offsets = array('Q')
+        self._delays = array('f')
+        self._last = time.monotonic()
+
+    def for_attempt(self) -> StreamRecorder:
+        """An empty recorder for the same entry, for one of several attempts at the stream.
+
+        Only an attempt whose stream is sent to the end commits its recording."""
+        return StreamRecorder(self.key, self.media_type)
+
+    def append(self, chunk: bytes) -> None:
+        now = time.monotonic()
+        self._buffer += chunk
+        self._offsets.append(len(self._buffer))
+        self._delays.append(now - self._last)
+        self._last = now
+
+    def commit(self) -> None:
+        StreamCache.get_instance().put(self.key, RecordedStream(
+            buffer=bytes(self._buffer),
+            offsets=self._offsets,
+            delays=self._delays,
+            media_type=self.media_type,
+        ))
+
+
+class StreamCache(ResponseCache):
+    """LRU/TTL cache of recorded streams, bounded by entry count and by total bytes."""
+    instance: StreamCache | None = None
+
+    def __init__(self, enabled: bool, max_entries: int, max_bytes: int, ttl_seconds: float):
+        super().__init__(enabled=enabled, max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    @classmethod
+    def get_instance(cls) -> StreamCache:
+        if cls.instance is None:
+            env = Environment.get_instance()
+            cls.instance = cls(
+                enabled=env.stream_cache,
+                max_entries=env.stream_cache_max_entries,
+                max_bytes=env.stream_cache_max_bytes,
+                ttl_seconds=env.stream_cache_ttl_seconds,
+            )
+            ProxyMetrics.get_instance().register_source('stream_cache', cls.instance.stats)
+        return cls.instance
+
+    def _copy_value(self, value: RecordedStream) -> RecordedStream:
+        return value
+
+    def _on_stored(self, value: RecordedStream) -> None:
+        self.bytes += value.size
+
+    def _on_removed(self, value: RecordedStream) -> None:
+        self.bytes -= value.size
+
+    def _is_over_capacity(self) -> bool:
+        return self.bytes > self.max_bytes and len(self._entries) > 0
+
+    def stats(self) -> dict[str, Any]:
+        return dict(super().stats(), bytes=self.bytes, max_bytes=self.max_bytes)
+
+
+def lookup_stream(
+    route: str,
+    request: BaseModel,
+    api_key: str | None,
+    base_url: str | None = None,
+    x_proxy_cache: str | None = None,
+) -> tuple[RecordedStream | None, StreamRecorder | None]:
+    """Return the recorded stream on a hit, or a recorder to pass to the dispatcher on a miss.
+    Both are None when the request must not be cached."""
+    cache = StreamCache.get_instance()
+    if not cache.enabled or is_cache_bypassed(x_proxy_cache) or not is_deterministic_request(request):
+        return None, None
+    key = canonical_request_key(route=route, request=request, api_key=api_key, base_url=base_url)
+    recorded = cache.get(key)
+    if recorded is not None:
+        return recorded, None
+    return None, StreamRecorder(key)
+
+
+def parse_replay_timing(x_proxy_replay: str | None) -> ReplayTiming:
+    value = (x_proxy_replay or Environment.get_instance().stream_cache_replay_timing).strip().lower()
+    return "original" if value == "original" else "instant"
+
+
+async def replay(recorded: RecordedStream, timing: ReplayTiming = "instant") -> AsyncIterator[bytes]:
+    start = 0
+    for end, delay in zip(recorded.offsets, recorded.delays):
+        if timing == "original" and delay > 0:
+            await asyncio.sleep(delay)
+        yield recorded.buffer[start:end]
+        start = end
+
+
+def replay_StreamingResponse(recorded: RecordedStream, x_proxy_replay: str | None = None) -> StreamingResponse:
+    return StreamingResponse(
+        replay(recorded, parse_replay_timing(x_proxy_replay)),
+        media_type=recorded.media_type,
+    )
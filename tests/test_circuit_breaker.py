@@ -0,0 +1,141 @@
+import pytest
+
+import server.circuit_breaker as circuit_breaker
+from server.circuit_breaker import CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", clock)
+    return clock
+
+
+def make_breaker(**overrides) -> CircuitBreaker:
+    settings = dict(
+        upstream="cohere",
+        endpoint="http://endpoint/",
+        enabled=True,
+        window_seconds=60,
+        min_calls=4,
+        failure_rate=0.5,
+        slow_call_seconds=10,
+        slow_call_rate=0.8,
+        open_seconds=30,
+        half_open_probes=2,
+    )
+    settings.update(overrides)
+    return CircuitBreaker(**settings)
+
+
+def finish(breaker: CircuitBreaker, failed: bool = False, latency: float | None = 0.1) -> None:
+    breaker.on_finish(breaker.on_start(), failed=failed, latency=latency)
+
+
+def test_opens_once_enough_calls_fail(clock):
+    breaker = make_breaker()
+    finish(breaker, failed=True)
+    finish(breaker, failed=True)
+    finish(breaker, failed=True)
+    # Fewer than min_calls in the window: still closed.
+    assert breaker.state == "closed"
+
+    finish(breaker)
+
+    assert breaker.state == "open"
+    assert not breaker.is_available()
+    assert breaker.retry_after() == 30
+
+
+def test_opens_on_slow_calls(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        finish(breaker, latency=12)
+
+    assert breaker.state == "open"
+
+
+def test_calls_without_latency_are_never_slow(clock):
+    breaker = make_breaker()
+    for _ in range(8):
+        finish(breaker, latency=None)
+
+    assert breaker.state == "closed"
+    assert breaker.stats()["window_slow_calls"] == 0
+
+
+def test_old_failures_leave_the_window(clock):
+    breaker = make_breaker()
+    finish(breaker, failed=True)
+    finish(breaker, failed=True)
+    clock.now += 61
+    finish(breaker)
+    finish(breaker)
+    finish(breaker)
+
+    assert breaker.state == "closed"
+    assert breaker.stats()["window_failures"] == 0
+
+
+def test_half_open_lets_probes_through_and_closes_when_they_succeed(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        finish(breaker, failed=True)
+    clock.now += 30
+
+    assert breaker.is_available()
+    assert breaker.state == "half_open"
+    first, second = breaker.on_start(), breaker.on_start()
+    assert first and second
+    # Every probe slot is taken.
+    assert not breaker.is_available()
+
+    breaker.on_finish(first, failed=False, latency=0.1)
+    assert breaker.state == "half_open"
+    breaker.on_finish(second, failed=False, latency=0.1)
+
+    assert breaker.state == "closed"
+    assert breaker.is_available()
+
+
+def test_half_open_opens_again_on_a_failed_probe(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        finish(breaker, failed=True)
+    clock.now += 30
+    assert breaker.is_available()
+
+    finish(breaker, failed=True)
+
+    assert breaker.state == "open"
+    assert not breaker.is_available()
+
+
+def test_calls_started_before_opening_do_not_count(clock):
+    breaker = make_breaker()
+    in_flight = [breaker.on_start() for _ in range(3)]
+    for _ in range(4):
+        finish(breaker, failed=True)
+    assert breaker.state == "open"
+
+    for probe in in_flight:
+        breaker.on_finish(probe, failed=False, latency=0.1)
+
+    assert breaker.state == "open"
+
+
+def test_disabled_breaker_is_always_available(clock):
+    breaker = make_breaker(enabled=False)
+    for _ in range(10):
+        finish(breaker, failed=True)
+
+    assert breaker.is_available()
+    assert breaker.stats()["state"] == "disabled"
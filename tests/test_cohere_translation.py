@@ -0,0 +1,52 @@
+import asyncio
+import json
+
+import pytest
+from cohere.core.api_error import ApiError
+
+from server.cohere_service import StreamingResponseHTTPExceptionDispatcherForCohere
+from server.cohere_translation import translate_v2_stream
+from server.openai_service import StreamingResponseHTTPExceptionDispatcherForOpenAI
+
+
+V2_EVENTS = [
+    {"type": "message-start", "id": "generation-1"},
+    {"type": "content-start", "index": 0},
+    {"type": "content-delta", "index": 0, "delta": {"message": {"content": {"text": "Hello"}}}},
+    {"type": "content-delta", "index": 0, "delta": {"message": {"content": {"text": " world"}}}},
+    {"type": "content-end", "index": 0},
+    {"type": "message-end", "delta": {"finish_reason": "COMPLETE"}},
+]
+
+
+async def _events():
+    for event in V2_EVENTS:
+        yield event
+
+
+def _consume(make_dispatcher) -> list[dict]:
+    async def run() -> bytes:
+        stream = translate_v2_stream(_events(), model="command-r")
+        response = await make_dispatcher(stream).get_StreamingResponse_or_raise_HTTPException()
+        return b"".join([chunk async for chunk in response.body_iterator])
+
+    body = asyncio.run(run())
+    return [json.loads(line[len(b"data: "):]) for line in body.split(b"\n\n") if line]
+
+
+@pytest.mark.parametrize("make_dispatcher", [
+    lambda stream: StreamingResponseHTTPExceptionDispatcherForOpenAI(
+        response=stream, exception_type_to_catch=ApiError, additional_strings=["extra"],
+    ),
+    lambda stream: StreamingResponseHTTPExceptionDispatcherForCohere(
+        response=stream, api_version="openai", additional_strings=["extra"],
+    ),
+], ids=["openai_dispatcher", "cohere_dispatcher"])
+def test_translated_stream_gets_additional_texts_before_the_finish_chunk(make_dispatcher):
+    chunks = _consume(make_dispatcher)
+
+    contents = [(chunk["choices"][0]["delta"].get("content"), chunk["choices"][0].get("finish_reason")) for chunk in chunks]
+    assert "".join(content or "" for content, _ in contents) == "Hello worldextra"
+    assert contents[-2] == ("extra", None)
+    assert contents[-1] == (None, "stop")
+    assert {chunk["id"] for chunk in chunks} == {"generation-1"}
@@ -0,0 +1,60 @@
+import asyncio
+
+from server.circuit_breaker import CircuitBreaker
+from server.load_balancer import Endpoint, LoadBalancer, UpstreamBalancer, call_balanced
+
+
+def test_failing_endpoint_does_not_stay_preferred_as_unmeasured(monkeypatch):
+    balancer = UpstreamBalancer(
+        "cohere",
+        [Endpoint(url="http://failing/"), Endpoint(url="http://healthy/")],
+        ewma_alpha=0.3,
+    )
+    monkeypatch.setattr(LoadBalancer, "instance", LoadBalancer({"cohere": balancer}))
+    calls = {"http://failing/": 0, "http://healthy/": 0}
+
+    async def call(url: str | None) -> str:
+        calls[url] += 1
+        if url == "http://failing/":
+            raise ConnectionError("connection refused")
+        await asyncio.sleep(0.001)
+        return "ok"
+
+    async def run() -> None:
+        for _ in range(50):
+            try:
+                await call_balanced("cohere", call)
+            except ConnectionError:
+                pass
+
+    asyncio.run(run())
+
+    failing, healthy = balancer.endpoints
+    assert failing.ewma_ttft is not None
+    assert calls["http://failing/"] <= 2
+    assert calls["http://healthy/"] >= 48
+
+
+def test_long_non_stream_calls_are_not_slow_calls(monkeypatch):
+    endpoint = Endpoint(url="http://healthy/")
+    endpoint.breaker = CircuitBreaker(
+        "cohere", endpoint.name, enabled=True, window_seconds=60, min_calls=2, failure_rate=0.5,
+        slow_call_seconds=0.001, slow_call_rate=0.5, open_seconds=30, half_open_probes=1,
+    )
+    balancer = UpstreamBalancer("cohere", [endpoint], ewma_alpha=0.3)
+    monkeypatch.setattr(LoadBalancer, "instance", LoadBalancer({"cohere": balancer}))
+
+    async def generate(url: str | None) -> str:
+        await asyncio.sleep(0.01)
+        return "a long completion"
+
+    async def run() -> None:
+        for _ in range(5):
+            await call_balanced("cohere", generate)
+
+    asyncio.run(run())
+
+    assert endpoint.breaker.state == "closed"
+    assert endpoint.breaker.slow_calls == 0
+    assert endpoint.ewma_ttft is None
+    assert not balancer.recent_ttfts
@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+import pytest
+
+from server.passthrough import SSEPassthroughForwarder
+
+
+class FakeResponse:
+    def __init__(self, chunks: list[bytes]):
+        self.chunks = chunks
+        self.closed = False
+
+    async def aiter_raw(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def aclose(self) -> None:
+        self.closed = True
+
+
+def _split_every(data: bytes, size: int) -> list[bytes]:
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+def _forward(forwarder: SSEPassthroughForwarder, response: FakeResponse) -> bytes:
+    async def run() -> bytes:
+        return b"".join([chunk async for chunk in forwarder._forward(response, response.aiter_raw())])
+
+    return asyncio.run(run())
+
+
+def _events(body: bytes) -> list[dict]:
+    return [
+        json.loads(line[len(b"data: "):])
+        for event in body.split(b"\n\n") if event
+        for line in event.split(b"\n") if line.startswith(b"data: ")
+    ]
+
+
+OPENAI_STREAM = b"".join(
+    b"data: " + json.dumps(chunk).encode() + b"\n\n"
+    for chunk in [
+        dict(id="chatcmpl-1", choices=[dict(index=0, delta=dict(content="Hello"), finish_reason=None)]),
+        dict(id="chatcmpl-1", choices=[dict(index=0, delta=dict(content=" world"), finish_reason=None)]),
+        dict(id="chatcmpl-1", choices=[dict(index=0, delta={}, finish_reason="stop")]),
+    ]
+) + b"data: [DONE]\n\n"
+
+COHERE_V2_STREAM = b"".join(
+    b"event: " + event["type"].encode() + b"\ndata: " + json.dumps(event).encode() + b"\r\n\r\n"
+    for event in [
+        {"type": "message-start", "id": "generation-1"},
+        {"type": "content-delta", "index": 0, "delta": {"message": {"content": {"text": "Hello"}}}},
+        {"type": "content-end", "index": 0},
+        {"type": "message-end", "delta": {"finish_reason": "COMPLETE"}},
+    ]
+)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, len(OPENAI_STREAM)])
+def test_openai_injection_before_the_finish_chunk_whatever_the_chunking(chunk_size):
+    forwarder = SSEPassthroughForwarder(
+        "openai", "http://upstream/", {}, api_key=None, additional_strings=["extra"], first_chunk_timeout=1,
+    )
+    response = FakeResponse(_split_every(OPENAI_STREAM, chunk_size))
+
+    body = _forward(forwarder, response)
+
+    events = [event for event in body.split(b"\n\n") if event]
+    assert events[-1] == b"data: [DONE]"
+    chunks = _events(body.replace(b"data: [DONE]\n\n", b""))
+    assert [chunk["choices"][0]["delta"].get("content") for chunk in chunks] == ["Hello", " world", "extra", None]
+    assert chunks[2]["id"] == "chatcmpl-1"
+    assert response.closed
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 33, len(COHERE_V2_STREAM)])
+def test_cohere_v2_injection_before_content_end_whatever_the_chunking(chunk_size):
+    forwarder = SSEPassthroughForwarder(
+        "cohere_v2", "http://upstream/", {}, api_key=None, additional_strings=["extra"], first_chunk_timeout=1,
+    )
+    response = FakeResponse(_split_every(COHERE_V2_STREAM, chunk_size))
+
+    body = _forward(forwarder, response)
+
+    assert [event["type"] for event in _events(body)] == [
+        "message-start", "content-delta", "content-delta", "content-end", "message-end",
+    ]
+    assert _events(body)[2]["delta"]["message"]["content"]["text"] == "extra"
+    assert response.closed
+
+
+def test_stream_without_finishing_event_is_forwarded_whole():
+    forwarder = SSEPassthroughForwarder(
+        "openai", "http://upstream/", {}, api_key=None, additional_strings=["extra"], first_chunk_timeout=1,
+    )
+    truncated = OPENAI_STREAM[:OPENAI_STREAM.index(b'data: {"id": "chatcmpl-1", "choices": [{"index": 0, "delta": {}')]
+    response = FakeResponse(_split_every(truncated + b"data: partial", 9))
+
+    assert _forward(forwarder, response) == truncated + b"data: partial"
+    assert response.closed
+
+
+def test_nothing_to_inject_forwards_chunks_as_received():
+    forwarder = SSEPassthroughForwarder("openai", "http://upstream/", {}, api_key=None, first_chunk_timeout=1)
+    chunks = _split_every(OPENAI_STREAM, 10)
+
+    async def run() -> list[bytes]:
+        response = FakeResponse(chunks)
+        return [chunk async for chunk in forwarder._forward(response, response.aiter_raw())]
+
+    assert asyncio.run(run()) == chunks
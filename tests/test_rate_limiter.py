@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+from pydantic import BaseModel
+
+from server.errors import TooManyRequestsError
+from server.rate_limiter import RateLimiter, bound_tokens, estimate_tokens
+
+
+class ChatRequest(BaseModel):
+    model: str = "command-r"
+    message: str = "x" * 400
+    max_tokens: int | None = 100
+
+
+def make_limiter(**overrides) -> RateLimiter:
+    settings = dict(
+        enabled=True,
+        requests_per_second=1000,
+        burst=1000,
+        tokens_per_minute=600,
+        queue_size=10,
+        max_wait_seconds=0.5,
+        max_keys=10,
+    )
+    settings.update(overrides)
+    return RateLimiter(**settings)
+
+
+def test_rejects_with_retry_after_when_the_wait_is_too_long():
+    limiter = make_limiter()
+    request = ChatRequest()
+
+    async def run() -> None:
+        await limiter.admit("key", request.model, request)
+        await limiter.admit("key", request.model, request)
+        await limiter.admit("key", request.model, request)
+
+    with pytest.raises(TooManyRequestsError) as raised:
+        asyncio.run(run())
+
+    assert int(raised.value.headers["Retry-After"]) >= 1
+    assert limiter.stats()["admitted"] == 2
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_tenants_and_models_have_their_own_buckets():
+    limiter = make_limiter(tokens_per_minute=300)
+    request = ChatRequest()
+
+    async def run() -> None:
+        await limiter.admit("key", "command-r", request)
+        await limiter.admit("other-key", "command-r", request)
+        await limiter.admit("key", "command-r-plus", request)
+
+    asyncio.run(run())
+
+    assert limiter.stats()["admitted"] == 3
+
+
+def test_content_length_bound_is_settled_with_the_estimate():
+    limiter = make_limiter()
+    request = ChatRequest()
+    content_length = len(request.model_dump_json()) + 200
+
+    asyncio.run(limiter.admit("key", request.model, request, content_length=content_length))
+
+    assert bound_tokens(request, content_length) > estimate_tokens(request)
+    (limits,) = limiter._limits.values()
+    assert limits.tokens.tokens == pytest.approx(600 - estimate_tokens(request), abs=1)
+
+
+def test_rejected_requests_are_not_serialized(monkeypatch):
+    limiter = make_limiter(tokens_per_minute=60)
+    request = ChatRequest()
+    serialized = []
+    monkeypatch.setattr(
+        "server.rate_limiter.estimate_tokens", lambda request: serialized.append(request) or 1,
+    )
+
+    async def run() -> None:
+        await limiter.admit("key", request.model, request, content_length=400)
+        for _ in range(5):
+            with pytest.raises(TooManyRequestsError):
+                await limiter.admit("key", request.model, request, content_length=400)
+
+    asyncio.run(run())
+
+    assert len(serialized) == 1
+
+
+def test_disabled_limiter_admits_everything():
+    limiter = make_limiter(enabled=False, tokens_per_minute=1)
+    request = ChatRequest()
+
+    async def run() -> None:
+        for _ in range(10):
+            await limiter.admit("key", request.model, request)
+
+    asyncio.run(run())
+
+    assert limiter.stats()["admitted"] == 0
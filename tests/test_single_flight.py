@@ -0,0 +1,88 @@
+import asyncio
+
+from fastapi.responses import StreamingResponse
+
+from server.single_flight import SingleFlight
+
+
+def test_identical_calls_share_one_upstream_call():
+    single_flight = SingleFlight(enabled=True, queue_size=16, max_history_bytes=1 << 20)
+    calls = 0
+
+    async def call() -> dict:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"text": "hello"}
+
+    async def run() -> list[dict]:
+        return await asyncio.gather(*(single_flight.call("key", call) for _ in range(5)))
+
+    results = asyncio.run(run())
+
+    assert calls == 1
+    assert results == [{"text": "hello"}] * 5
+    # Every caller gets its own copy.
+    assert len({id(result) for result in results}) == 5
+    assert single_flight.stats()["in_flight_calls"] == 0
+
+
+def test_followers_take_over_when_the_leader_is_cancelled():
+    single_flight = SingleFlight(enabled=True, queue_size=16, max_history_bytes=1 << 20)
+    calls = 0
+
+    async def call() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def run() -> list[str]:
+        leader = asyncio.create_task(single_flight.call("key", call))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(single_flight.call("key", call)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await asyncio.gather(*followers)
+
+    assert asyncio.run(run()) == ["answer"] * 3
+    assert calls == 2
+
+
+def test_failure_of_the_leader_reaches_the_followers():
+    single_flight = SingleFlight(enabled=True, queue_size=16, max_history_bytes=1 << 20)
+
+    async def call() -> str:
+        await asyncio.sleep(0.01)
+        raise ConnectionError("upstream down")
+
+    async def run() -> list:
+        return await asyncio.gather(*(single_flight.call("key", call) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(result, ConnectionError) for result in asyncio.run(run()))
+
+
+def test_stream_subscribers_each_get_every_chunk():
+    single_flight = SingleFlight(enabled=True, queue_size=16, max_history_bytes=1 << 20)
+    opened = 0
+
+    async def body():
+        for chunk in (b"data: 1\n\n", b"data: 2\n\n", b"data: 3\n\n"):
+            await asyncio.sleep(0.005)
+            yield chunk
+
+    async def open_response() -> StreamingResponse:
+        nonlocal opened
+        opened += 1
+        await asyncio.sleep(0.01)
+        return StreamingResponse(body(), media_type="text/event-stream")
+
+    async def read() -> bytes:
+        response = await single_flight.stream("key", open_response)
+        return b"".join([chunk async for chunk in response.body_iterator])
+
+    async def run() -> list[bytes]:
+        return await asyncio.gather(*(read() for _ in range(3)))
+
+    assert asyncio.run(run()) == [b"data: 1\n\ndata: 2\n\ndata: 3\n\n"] * 3
+    assert opened == 1